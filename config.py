@@ -47,6 +47,17 @@ class Config:
     TWITTER_CLIENT_SECRET = environ.get("TWITTER_CLIENT_SECRET")
 
 
+    # Scheduler daemon, see pickr_flask/scheduler.py
+    SCHEDULE_TIMEZONE = environ.get("SCHEDULE_TIMEZONE", "Europe/London")
+    # job name -> cron spec (minute hour day-of-month month day-of-week),
+    # a job without a spec doesn't run
+    SCHEDULE = {
+        "all_niches_update": "59 0 * * *",
+        "all_niches_run_pipeline": "59 1 * * *",
+        "all_users_run_schedule": "59 4 * * 1",
+        "send_marketing_dms": "0 15 * * *",
+    }
+
     # Celery
     timezone = "Europe/London"  # timezone for cron jobs
     CELERY = dict(
@@ -57,9 +68,16 @@ class Config:
         task_create_missing_queues=True,
         # The following determines what queue the tasks are on.
         # Any compute-heavy tasks should be put on "model_runner" queue.
+        # Tasks that mostly wait on the GPT and news APIs go on the "llm"
+        # queue, whose workers run many of them at once in threads.
         task_default_queue="default",
         task_routes={
-            "pickr_flask.tasks.run_niche_topic_model": {"queue": "model_runner"}
+            "pickr_flask.tasks.run_niche_topic_model": {"queue": "model_runner"},
+            # needs the saved topic models and the sentence model
+            "pickr_flask.tasks.assign_new_posts": {"queue": "model_runner"},
+            "pickr_flask.tasks.run_niche_trends": {"queue": "llm"},
+            "pickr_flask.tasks.generate_niche_topic_overviews": {"queue": "llm"},
+            "pickr_flask.tasks.generate_modeled_topic_tweets": {"queue": "llm"},
         },
         # Set schedules for periodic tasks using celery beat
         
@@ -93,10 +111,66 @@ class Config:
 
     # OpenAI API
     OPENAI_API_KEY = environ.get("OPENAI_API_KEY")
+    # max. number of GPT requests in flight per process
+    OPENAI_MAX_CONCURRENCY = int(environ.get("OPENAI_MAX_CONCURRENCY", 8))
+    # "thread" or "asyncio"
+    OPENAI_EXECUTOR_MODE = environ.get("OPENAI_EXECUTOR_MODE", "thread")
+    # responses to prompts sent with temperature <= LLM_CACHE_MAX_TEMPERATURE
+    # are cached, set LLM_CACHE_PATH="" to disable the cache
+    LLM_CACHE_PATH = environ.get("LLM_CACHE_PATH", path.join(basedir, "llm_cache.sqlite3"))
+    LLM_CACHE_MAX_TEMPERATURE = float(environ.get("LLM_CACHE_MAX_TEMPERATURE", 0.2))
+    LLM_CACHE_TTL_DAYS = int(environ.get("LLM_CACHE_TTL_DAYS", 30))
+    LLM_CACHE_MAX_ENTRIES = int(environ.get("LLM_CACHE_MAX_ENTRIES", 100000))
     
     # News API
     NEWS_API_KEY = environ.get("NEWS_API_KEY")
 
+    # Topic model
+    # fitted per-niche models are saved here for incremental runs
+    TOPIC_MODEL_DIR = environ.get("TOPIC_MODEL_DIR", path.join(basedir, "topic_models"))
+    TOPIC_MODEL_INCREMENTAL = environ.get("TOPIC_MODEL_INCREMENTAL", "true").lower() == "true"
+    # niches the looped topic pipeline runs at once, each in its own process
+    PIPELINE_NICHE_WORKERS = int(environ.get("PIPELINE_NICHE_WORKERS", 4))
+    # days the archived fit of each run is kept, see topic_model/fit_archive.py
+    TOPIC_FIT_KEEP_DAYS = int(environ.get("TOPIC_FIT_KEEP_DAYS", 30))
+    # assign posts to the saved models as they're ingested, between runs
+    TOPIC_STREAMING = environ.get("TOPIC_STREAMING", "true").lower() == "true"
+    # processes used to clean large batches of fetched posts, 1 cleans inline
+    TEXT_CLEANING_PROCESSES = int(environ.get("TEXT_CLEANING_PROCESSES", 1))
+
+    # Fetching
+    # threads fetching the subreddits and terms of a niche at once
+    FETCH_MAX_WORKERS = int(environ.get("FETCH_MAX_WORKERS", 8))
+    # requests per provider shared by all workers, with bursts up to "burst".
+    # reddit allows 100 requests a minute per OAuth client, twitter recent
+    # search 450 per 15 minutes per app, the news api developer plan 100 a day.
+    FETCH_RATE_LIMITS = {
+        "reddit": dict(
+            requests=int(environ.get("REDDIT_REQUESTS_PER_MINUTE", 90)),
+            per_seconds=60, burst=10,
+        ),
+        "twitter": dict(
+            requests=int(environ.get("TWITTER_SEARCH_REQUESTS_PER_15_MINUTES", 450)),
+            per_seconds=15 * 60, burst=10,
+        ),
+        "newsapi": dict(
+            requests=int(environ.get("NEWS_API_REQUESTS_PER_DAY", 100)),
+            per_seconds=24 * 60 * 60,
+        ),
+    }
+    # longest wait for a news api request before the term is skipped. The
+    # daily quota refills a request every ~15 minutes, which would hold up
+    # the llm queue's threads
+    NEWS_API_RATE_LIMIT_TIMEOUT = float(environ.get("NEWS_API_RATE_LIMIT_TIMEOUT", 60))
+    # redis holding the shared rate limits, defaults to the celery broker.
+    # set it to "" to limit each process on its own
+    RATE_LIMIT_REDIS_URL = environ.get("RATE_LIMIT_REDIS_URL")
+    # send all API requests to this server instead, e.g. a local fake
+    FETCH_API_BASE_URL = environ.get("FETCH_API_BASE_URL")
+    # reddit posts of a niche whose engagement is refreshed before each
+    # topic model run, 100 per request
+    REDDIT_REFRESH_MAX_POSTS = int(environ.get("REDDIT_REFRESH_MAX_POSTS", 5000))
+
 class DevConfig(Config):
     TESTING = True
     DEBUG = True
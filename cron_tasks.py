@@ -4,21 +4,36 @@ app = typer.Typer()
 
 
 @app.command()
-def posts():
+def scheduler():
+    """
+    Run the scheduler daemon, which runs the scheduled jobs and posts
+    the scheduled tweets, see pickr_flask/scheduler.py.
+    """
+    import signal
     from pickr_flask import init_app
     app = init_app()
     with app.app_context():
-        from pickr_flask.looped_tasks import post_scheduled_tweets
-        post_scheduled_tweets()
+        from pickr_flask.scheduler import build_scheduler
+        sched = build_scheduler(app)
+        signal.signal(signal.SIGTERM, lambda *_: sched.stop())
+        signal.signal(signal.SIGINT, lambda *_: sched.stop())
+        sched.run()
 
 
 @app.command()
-def schedule():
+def jobs():
+    """Show the last and next run of the scheduled jobs."""
     from pickr_flask import init_app
     app = init_app()
     with app.app_context():
-        from pickr_flask.looped_tasks import all_users_run_schedule_schdule
-        all_users_run_schedule_schdule()
+        from pickr_flask.models import ScheduledJob
+        for job in ScheduledJob.query.order_by(ScheduledJob.name).all():
+            print(
+                f"{job.name}: spec={job.spec} last_run={job.last_run_at} "
+                f"status={job.last_status} next_run={job.next_run_at}"
+            )
+            if job.last_error:
+                print(f"    {job.last_error}")
 
 
 @app.command()
@@ -48,15 +63,6 @@ def get_posts_run():
         all_niches_update()
 
 
-@app.command()
-def dms():
-    from pickr_flask import init_app
-    app = init_app()
-    with app.app_context():
-        from pickr_flask.looped_tasks import send_marketing_dms
-        send_marketing_dms()
-
-
 @app.command()
 def dms_run():
     from pickr_flask import init_app
@@ -66,15 +72,6 @@ def dms_run():
         run_marketing_functions()
 
 
-@app.command()
-def get_posts():
-    from pickr_flask import init_app
-    app = init_app()
-    with app.app_context():
-        from pickr_flask.looped_tasks import all_niches_update_schedule
-        all_niches_update_schedule()
-
-
 @app.command()
 def get_news_topics_run():
     from pickr_flask import init_app
@@ -93,15 +90,6 @@ def get_topics_run():
         all_niches_run_pipeline()
 
 
-@app.command()
-def get_topics():
-    from pickr_flask import init_app
-    app = init_app()
-    with app.app_context():
-        from pickr_flask.looped_tasks import all_niches_run_pipeline_schedule
-        all_niches_run_pipeline_schedule()
-
-
 @app.command()
 def get_topics_run_days():
     from pickr_flask import init_app
@@ -127,5 +115,15 @@ def clean_posts():
         clean_all_generated_tweets()
 
 
+@app.command()
+def nltk_data():
+    from topic_model.util import NLTK_DATA_DIR, download_nltk_data
+    failed = download_nltk_data()
+    if failed:
+        print(f"failed to download NLTK data: {failed}")
+        raise typer.Exit(code=1)
+    print(f"NLTK data is in {NLTK_DATA_DIR}")
+
+
 if __name__ == "__main__":
     app()
@@ -0,0 +1,99 @@
+"""daily engagement and topic trend
+
+Revision ID: 3f6b8d2e9a51
+Revises: a9c3d5e7f104
+Create Date: 2024-03-08 10:12:55.604318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6b8d2e9a51'
+down_revision = 'a9c3d5e7f104'
+branch_labels = None
+depends_on = None
+
+SNAPSHOT_TABLES = [
+    # (snapshot table, daily table, post key, metrics)
+    ('reddit_engagement_snapshot', 'reddit_engagement_daily', 'reddit_post_id', ('score', 'num_comments')),
+    ('tweet_engagement_snapshot', 'tweet_engagement_daily', 'tweet_id', ('likes', 'retweets')),
+]
+
+
+def upgrade():
+    op.create_table('reddit_engagement_daily',
+    sa.Column('reddit_post_id', sa.UUID(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('score', sa.Integer(), nullable=True),
+    sa.Column('num_comments', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['reddit_post_id'], ['pickr.reddit.id'], ),
+    sa.PrimaryKeyConstraint('reddit_post_id', 'day'),
+    schema='pickr'
+    )
+    op.create_table('tweet_engagement_daily',
+    sa.Column('tweet_id', sa.BigInteger(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('likes', sa.Integer(), nullable=True),
+    sa.Column('retweets', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['tweet_id'], ['pickr.tweet.id'], ),
+    sa.PrimaryKeyConstraint('tweet_id', 'day'),
+    schema='pickr'
+    )
+    op.create_table('topic_trend',
+    sa.Column('niche_id', sa.UUID(), nullable=False),
+    sa.Column('source', sa.String(length=16), nullable=False),
+    sa.Column('topic_id', sa.Integer(), nullable=False),
+    sa.Column('last_day', sa.Date(), nullable=True),
+    sa.Column('points', sa.Integer(), nullable=False),
+    sa.Column('n', sa.Float(), nullable=False),
+    sa.Column('sx', sa.Float(), nullable=False),
+    sa.Column('sy', sa.Float(), nullable=False),
+    sa.Column('sxy', sa.Float(), nullable=False),
+    sa.Column('sxx', sa.Float(), nullable=False),
+    sa.Column('half_life_days', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['niche_id'], ['pickr.niche.id'], ),
+    sa.PrimaryKeyConstraint('niche_id', 'source', 'topic_id'),
+    schema='pickr'
+    )
+    # keep the last snapshot of each post and day
+    for snapshot, daily, key, metrics in SNAPSHOT_TABLES:
+        columns = ', '.join(metrics)
+        op.execute(f"""
+            INSERT INTO pickr.{daily} ({key}, day, {columns})
+            SELECT DISTINCT ON ({key}, taken_at::date) {key}, taken_at::date, {columns}
+            FROM pickr.{snapshot}
+            ORDER BY {key}, taken_at::date, taken_at DESC
+        """)
+        op.drop_table(snapshot, schema='pickr')
+
+
+def downgrade():
+    op.create_table('reddit_engagement_snapshot',
+    sa.Column('reddit_post_id', sa.UUID(), nullable=False),
+    sa.Column('taken_at', sa.DateTime(), nullable=False),
+    sa.Column('score', sa.Integer(), nullable=True),
+    sa.Column('num_comments', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['reddit_post_id'], ['pickr.reddit.id'], ),
+    sa.PrimaryKeyConstraint('reddit_post_id', 'taken_at'),
+    schema='pickr'
+    )
+    op.create_table('tweet_engagement_snapshot',
+    sa.Column('tweet_id', sa.BigInteger(), nullable=False),
+    sa.Column('taken_at', sa.DateTime(), nullable=False),
+    sa.Column('likes', sa.Integer(), nullable=True),
+    sa.Column('retweets', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['tweet_id'], ['pickr.tweet.id'], ),
+    sa.PrimaryKeyConstraint('tweet_id', 'taken_at'),
+    schema='pickr'
+    )
+    for snapshot, daily, key, metrics in SNAPSHOT_TABLES:
+        columns = ', '.join(metrics)
+        op.execute(f"""
+            INSERT INTO pickr.{snapshot} ({key}, taken_at, {columns})
+            SELECT {key}, day, {columns} FROM pickr.{daily}
+        """)
+    op.drop_table('topic_trend', schema='pickr')
+    op.drop_table('tweet_engagement_daily', schema='pickr')
+    op.drop_table('reddit_engagement_daily', schema='pickr')
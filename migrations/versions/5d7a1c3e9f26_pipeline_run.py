@@ -0,0 +1,43 @@
+"""pipeline run
+
+Revision ID: 5d7a1c3e9f26
+Revises: c2d9e4a7b813
+Create Date: 2024-03-18 11:04:21.386517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d7a1c3e9f26'
+down_revision = 'c2d9e4a7b813'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('pipeline_run',
+    sa.Column('id', sa.UUID(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    schema='pickr'
+    )
+    op.create_table('pipeline_run_stage',
+    sa.Column('run_id', sa.UUID(), nullable=False),
+    sa.Column('niche_id', sa.UUID(), nullable=False),
+    sa.Column('stage', sa.String(length=32), nullable=False),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['niche_id'], ['pickr.niche.id'], ),
+    sa.ForeignKeyConstraint(['run_id'], ['pickr.pipeline_run.id'], ),
+    sa.PrimaryKeyConstraint('run_id', 'niche_id', 'stage'),
+    schema='pickr'
+    )
+
+
+def downgrade():
+    op.drop_table('pipeline_run_stage', schema='pickr')
+    op.drop_table('pipeline_run', schema='pickr')
@@ -0,0 +1,63 @@
+"""news article unique url
+
+Revision ID: 8d41c7a5e2f9
+Revises: 3b8e0f6c1d2a
+Create Date: 2024-02-12 09:41:27.503118
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41c7a5e2f9'
+down_revision = '3b8e0f6c1d2a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # merge duplicate articles into the oldest row for each url,
+    # moving their topic associations over first
+    op.execute(
+        """
+        CREATE TEMPORARY TABLE news_article_dupe ON COMMIT DROP AS
+        SELECT id, keep_id FROM (
+            SELECT id, first_value(id) OVER (
+                PARTITION BY url ORDER BY published_date NULLS LAST, id
+            ) AS keep_id
+            FROM pickr.news_article
+            WHERE url IS NOT NULL
+        ) ranked
+        WHERE id <> keep_id
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO pickr.news_modeled_topic_assoc (news_id, modeled_topic_id)
+        SELECT DISTINCT d.keep_id, a.modeled_topic_id
+        FROM pickr.news_modeled_topic_assoc a
+        JOIN news_article_dupe d ON a.news_id = d.id
+        ON CONFLICT DO NOTHING
+        """
+    )
+    op.execute(
+        """
+        DELETE FROM pickr.news_modeled_topic_assoc a
+        USING news_article_dupe d WHERE a.news_id = d.id
+        """
+    )
+    op.execute(
+        """
+        DELETE FROM pickr.news_article n
+        USING news_article_dupe d WHERE n.id = d.id
+        """
+    )
+    op.create_unique_constraint(
+        'news_article_url_key', 'news_article', ['url'], schema='pickr'
+    )
+
+
+def downgrade():
+    op.drop_constraint(
+        'news_article_url_key', 'news_article', schema='pickr', type_='unique'
+    )
@@ -0,0 +1,34 @@
+"""streamed topic assignment
+
+Revision ID: 8e2a4c6f1b37
+Revises: 3f6b8d2e9a51
+Create Date: 2024-03-12 14:41:07.218865
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2a4c6f1b37'
+down_revision = '3f6b8d2e9a51'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('modeled_topic', schema='pickr') as batch_op:
+        batch_op.add_column(sa.Column('model_topic_id', sa.Integer(), nullable=True))
+    with op.batch_alter_table('topic_trend', schema='pickr') as batch_op:
+        batch_op.add_column(sa.Column('open_day', sa.Date(), nullable=True))
+        batch_op.add_column(sa.Column('open_value', sa.Float(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('size', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('topic_trend', schema='pickr') as batch_op:
+        batch_op.drop_column('size')
+        batch_op.drop_column('open_value')
+        batch_op.drop_column('open_day')
+    with op.batch_alter_table('modeled_topic', schema='pickr') as batch_op:
+        batch_op.drop_column('model_topic_id')
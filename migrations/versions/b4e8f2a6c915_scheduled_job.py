@@ -0,0 +1,34 @@
+"""scheduled job
+
+Revision ID: b4e8f2a6c915
+Revises: 5d7a1c3e9f26
+Create Date: 2024-03-20 14:38:09.271845
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4e8f2a6c915'
+down_revision = '5d7a1c3e9f26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('scheduled_job',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('spec', sa.String(length=64), nullable=True),
+    sa.Column('last_run_at', sa.DateTime(), nullable=True),
+    sa.Column('last_finished_at', sa.DateTime(), nullable=True),
+    sa.Column('last_status', sa.String(length=16), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('next_run_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name'),
+    schema='pickr'
+    )
+
+
+def downgrade():
+    op.drop_table('scheduled_job', schema='pickr')
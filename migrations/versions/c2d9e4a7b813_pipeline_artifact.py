@@ -0,0 +1,38 @@
+"""pipeline artifact
+
+Revision ID: c2d9e4a7b813
+Revises: 8e2a4c6f1b37
+Create Date: 2024-03-15 09:27:33.540172
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2d9e4a7b813'
+down_revision = '8e2a4c6f1b37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('pipeline_artifact',
+    sa.Column('id', sa.UUID(), nullable=False),
+    sa.Column('kind', sa.String(length=64), nullable=False),
+    sa.Column('niche_id', sa.UUID(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['niche_id'], ['pickr.niche.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    schema='pickr'
+    )
+    with op.batch_alter_table('pipeline_artifact', schema='pickr') as batch_op:
+        batch_op.create_index(batch_op.f('ix_pickr_pipeline_artifact_created_at'), ['created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('pipeline_artifact', schema='pickr') as batch_op:
+        batch_op.drop_index(batch_op.f('ix_pickr_pipeline_artifact_created_at'))
+    op.drop_table('pipeline_artifact', schema='pickr')
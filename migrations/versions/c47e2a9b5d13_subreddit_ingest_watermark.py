@@ -0,0 +1,48 @@
+"""subreddit ingest watermark
+
+Revision ID: c47e2a9b5d13
+Revises: 8d41c7a5e2f9
+Create Date: 2024-02-19 10:12:53.206481
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47e2a9b5d13'
+down_revision = '8d41c7a5e2f9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('subreddit', schema='pickr') as batch_op:
+        batch_op.add_column(sa.Column('last_post_created_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('last_reddit_id', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('last_fetched_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('posts_per_day', sa.Float(), nullable=True))
+
+    # start from the newest post already stored for each subreddit
+    op.execute(
+        """
+        UPDATE pickr.subreddit s
+        SET last_post_created_at = latest.created_at,
+            last_reddit_id = latest.reddit_id
+        FROM (
+            SELECT DISTINCT ON (subreddit_id) subreddit_id, created_at, reddit_id
+            FROM pickr.reddit
+            WHERE subreddit_id IS NOT NULL AND created_at IS NOT NULL
+            ORDER BY subreddit_id, created_at DESC
+        ) latest
+        WHERE latest.subreddit_id = s.id
+        """
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('subreddit', schema='pickr') as batch_op:
+        batch_op.drop_column('posts_per_day')
+        batch_op.drop_column('last_fetched_at')
+        batch_op.drop_column('last_reddit_id')
+        batch_op.drop_column('last_post_created_at')
@@ -0,0 +1,34 @@
+"""twitter term ingest state
+
+Revision ID: e5b19d3f7a20
+Revises: c47e2a9b5d13
+Create Date: 2024-02-26 09:03:17.845120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b19d3f7a20'
+down_revision = 'c47e2a9b5d13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('twitter_term', schema='pickr') as batch_op:
+        batch_op.add_column(sa.Column('since_id', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('last_fetched_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('yield_rate', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('budget_month', sa.Date(), nullable=True))
+        batch_op.add_column(sa.Column('posts_read_month', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('twitter_term', schema='pickr') as batch_op:
+        batch_op.drop_column('posts_read_month')
+        batch_op.drop_column('budget_month')
+        batch_op.drop_column('yield_rate')
+        batch_op.drop_column('last_fetched_at')
+        batch_op.drop_column('since_id')
@@ -0,0 +1,29 @@
+"""scheduled post due index
+
+Revision ID: e7c3a9f1d482
+Revises: b4e8f2a6c915
+Create Date: 2024-03-22 16:51:40.118263
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7c3a9f1d482'
+down_revision = 'b4e8f2a6c915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('scheduled_post', schema='pickr') as batch_op:
+        batch_op.create_index(
+            'ix_pickr_scheduled_post_due', ['scheduled_for'], unique=False,
+            postgresql_where=sa.text('posted_at IS NULL AND scheduled_for IS NOT NULL'),
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('scheduled_post', schema='pickr') as batch_op:
+        batch_op.drop_index('ix_pickr_scheduled_post_due')
@@ -0,0 +1,72 @@
+'''
+Claim-check storage for the outputs of topic pipeline stages.
+
+The topic dicts of a niche, with the ids of every post and the
+representative docs of each topic, are too large to pass through the celery
+broker and result backend. A stage stores its output here and passes on a
+small reference instead, which the next stage loads.
+'''
+import json
+import logging
+import zlib
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import delete, exc
+
+from .models import PipelineArtifact, db
+
+log = logging.getLogger(__name__)
+
+COMPRESSION_LEVEL = 6
+
+
+def put_artifact(kind: str, payload: Any, niche_id=None) -> dict:
+    '''
+    Store a JSON serializable payload and return its reference,
+    a small dict that is safe to pass between celery tasks.
+    '''
+    data = json.dumps(payload, default=str, separators=(",", ":")).encode()
+    artifact = PipelineArtifact(
+        kind=kind,
+        niche_id=niche_id,
+        size=len(data),
+        data=zlib.compress(data, COMPRESSION_LEVEL),
+    )
+    db.session.add(artifact)
+    try:
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error storing {kind} artifact: {e}")
+        raise
+    log.info(
+        f"Stored {kind} artifact {artifact.id}: "
+        f"size={len(data)} compressed={len(artifact.data)}"
+    )
+    return {"artifact_id": str(artifact.id), "kind": kind}
+
+
+def is_artifact_ref(value) -> bool:
+    return isinstance(value, dict) and "artifact_id" in value
+
+
+def get_artifact(ref: dict) -> Any:
+    '''Load the payload of an artifact reference returned by put_artifact.'''
+    artifact = db.session.get(PipelineArtifact, ref["artifact_id"])
+    if artifact is None:
+        raise KeyError(f"Missing pipeline artifact {ref['artifact_id']}")
+    return json.loads(zlib.decompress(artifact.data))
+
+
+def prune_artifacts(older_than: datetime) -> None:
+    '''Delete artifacts created before older_than.'''
+    try:
+        db.session.execute(
+            delete(PipelineArtifact).where(PipelineArtifact.created_at < older_than)
+        )
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error pruning pipeline artifacts: {e}")
+        return
+    db.session.commit()
@@ -0,0 +1,100 @@
+'''
+Unit of work for the rows a pipeline stage writes.
+
+Stages used to add and commit one ORM object at a time. A BatchWriter
+collects the rows instead and writes them with one multi-row INSERT per
+table in a single transaction.
+'''
+import logging
+from collections import defaultdict
+from typing import Dict, List
+
+from sqlalchemy import Table, exc, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .models import db
+
+log = logging.getLogger(__name__)
+
+
+def _table(target) -> Table:
+    return target if isinstance(target, Table) else target.__table__
+
+
+class BatchWriter:
+    '''
+    Accumulate rows for ORM models or association tables, then insert
+    them all with flush(). Tables are written in the order rows were first
+    added to them, so add parents before the rows that reference them.
+
+    UUID primary keys are filled in by add(), so rows can reference each
+    other before they are written.
+    '''
+
+    def __init__(self):
+        self._rows: Dict[object, List[dict]] = defaultdict(list)
+
+    def add(self, target, row: dict) -> dict:
+        for column in _table(target).primary_key.columns:
+            default = column.default
+            if column.name not in row and default is not None and default.is_callable:
+                row[column.name] = default.arg(None)
+        self._rows[target].append(row)
+        return row
+
+    def add_all(self, target, rows: List[dict]) -> List[dict]:
+        return [self.add(target, row) for row in rows]
+
+    def add_object(self, obj):
+        '''
+        Add an ORM object now, to use its database generated id in later
+        rows. It's committed, or rolled back, with the rest of the batch.
+        '''
+        db.session.add(obj)
+        db.session.flush()
+        return obj
+
+    def __len__(self) -> int:
+        return sum(len(rows) for rows in self._rows.values())
+
+    def flush(self, returning: bool = False) -> Dict[object, list]:
+        '''
+        Insert the accumulated rows in one transaction and commit.
+        With returning=True the inserted ORM objects are returned per model.
+        On a database error the whole batch, objects from add_object()
+        included, is rolled back and the error is raised, so callers don't
+        go on to use ids that were never written.
+        '''
+        pending, self._rows = self._rows, defaultdict(list)
+        inserted = {}
+        try:
+            for target, rows in pending.items():
+                # parameter sets in one executemany need the same keys
+                groups = defaultdict(list)
+                for row in rows:
+                    groups[frozenset(row)].append(row)
+                for group in groups.values():
+                    if isinstance(target, Table):
+                        # association rows may repeat, the pair is the key
+                        db.session.execute(
+                            pg_insert(target).on_conflict_do_nothing(), group
+                        )
+                    elif returning:
+                        inserted.setdefault(target, []).extend(
+                            db.session.scalars(
+                                insert(target).returning(target), group
+                            ).all()
+                        )
+                    else:
+                        db.session.execute(insert(target), group)
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            db.session.rollback()
+            log.error(f"Database error occurred: {e}")
+            raise
+        log.debug(
+            "Wrote " + ", ".join(
+                f"{len(rows)} {_table(t).name}" for t, rows in pending.items()
+            )
+        )
+        return inserted
@@ -0,0 +1,66 @@
+'''
+Postgres backed store for topic_model.embedding_cache.
+'''
+import logging
+from typing import Dict, List
+
+import numpy as np
+from sqlalchemy import exc
+from sqlalchemy.dialects.postgresql import insert
+
+from topic_model.embedding_cache import encode_with_cache
+from topic_model.model_registry import TOPIC_ENCODER
+from .models import TextEmbedding, db
+
+log = logging.getLogger(__name__)
+
+# keep IN lists and multi-row inserts to a reasonable size
+BATCH_SIZE = 1000
+
+
+class DBEmbeddingStore:
+
+    def get_many(self, model_name: str, hashes: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        for i in range(0, len(hashes), BATCH_SIZE):
+            rows = (
+                db.session.query(TextEmbedding.text_hash, TextEmbedding.embedding)
+                .filter(
+                    TextEmbedding.model_name == model_name,
+                    TextEmbedding.text_hash.in_(hashes[i:i + BATCH_SIZE]),
+                )
+                .all()
+            )
+            for text_hash, embedding in rows:
+                found[text_hash] = np.frombuffer(embedding, dtype=np.float32)
+        return found
+
+    def put_many(self, model_name: str, embeddings: Dict[str, np.ndarray]) -> None:
+        rows = [
+            {
+                "model_name": model_name,
+                "text_hash": h,
+                "embedding": np.asarray(e, dtype=np.float32).tobytes(),
+            }
+            for h, e in embeddings.items()
+        ]
+        try:
+            for i in range(0, len(rows), BATCH_SIZE):
+                db.session.execute(
+                    insert(TextEmbedding)
+                    .values(rows[i:i + BATCH_SIZE])
+                    .on_conflict_do_nothing()
+                )
+        except exc.SQLAlchemyError as e:
+            db.session.rollback()
+            log.error(f"Error writing text embeddings: {e}")
+        else:
+            db.session.commit()
+
+
+def embed_texts(texts: List[str], model_name=TOPIC_ENCODER) -> np.ndarray:
+    '''
+    Embed texts through the database cache.
+    Called at ingest time so the topic model run finds its embeddings cached.
+    '''
+    return encode_with_cache(model_name, texts, DBEmbeddingStore())
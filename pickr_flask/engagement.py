@@ -0,0 +1,383 @@
+'''
+Refresh of the engagement of posts inside the trend window.
+
+Scores and likes are fetched once when a post is ingested, long before they
+settle. The refresh looks the posts up again in batches of 100 ids, writes
+the new values back with a bulk UPDATE and keeps the last values of each day
+they changed on, one row per post and day however often it's refreshed.
+Trend slopes are then computed from the engagement gained each day rather
+than from the value a post had when it was ingested.
+'''
+import logging
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Callable, Dict, List
+
+import pandas as pd
+from sqlalchemy import and_, delete, exc, func, or_, select, text
+from sqlalchemy.dialects.postgresql import insert
+from topic_model.trend import TrendState, rank_from_slope
+
+from .fetch_scheduler import FetchJob, FetchScheduler
+from .ingest import bulk_update
+from .models import (ModeledTopic, RedditEngagementDaily, RedditPost,
+                     TopicTrend, Tweet, TweetEngagementDaily, db)
+from .reddit import REDDIT_PAGE_SIZE, fetch_reddit_engagement
+from .twitter import SEARCH_PAGE_SIZE, fetch_tweet_engagement
+
+log = logging.getLogger(__name__)
+
+# same as the trend_prev_days of the topic analysis
+TREND_WINDOW = timedelta(days=14)
+# posts refreshed more recently than this are skipped
+MIN_REFRESH_INTERVAL = timedelta(hours=6)
+
+
+def _refresh(
+        model,
+        daily_model,
+        daily_key: str,
+        metrics: List[str],
+        posts: list,
+        lookup_key: str,
+        fetch: Callable[[list], Dict],
+        batch_size: int,
+        provider: str,
+        now: datetime,
+) -> int:
+    '''
+    Look up the metrics of posts concurrently, one job per batch, then
+    update the posts and the daily values of the changed ones in one
+    transaction. Returns the number of posts whose metrics changed.
+    '''
+    keys = [getattr(p, lookup_key) for p in posts]
+    jobs = [
+        FetchJob(provider, i, partial(fetch, keys[i:i + batch_size]))
+        for i in range(0, len(keys), batch_size)
+    ]
+    fetched = {}
+    # keys of the batches that were looked up, failed ones are retried
+    # on the next refresh rather than marked as refreshed
+    looked_up = set()
+    for done in FetchScheduler().run(jobs):
+        if done.error is None:
+            fetched.update(done.result)
+            looked_up.update(keys[done.job.key:done.job.key + batch_size])
+
+    updates, changed = [], []
+    for p in posts:
+        key = getattr(p, lookup_key)
+        if key not in looked_up:
+            continue
+        new = fetched.get(key)
+        if new is None:
+            # deleted: keep the old values
+            new = {m: getattr(p, m) for m in metrics}
+        elif any(new[m] != getattr(p, m) for m in metrics):
+            changed.append((p, new))
+        updates.append({lookup_key: key, "updated_at": now, **new})
+    if len(updates) == 0:
+        return 0
+
+    # posts refreshed for the first time also get the values they were
+    # ingested with, on the day they were, so their first gain is measured
+    # from those
+    daily_col = getattr(daily_model, daily_key)
+    changed_ids = [p.id for p, _ in changed]
+    tracked = set(db.session.scalars(
+        select(daily_col).where(daily_col.in_(changed_ids)).distinct()
+    )) if changed_ids else set()
+    today = now.date()
+    days = []
+    for p, new in changed:
+        ingested = (p.updated_at or p.created_at or now).date()
+        if p.id not in tracked and ingested < today:
+            days.append({
+                daily_key: p.id, "day": ingested, **{m: getattr(p, m) for m in metrics},
+            })
+        days.append({daily_key: p.id, "day": today, **new})
+
+    try:
+        bulk_update(model, updates, lookup_key, metrics + ["updated_at"])
+        if days:
+            stmt = insert(daily_model.__table__)
+            db.session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[daily_key, "day"],
+                    set_={m: stmt.excluded[m] for m in metrics},
+                ),
+                days,
+            )
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error writing {model.__tablename__} engagement: {e}")
+        return 0
+    db.session.commit()
+    log.info(
+        f"Refreshed {model.__tablename__} engagement: posts={len(posts)} "
+        f"found={len(fetched)} changed={len(changed)} days={len(days)}"
+    )
+    return len(changed)
+
+
+def refresh_reddit_engagement(subreddit_ids: List, now: datetime, max_posts: int) -> int:
+    '''
+    Refresh the score and comment count of the subreddits' posts inside
+    the trend window, least recently refreshed first.
+    '''
+    stale = now - MIN_REFRESH_INTERVAL
+    posts = db.session.execute(
+        select(
+            RedditPost.id, RedditPost.reddit_id, RedditPost.score,
+            RedditPost.num_comments, RedditPost.created_at, RedditPost.updated_at,
+        )
+        .where(and_(
+            RedditPost.subreddit_id.in_(subreddit_ids),
+            RedditPost.created_at >= now - TREND_WINDOW,
+            or_(RedditPost.updated_at.is_(None), RedditPost.updated_at < stale),
+        ))
+        .order_by(RedditPost.updated_at.asc().nulls_first())
+        .limit(max_posts)
+    ).all()
+    return _refresh(
+        RedditPost, RedditEngagementDaily, "reddit_post_id",
+        ["score", "num_comments"], posts, "reddit_id",
+        fetch_reddit_engagement, REDDIT_PAGE_SIZE, "reddit", now,
+    )
+
+
+def refresh_tweet_engagement(niche_id, now: datetime, max_posts: int) -> int:
+    '''
+    Refresh the likes and retweets of the niche's tweets inside the trend
+    window. Lookups count against the monthly tweet cap, so only the
+    max_posts most liked tweets that weren't refreshed today are looked up.
+    '''
+    if max_posts <= 0:
+        return 0
+    posts = db.session.execute(
+        select(
+            Tweet.id, Tweet.likes, Tweet.retweets,
+            Tweet.published_at.label("created_at"), Tweet.updated_at,
+        )
+        .where(and_(
+            Tweet.niche_id == niche_id,
+            Tweet.published_at >= now - TREND_WINDOW,
+            or_(Tweet.updated_at.is_(None), Tweet.updated_at < now - timedelta(days=1)),
+        ))
+        .order_by(Tweet.likes.desc().nulls_last())
+        .limit(max_posts)
+    ).all()
+    return _refresh(
+        Tweet, TweetEngagementDaily, "tweet_id",
+        ["likes", "retweets"], posts, "id",
+        fetch_tweet_engagement, SEARCH_PAGE_SIZE, "twitter", now,
+    )
+
+
+def prune_daily_engagement(now: datetime) -> None:
+    '''
+    Delete daily values from before the trend window, keeping the newest
+    one of each post as the baseline its later gains are measured from.
+    '''
+    cutoff = (now - TREND_WINDOW).date()
+    try:
+        for model, key in (
+                (RedditEngagementDaily, "reddit_post_id"),
+                (TweetEngagementDaily, "tweet_id"),
+        ):
+            table = f"{model.__table__.schema}.{model.__tablename__}"
+            db.session.execute(text(f"""
+                DELETE FROM {table} s
+                USING (
+                    SELECT {key}, max(day) AS keep FROM {table}
+                    WHERE day < :cutoff GROUP BY {key}
+                ) k
+                WHERE s.{key} = k.{key} AND s.day < k.keep
+            """), {"cutoff": cutoff})
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error pruning daily engagement: {e}")
+        return
+    db.session.commit()
+
+
+def daily_engagement_gains(source: str, post_ids: List, since: datetime) -> pd.DataFrame:
+    '''
+    Engagement each post gained per day since the given time, from its
+    daily values: columns id, date and gain. Posts without daily values are
+    left out. A post's first day counts all of its engagement as gained.
+    '''
+    if source == "twitter":
+        model, key, metric = TweetEngagementDaily, "tweet_id", "likes"
+    else:
+        model, key, metric = RedditEngagementDaily, "reddit_post_id", "score"
+    columns = ["id", "date", "gain"]
+    if len(post_ids) == 0:
+        return pd.DataFrame(columns=columns)
+    table = f"{model.__table__.schema}.{model.__tablename__}"
+    rows = db.session.execute(text(f"""
+        SELECT id, day, gain
+        FROM (
+            SELECT {key} AS id, day,
+                {metric} - coalesce(lag({metric}) OVER (
+                    PARTITION BY {key} ORDER BY day
+                ), 0) AS gain
+            FROM {table}
+            WHERE {key} = ANY(:ids)
+        ) s
+        WHERE day >= :since
+    """), {"ids": list(post_ids), "since": since.date()}).all()
+    gains = pd.DataFrame(rows, columns=columns)
+    gains["date"] = pd.to_datetime(gains["date"])
+    return gains
+
+
+def load_topic_trends(niche_id, source: str) -> Dict[int, TrendState]:
+    '''Trend states of the topics of a niche's saved model, by topic id.'''
+    rows = db.session.scalars(
+        select(TopicTrend).where(and_(
+            TopicTrend.niche_id == niche_id, TopicTrend.source == source
+        ))
+    ).all()
+    return {
+        r.topic_id: TrendState.from_dict({
+            c: getattr(r, c) for c in TrendState.__dataclass_fields__
+        })
+        for r in rows
+    }
+
+
+def save_topic_trends(
+        niche_id,
+        source: str,
+        trends: Dict[int, TrendState],
+        sizes: Dict[int, int],
+) -> None:
+    '''Replace the saved trend states and topic sizes of a niche's model.'''
+    try:
+        db.session.execute(delete(TopicTrend).where(and_(
+            TopicTrend.niche_id == niche_id, TopicTrend.source == source
+        )))
+        if trends:
+            # a streamed batch may have recreated a row since the delete
+            stmt = insert(TopicTrend.__table__)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["niche_id", "source", "topic_id"],
+                set_={
+                    c: stmt.excluded[c]
+                    for c in ["size", *TrendState.__dataclass_fields__]
+                },
+            )
+            db.session.execute(stmt, [
+                {
+                    "niche_id": niche_id, "source": source, "topic_id": topic_id,
+                    "size": sizes.get(topic_id, 0), **t.to_dict(),
+                }
+                for topic_id, t in trends.items()
+            ])
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error saving topic trends: niche={niche_id} source={source}: {e}")
+        return
+    db.session.commit()
+
+
+def add_streamed_posts(
+        niche_id,
+        source: str,
+        topics: List[int],
+        values: List[float],
+        now: datetime,
+) -> Dict[int, int]:
+    '''
+    Add posts assigned to topics between runs to the topics' sizes and to
+    the provisional engagement of today. values[i] is the engagement of
+    the post assigned to topics[i], outliers (-1) are left out.
+    Returns the updated trend rank of each topic the posts were added to.
+    '''
+    added = {}
+    for topic_id, value in zip(topics, values):
+        if topic_id == -1:
+            continue
+        count, total = added.get(topic_id, (0, 0.0))
+        added[topic_id] = (count + 1, total + (value or 0))
+    if len(added) == 0:
+        return {}
+
+    # batches of the same niche are assigned concurrently: create the
+    # missing rows without failing on one created meanwhile, then lock
+    # the rows, in topic order so batches can't deadlock, before adding
+    ranks = {}
+    try:
+        stmt = insert(TopicTrend.__table__).on_conflict_do_nothing()
+        db.session.execute(stmt, [
+            {
+                "niche_id": niche_id, "source": source, "topic_id": topic_id,
+                "size": 0, **TrendState().to_dict(),
+            }
+            for topic_id in added
+        ])
+        rows = db.session.scalars(
+            select(TopicTrend).where(and_(
+                TopicTrend.niche_id == niche_id,
+                TopicTrend.source == source,
+                TopicTrend.topic_id.in_(list(added)),
+            ))
+            .order_by(TopicTrend.topic_id)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        ).all()
+        for row in rows:
+            count, total = added[row.topic_id]
+            state = TrendState.from_dict({
+                c: getattr(row, c) for c in TrendState.__dataclass_fields__
+            })
+            state.add_open(now.date(), total)
+            for c, v in state.to_dict().items():
+                setattr(row, c, v)
+            row.size += count
+            ranks[row.topic_id] = rank_from_slope(state.current_slope())
+        db.session.flush()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error updating streamed topic trends: niche={niche_id} source={source}: {e}")
+        return {}
+    db.session.commit()
+    return ranks
+
+
+def update_modeled_topic_ranks(niche_id, source: str, ranks: Dict[int, int]) -> int:
+    '''
+    Write updated trend ranks to the niche's modeled topics from the last
+    run of its saved model, which keep their rank in size.
+    Returns the number of modeled topics updated.
+    '''
+    if len(ranks) == 0:
+        return 0
+    source_filter = (
+        ModeledTopic.trend_class == "twitter" if source == "twitter"
+        else ModeledTopic.trend_class.is_(None)
+    )
+    scope = and_(
+        ModeledTopic.niche_id == niche_id,
+        ModeledTopic.model_topic_id.isnot(None),
+        source_filter,
+    )
+    latest = db.session.scalar(select(func.max(ModeledTopic.date)).where(scope))
+    if latest is None:
+        return 0
+    topics = db.session.scalars(select(ModeledTopic).where(and_(
+        scope,
+        ModeledTopic.date == latest,
+        ModeledTopic.model_topic_id.in_(list(ranks)),
+    ))).all()
+    for t in topics:
+        t.size = ranks[t.model_topic_id]
+    try:
+        db.session.flush()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error updating modeled topic ranks: niche={niche_id}: {e}")
+        return 0
+    db.session.commit()
+    return len(topics)
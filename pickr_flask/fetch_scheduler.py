@@ -0,0 +1,103 @@
+'''
+Concurrent fetching from the reddit, twitter and news APIs.
+
+Fetches spend their time waiting on the network, so the subreddits and terms
+of a niche are fetched on a thread pool. Each API call takes a token from
+the provider's shared rate limit (see rate_limit.py), so the pool can't go
+over quota. Results come back to the calling thread, which does all the
+database writes.
+'''
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, Optional
+from urllib.parse import urlsplit
+
+import requests
+from flask import current_app as app, has_app_context
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class FetchJob:
+    provider: str  # "reddit", "twitter" or "newsapi"
+    key: Any  # what's being fetched, e.g. a Subreddit or a term
+    fetch: Callable[[], Any]
+
+
+@dataclass
+class FetchResult:
+    job: FetchJob
+    result: Any = None
+    error: Optional[Exception] = None
+
+
+class FetchScheduler:
+    '''
+    Run fetch jobs on a thread pool and yield their results as they finish.
+    Jobs run inside the caller's app context, but shouldn't use the
+    database session, which belongs to the calling thread.
+    '''
+
+    def __init__(self, max_workers: Optional[int] = None):
+        if max_workers is None:
+            max_workers = app.config.get("FETCH_MAX_WORKERS", 8)
+        self.max_workers = max(1, max_workers)
+
+    def run(self, jobs: Iterable[FetchJob]) -> Iterator[FetchResult]:
+        jobs = list(jobs)
+        if len(jobs) == 0:
+            return
+        flask_app = app._get_current_object() if has_app_context() else None
+
+        def call(job: FetchJob) -> FetchResult:
+            try:
+                if flask_app is None:
+                    return FetchResult(job, job.fetch())
+                with flask_app.app_context():
+                    return FetchResult(job, job.fetch())
+            except Exception as e:
+                log.error(f"Error fetching {job.provider} {job.key}: {e}")
+                return FetchResult(job, error=e)
+
+        workers = min(self.max_workers, len(jobs))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch") as pool:
+            futures = [pool.submit(call, job) for job in jobs]
+            for future in as_completed(futures):
+                yield future.result()
+
+
+class BaseURLAdapter(HTTPAdapter):
+    '''
+    Send every request to base_url instead, with the original host as the
+    first path segment: https://oauth.reddit.com/r/x/new is sent to
+    {base_url}/oauth.reddit.com/r/x/new.
+    '''
+
+    def __init__(self, base_url: str, **kwargs):
+        self.base_url = base_url.rstrip("/")
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        path = url.path + ("?" + url.query if url.query else "")
+        request.url = f"{self.base_url}/{url.netloc}{path}"
+        return super().send(request, **kwargs)
+
+
+def api_session() -> Optional[requests.Session]:
+    '''
+    HTTP session for the API clients. When FETCH_API_BASE_URL is set,
+    e.g. to a local fake server, all their requests are sent there.
+    Returns None to let the clients make their own session.
+    '''
+    base_url = app.config.get("FETCH_API_BASE_URL") if has_app_context() else None
+    if not base_url:
+        return None
+    session = requests.Session()
+    adapter = BaseURLAdapter(base_url)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
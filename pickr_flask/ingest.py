@@ -0,0 +1,145 @@
+'''
+Bulk writes of fetched posts.
+
+A fetch is written with batched INSERT ... ON CONFLICT statements on the
+natural key of the table, in one transaction, instead of a SELECT, an INSERT
+and a COMMIT per post.
+'''
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Set
+
+from sqlalchemy import (cast, column, exc, literal_column, select, tuple_,
+                        update, values)
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import db
+
+log = logging.getLogger(__name__)
+
+# rows per INSERT statement
+BATCH_SIZE = 500
+
+
+@dataclass
+class UpsertResult:
+    inserted: int = 0
+    updated: int = 0
+    # natural key -> primary key, for every row that was written or existed
+    ids: Dict = field(default_factory=dict)
+    # natural keys of the rows that were inserted
+    new_keys: Set = field(default_factory=set)
+
+    @property
+    def written(self) -> int:
+        return self.inserted + self.updated
+
+
+def _key(row: dict, key_columns: Sequence[str]):
+    if len(key_columns) == 1:
+        return row[key_columns[0]]
+    return tuple(row[c] for c in key_columns)
+
+
+def bulk_upsert(
+        model,
+        rows: List[dict],
+        key_columns: Sequence[str],
+        update_columns: Optional[Sequence[str]] = None,
+        batch_size: int = BATCH_SIZE,
+) -> UpsertResult:
+    '''
+    Insert rows into model's table, keyed on the unique key_columns.
+    Rows whose key exists already get update_columns overwritten,
+    or are left alone if update_columns is empty.
+    Everything is written in one transaction. On a database error it's
+    rolled back and the error is raised.
+    '''
+    result = UpsertResult()
+    # a statement can't touch the same row twice, the last row for a key wins
+    deduped = list({_key(r, key_columns): r for r in rows}.values())
+    if len(deduped) == 0:
+        return result
+
+    table = model.__table__
+    pk = table.primary_key.columns.values()[0]
+    key_cols = [table.c[c] for c in key_columns]
+    id_cols = [pk] + [c for c in key_cols if c.name != pk.name]
+    try:
+        for i in range(0, len(deduped), batch_size):
+            batch = deduped[i:i + batch_size]
+            stmt = insert(table).values(batch)
+            if update_columns:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=list(key_columns),
+                    set_={c: stmt.excluded[c] for c in update_columns},
+                )
+            else:
+                stmt = stmt.on_conflict_do_nothing(index_elements=list(key_columns))
+            # xmax is 0 for a row version created by an insert
+            stmt = stmt.returning(
+                *id_cols, literal_column("xmax = 0").label("inserted")
+            )
+            for row in db.session.execute(stmt):
+                key = _key(row._mapping, key_columns)
+                result.ids[key] = row._mapping[pk.name]
+                if row.inserted:
+                    result.inserted += 1
+                    result.new_keys.add(key)
+                else:
+                    result.updated += 1
+
+        # rows skipped by DO NOTHING aren't returned, look their ids up
+        missing = [
+            _key(r, key_columns) for r in deduped
+            if _key(r, key_columns) not in result.ids
+        ]
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            if len(key_columns) == 1:
+                cond = key_cols[0].in_(batch)
+            else:
+                cond = tuple_(*key_cols).in_(batch)
+            for row in db.session.execute(select(*id_cols).where(cond)):
+                result.ids[_key(row._mapping, key_columns)] = row._mapping[pk.name]
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error writing {table.name} rows: {e}")
+        raise
+    db.session.commit()
+    log.info(
+        f"Upserted {table.name}: inserted={result.inserted} "
+        f"updated={result.updated} unchanged={len(deduped) - result.written}"
+    )
+    return result
+
+
+def bulk_update(
+        model,
+        rows: List[dict],
+        key_column: str,
+        update_columns: Sequence[str],
+        batch_size: int = BATCH_SIZE,
+) -> int:
+    '''
+    Overwrite update_columns of the existing rows matched on key_column,
+    with one UPDATE ... FROM (VALUES ...) statement per batch.
+    Doesn't commit, so the caller can write related rows in the same
+    transaction. Returns the number of rows updated.
+    '''
+    table = model.__table__
+    names = [key_column] + list(update_columns)
+    updated = 0
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        data = values(
+            *[column(c, table.c[c].type) for c in names], name="data"
+        ).data([tuple(r[c] for c in names) for r in batch])
+        # VALUES parameters arrive untyped, cast them to the column types
+        stmt = (
+            update(table)
+            .where(table.c[key_column] == cast(data.c[key_column], table.c[key_column].type))
+            .values({c: cast(data.c[c], table.c[c].type) for c in update_columns})
+        )
+        updated += db.session.execute(stmt).rowcount
+    return updated
@@ -1,24 +1,25 @@
 import logging
+import multiprocessing
 import random
-from datetime import datetime, timedelta, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from typing import List
 import itertools
-import time as time_m
 
-import tweepy
 import math
 from tqdm import tqdm
 from flask import current_app as app
 from sqlalchemy import and_
 from topic_model import topic
-from .models import (GeneratedPost, ModeledTopic, Niche, PickrUser, PostEdit, RedditPost,
-                     ScheduledPost, _to_dict, db, user_niche_assoc)
+from .models import (ModeledTopic, Niche, PickrUser, PostEdit, RedditPost,
+                     _to_dict, db, user_niche_assoc)
 from .post_schedule import (write_schedule, write_schedule_posts,
                             get_simple_schedule_text)
-from .queries import latest_post_edit, oauth_session_by_user
-from .tasks import (create_schedule, update_niche_twitter, update_niche_subreddits, run_niche_trends, build_topic_dicts, 
-                    run_niche_topic_model, generate_niche_topic_overviews, run_marketing_functions, generate_modeled_topic_tweets,
-                    MAX_DAILY_TWITTER_POSTS, TWITTER_NICHES
+from .pipeline_runs import (PIPELINE_STAGES, end_stage, init_pipeline_process,
+                            run_summary, start_run)
+from .tasks import (create_schedule, update_niche_posts, run_niche_trends, build_topic_dicts, 
+                    run_niche_topic_model, generate_niche_topic_overviews, generate_modeled_topic_tweets,
+                    twitter_niche_budgets, refresh_niche_engagement, prune_pipeline_data
 )
 from .reddit import (fetch_subreddit_posts, process_post,
                      write_generated_posts,
@@ -31,37 +32,6 @@ TOPIC_MODEL_MIN_DOCS = 20
 log = logging.getLogger(__name__)
 
 
-def is_time_between(begin_time, end_time, check_time=None):
-    # If check time is not given, default to current UTC time
-    check_time = check_time or datetime.utcnow().time()
-    if begin_time < end_time:
-        return check_time >= begin_time and check_time <= end_time
-    else: # crosses midnight
-        return check_time >= begin_time or check_time <= end_time
-
-
-def send_marketing_dms():
-    """
-    Scheduled daily task to send marketing dms.
-    """
-    while True:
-        # datetime object containing current date and time
-        now = datetime.now()
-        if is_time_between(time(15, 00), time(15, 1), check_time=now.time()):
-            run_marketing_functions()
-
-def all_niches_update_schedule():
-    """
-    Scheduled daily task to fetch recent posts for all niches
-    with subreddits or twitter terms and save to database.
-    """
-    while True:
-        # datetime object containing current date and time
-        now = datetime.now()
-        if is_time_between(time(0, 59), time(1, 00), check_time=now.time()):
-            all_niches_update()
-            
-
 def all_niches_update():
     """
     Scheduled daily task to fetch recent posts for all niches
@@ -73,56 +43,83 @@ def all_niches_update():
             .all()
     )
 
-    num_twitter_posts_per_niche = MAX_DAILY_TWITTER_POSTS / len(TWITTER_NICHES)
+    twitter_budgets = twitter_niche_budgets(niches)
 
     for niche in tqdm(niches):
-
-        if niche.title in ["Entrepreneurship", "Marketing", "Personal Development"]:
-            log.info(f"Updating twitter posts for niche: {niche.title}")
-            update_niche_twitter(niche.id, num_twitter_posts_per_niche)
-
-        log.info(f"Updating subreddits for niche: {niche.title}")
-        update_niche_subreddits(niche.id)
-
-
-def all_niches_run_pipeline_schedule():
-    """
-    Scheduled daily task to run topic pipeline for each niche
-    """
-    now = datetime.now()
-    if is_time_between(time(1,59), time(2, 00), check_time=now.time()):
-        all_niches_run_pipeline()        
+        log.info(f"Updating posts for niche: {niche.title}")
+        update_niche_posts(niche.id, twitter_budgets[niche.id], stream_in_process=True)
 
 
 def all_niches_run_pipeline(date_from=None, date_to=None):
     """
-    Scheduled daily task to run topic pipeline for each niche
+    Scheduled daily task to run topic pipeline for each niche.
+    The niches run in a pool of processes, a failing niche is recorded in
+    the run summary and doesn't stop the others.
     """
+    prune_pipeline_data(datetime.utcnow())
+
     niches = (
         Niche.query.filter(and_(Niche.is_active, Niche.subreddits.any()))
             .order_by(Niche.title)
             .all()
     )
-
-    for niche in tqdm(niches):
-        log.info(f"Running topic model for niche: {niche.title}")
-        run_topic_pipeline(niche.id, date_from, date_to)
-
-
-def run_topic_pipeline(niche_id, date_from=None, date_to=None):
+    run_id = start_run([niche.id for niche in niches])
+    log.info(f"Starting topic pipeline run {run_id}: niches={len(niches)}")
+
+    # spawned rather than forked, the parent's DB connections and model
+    # threads don't survive a fork
+    with ProcessPoolExecutor(
+        max_workers=app.config["PIPELINE_NICHE_WORKERS"],
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_pipeline_process,
+    ) as pool:
+        futures = {
+            pool.submit(run_topic_pipeline, niche.id, date_from, date_to, run_id): niche
+            for niche in niches
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            niche = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                # the process died, its stages didn't get to record it
+                log.error(f"Topic pipeline process failed for niche {niche.title}: {e!r}")
+                for stage in PIPELINE_STAGES:
+                    end_stage(run_id, niche.id, stage, error=f"process: {e!r}")
+    db.session.expire_all()
+    return run_summary(run_id)
+
+
+def run_topic_pipeline(niche_id, date_from=None, date_to=None, run_id=None):
     """
-    Topic pipeline is done by chaining celery tasks, so different workers
-    can process different steps of the pipeline.
+    Run the news and topic model stages of a niche one after the other.
+    A failing stage is recorded in the run and doesn't stop the other.
     """
 
-    # get trending topics from news api
-    modeled_topic_ids = run_niche_trends(niche_id)
-    generate_modeled_topic_tweets(modeled_topic_ids)
+    def run_stage(stage, steps):
+        try:
+            steps()
+        except Exception as e:
+            log.exception(f"Topic pipeline {stage} failed for niche {niche_id}")
+            db.session.rollback()
+            end_stage(run_id, niche_id, stage, error=repr(e))
+        else:
+            end_stage(run_id, niche_id, stage)
+
+    def news():
+        # get trending topics from news api
+        modeled_topic_ids = run_niche_trends(niche_id)
+        generate_modeled_topic_tweets(modeled_topic_ids)
 
-    # get evergreen topics from reddit
-    topic_dicts = run_niche_topic_model(niche_id, date_from, date_to)
-    modeled_topic_ids = generate_niche_topic_overviews(topic_dicts, niche_id, topic_date=date_to)
-    generate_modeled_topic_tweets(modeled_topic_ids)
+    def topics():
+        # get evergreen topics from reddit
+        refresh_niche_engagement(niche_id)
+        topic_dicts = run_niche_topic_model(niche_id, date_from, date_to, as_artifact=False)
+        modeled_topic_ids = generate_niche_topic_overviews(topic_dicts, niche_id, topic_date=date_to)
+        generate_modeled_topic_tweets(modeled_topic_ids)
+
+    run_stage("news", news)
+    run_stage("topics", topics)
 
 
 def all_niches_run_news_pipeline():
@@ -139,17 +136,6 @@ def all_niches_run_news_pipeline():
         run_niche_trends(niche.id)
 
 
-def all_users_run_schedule_schdule():
-    '''
-    Scheduled weeky task to create post schedule for every user
-    '''
-    while True:
-        # datetime object containing current date and time
-        now = datetime.now()
-        if now.isoweekday() == 1 and is_time_between(time(4, 59), time(5, 00), check_time=now.time()):
-            all_users_run_schedule()
-
-
 def all_users_run_schedule():
     '''
     Scheduled weeky task to create post schedule for every user
@@ -160,83 +146,3 @@ def all_users_run_schedule():
             f"Creating schedule for user: {user.username}"
         )
         create_schedule(user.id)
-
-
-def post_scheduled_tweets():
-    '''
-    Retrieve any scheduled tweets that need to be posted from the DB
-    and post them to twitter.
-    '''
-    while True:
-        time_m.sleep(300)
-        scheduled_posts = (
-            ScheduledPost.query.filter(
-                and_(
-                    ScheduledPost.posted_at.is_(None),
-                    ScheduledPost.scheduled_for < datetime.now()
-                )
-            )
-            .order_by(
-                ScheduledPost.user_id, ScheduledPost.scheduled_for
-            )
-            .all()
-        )
-        if not scheduled_posts:
-            log.info("no tweets to schedule")
-            continue
-
-        log.info(f"found {len(scheduled_posts)} tweets to schedule")
-        # post the tweets grouped by user
-        uid_to_posts = {}
-        for p in scheduled_posts:
-            uid = p.user_id
-            if uid not in uid_to_posts.keys():
-                uid_to_posts[uid] = []
-            uid_to_posts[uid].append(p)
-
-        for user_id, posts in uid_to_posts.items():
-            oauth_sess = oauth_session_by_user(user_id)
-            if oauth_sess is None or oauth_sess.access_token is None \
-            or oauth_sess.access_token_secret is None:
-                log.error(
-                    f"no twitter credentials found for user: user_id={user_id}"
-                )
-                continue
-
-            client = tweepy.Client(
-                consumer_key=app.config["TWITTER_API_KEY"],
-                consumer_secret=app.config["TWITTER_API_KEY_SECRET"],
-                access_token=oauth_sess.access_token,
-                access_token_secret=oauth_sess.access_token_secret,
-                wait_on_rate_limit=True,
-            )
-
-            num_posted = 0
-            for p in posts:
-                post_edit = latest_post_edit(p.generated_post_id, user_id)
-                if post_edit is None:
-                    gp = GeneratedPost.query.get(p.generated_post_id)
-                    post_text = gp.text
-                else:
-                    post_text = post_edit.text
-
-                try:
-                    resp = client.create_tweet(text=post_text)
-                except (tweepy.errors.BadRequest, tweepy.errors.Unauthorized) as e:
-                    logging.error(
-                        f"error posting tweet for user_id={user_id}: {e}"
-                    )
-                    break
-
-                p.tweet_id = resp.data["id"]
-                p.posted_at = datetime.now()
-                db.session.add(p)
-                db.session.commit()
-                num_posted += 1
-            # endfor
-
-            log.info(
-                f"posted {num_posted} tweets for user_id={user_id}"
-            )
-        
-        # endfor
@@ -2,8 +2,9 @@ import enum
 from uuid import uuid4
 
 from flask_login import UserMixin
-from sqlalchemy import (BigInteger, Boolean, Column, DateTime, ForeignKey,
-                        Integer, String)
+from sqlalchemy import (BigInteger, Boolean, Column, Date, DateTime, Float,
+                        ForeignKey, Index, Integer, LargeBinary, String, Text,
+                        text)
 from sqlalchemy.dialects.postgresql import ENUM, UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -222,6 +223,8 @@ class ModeledTopic(db.Model):
     reddit_posts = relationship("RedditPost", secondary=reddit_modeled_topic_assoc)
     news_posts = relationship("NewsArticle", secondary=news_modeled_topic_assoc)
     trend_class = Column(String(32), nullable=True)
+    # id of the topic in the niche's saved topic model, see TopicTrend
+    model_topic_id = Column(Integer, nullable=True)
     # tweets that the model clustered into this topic.
     # tweets = relationship("Tweet", secondary=tweet_modeled_topic_assoc)
 
@@ -287,7 +290,14 @@ class Schedule(db.Model):
 class ScheduledPost(db.Model):
     """ScheduledPost represents a scheduled twitter post."""
     __tablename__ = "scheduled_post"
-    __table_args__ = {"schema": DEFAULT_SCHEMA}
+    __table_args__ = (
+        # the posts still to tweet, read by the tweet dispatcher
+        Index(
+            "ix_pickr_scheduled_post_due", "scheduled_for",
+            postgresql_where=text("posted_at IS NULL AND scheduled_for IS NOT NULL"),
+        ),
+        {"schema": DEFAULT_SCHEMA},
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(
         UUID(as_uuid=True),
@@ -336,6 +346,13 @@ class Subreddit(db.Model):
         UUID(as_uuid=True), ForeignKey(f"{DEFAULT_SCHEMA}.niche.id"), nullable=True
     )
     title = Column(String(255), nullable=True)
+    # ingest watermark: the newest post fetched so far, later fetches
+    # stop paging when they reach it
+    last_post_created_at = Column(DateTime, nullable=True)
+    last_reddit_id = Column(String(64), nullable=True)
+    last_fetched_at = Column(DateTime, nullable=True)
+    # smoothed rate of new posts, used to size the next fetch
+    posts_per_day = Column(Float, nullable=True)
 
     def __repr__(self):
         return f"<Subreddit title={self.title}>"
@@ -370,6 +387,15 @@ class TwitterTerm(db.Model):
         UUID(as_uuid=True), ForeignKey(f"{DEFAULT_SCHEMA}.niche.id"), nullable=True
     )
     term = Column(String(255), nullable=True)
+    # newest tweet fetched for the term, searches only return newer tweets
+    since_id = Column(BigInteger, nullable=True)
+    last_fetched_at = Column(DateTime, nullable=True)
+    # smoothed share of fetched tweets that were new, engaging and unique,
+    # the daily tweet budget is split across terms by it
+    yield_rate = Column(Float, nullable=True)
+    # tweets read this month, they count against the monthly API cap
+    budget_month = Column(Date, nullable=True)
+    posts_read_month = Column(Integer, nullable=False, default=0, server_default="0")
 
     def __repr__(self):
         return f"<TwitterTerm term={self.term}>"
@@ -404,6 +430,8 @@ class RedditPost(db.Model):
         nullable=True,
         default=None,
     )
+    # when score and num_comments were last fetched
+    updated_at = Column(DateTime, nullable=True)
 
     def __repr__(self):
         return f"<RedditPost id={self.id} url={self.url}>"
@@ -419,7 +447,7 @@ class NewsArticle(db.Model):
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
     title = Column(String)
-    url = Column(String)
+    url = Column(String, unique=True)
     published_date = Column(
         DateTime,
         nullable=True
@@ -477,3 +505,185 @@ class Tweet(db.Model):
 
     def __repr__(self):
         return f"<Tweet id={self.id}>"
+
+
+class TextEmbedding(db.Model):
+    """
+    TextEmbedding caches the sentence embedding of a text for an encoder.
+    Rows are keyed by encoder name and sha256 of the text, so they are
+    shared by every post with the same clean_text.
+    """
+
+    __tablename__: str = "text_embedding"
+    __table_args__: str = {"schema": DEFAULT_SCHEMA}
+
+    model_name = Column(String(128), primary_key=True)
+    text_hash = Column(String(64), primary_key=True)
+    # float32 vector as raw bytes
+    embedding = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, nullable=True, server_default=func.now())
+
+    def __repr__(self):
+        return f"<TextEmbedding model={self.model_name} hash={self.text_hash}>"
+
+
+class RedditEngagementDaily(db.Model):
+    """
+    Score and comment count of a reddit post at the end of each day they
+    were refreshed on. Rows are only written when the values change, the
+    first refresh also writes the values the post was ingested with.
+    """
+
+    __tablename__: str = "reddit_engagement_daily"
+    __table_args__: str = {"schema": DEFAULT_SCHEMA}
+
+    reddit_post_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey(f"{DEFAULT_SCHEMA}.reddit.id"),
+        primary_key=True,
+    )
+    day = Column(Date, primary_key=True)
+    score = Column(Integer)
+    num_comments = Column(Integer)
+
+    def __repr__(self):
+        return f"<RedditEngagementDaily post={self.reddit_post_id} day={self.day}>"
+
+
+class TweetEngagementDaily(db.Model):
+    """
+    Likes and retweets of a tweet at the end of each day they were
+    refreshed on, written like RedditEngagementDaily.
+    """
+
+    __tablename__: str = "tweet_engagement_daily"
+    __table_args__: str = {"schema": DEFAULT_SCHEMA}
+
+    tweet_id = Column(
+        BigInteger,
+        ForeignKey(f"{DEFAULT_SCHEMA}.tweet.id"),
+        primary_key=True,
+    )
+    day = Column(Date, primary_key=True)
+    likes = Column(Integer)
+    retweets = Column(Integer)
+
+    def __repr__(self):
+        return f"<TweetEngagementDaily tweet={self.tweet_id} day={self.day}>"
+
+
+class TopicTrend(db.Model):
+    """
+    Running trend regression of a topic of a niche's saved topic model,
+    see topic_model/trend.py. Reset when the model is refit, since its
+    topic ids change.
+    """
+
+    __tablename__: str = "topic_trend"
+    __table_args__: str = {"schema": DEFAULT_SCHEMA}
+
+    niche_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey(f"{DEFAULT_SCHEMA}.niche.id"),
+        primary_key=True,
+    )
+    source = Column(String(16), primary_key=True)
+    topic_id = Column(Integer, primary_key=True)
+    last_day = Column(Date)
+    points = Column(Integer, nullable=False, default=0)
+    n = Column(Float, nullable=False, default=0)
+    sx = Column(Float, nullable=False, default=0)
+    sy = Column(Float, nullable=False, default=0)
+    sxy = Column(Float, nullable=False, default=0)
+    sxx = Column(Float, nullable=False, default=0)
+    half_life_days = Column(Float, nullable=False)
+    # engagement of posts assigned so far today, not in the sums yet
+    open_day = Column(Date)
+    open_value = Column(Float, nullable=False, default=0)
+    # posts in the topic at the last run, plus the posts assigned since
+    size = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<TopicTrend niche={self.niche_id} {self.source} topic={self.topic_id}>"
+
+
+class PipelineArtifact(db.Model):
+    """
+    Output of a topic pipeline stage, stored so chained celery tasks only
+    pass its id through the broker. The payload is zlib compressed JSON.
+    """
+
+    __tablename__: str = "pipeline_artifact"
+    __table_args__: str = {"schema": DEFAULT_SCHEMA}
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    kind = Column(String(64), nullable=False)
+    niche_id = Column(UUID(as_uuid=True), ForeignKey(f"{DEFAULT_SCHEMA}.niche.id"), nullable=True)
+    created_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
+    # size of the JSON before compression
+    size = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f"<PipelineArtifact id={self.id} kind={self.kind}>"
+
+
+class PipelineRun(db.Model):
+    """
+    A run of the topic pipeline over all niches. Each niche's stages run
+    on their own and record how they ended in PipelineRunStage.
+    """
+
+    __tablename__: str = "pipeline_run"
+    __table_args__: str = {"schema": DEFAULT_SCHEMA}
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    started_at = Column(DateTime, nullable=False, server_default=func.now())
+    # set by the last stage to end
+    finished_at = Column(DateTime, nullable=True)
+    stages = relationship("PipelineRunStage", lazy=True)
+
+    def __repr__(self):
+        return f"<PipelineRun id={self.id} started_at={self.started_at}>"
+
+
+class PipelineRunStage(db.Model):
+    """
+    One stage of a niche in a pipeline run, e.g. its news or topic model chain.
+    status is pending, ok or failed.
+    """
+
+    __tablename__: str = "pipeline_run_stage"
+    __table_args__: str = {"schema": DEFAULT_SCHEMA}
+
+    run_id = Column(UUID(as_uuid=True), ForeignKey(f"{DEFAULT_SCHEMA}.pipeline_run.id"), primary_key=True)
+    niche_id = Column(UUID(as_uuid=True), ForeignKey(f"{DEFAULT_SCHEMA}.niche.id"), primary_key=True)
+    stage = Column(String(32), primary_key=True)
+    status = Column(String(16), nullable=False, default="pending")
+    error = Column(Text, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<PipelineRunStage run={self.run_id} niche={self.niche_id} {self.stage}={self.status}>"
+
+
+class ScheduledJob(db.Model):
+    """
+    Last and next run of a job of the scheduler daemon, see scheduler.py.
+    Times are UTC.
+    """
+
+    __tablename__: str = "scheduled_job"
+    __table_args__: str = {"schema": DEFAULT_SCHEMA}
+
+    name = Column(String(64), primary_key=True)
+    spec = Column(String(64), nullable=True)
+    last_run_at = Column(DateTime, nullable=True)
+    last_finished_at = Column(DateTime, nullable=True)
+    # running, ok or failed
+    last_status = Column(String(16), nullable=True)
+    last_error = Column(Text, nullable=True)
+    next_run_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<ScheduledJob {self.name} next_run_at={self.next_run_at}>"
@@ -2,28 +2,39 @@ import logging
 import uuid
 import re
 from datetime import date, timedelta
+from functools import lru_cache
 from os import environ
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
-import nltk
 from flask import current_app as app
 from newsapi import NewsApiClient
-from sqlalchemy import exc, insert
 
-from .models import db, NewsArticle, ModeledTopic, news_modeled_topic_assoc
-from topic_model.topic import get_label_and_description_no_keywords, is_topic_relevant_gpt
-from topic_model.util import remove_stop_words
+from .batch_writer import BatchWriter
+from .fetch_scheduler import api_session
+from .ingest import UpsertResult, bulk_upsert
+from .models import NewsArticle, ModeledTopic, news_modeled_topic_assoc
+from .rate_limit import RateLimitTimeout, rate_limiter
+from topic_model.topic import (LLM_EXECUTOR, get_label_and_description_no_keywords,
+                               is_topic_relevant_gpt)
+from topic_model.prompt_budget import PROMPT_BUDGETS, pack_texts
+from topic_model.util import preprocess
 
-newsapi = NewsApiClient(api_key=app.config["NEWS_API_KEY"])
+log = logging.getLogger(__name__)
 
 
-def get_trends(term: str, niche: str, page_size=100, num_pages=1, min_words=4, min_matches=2, date_from: Optional[str]=None, date_to: Optional[str]=None):
+@lru_cache(maxsize=1)
+def get_newsapi() -> NewsApiClient:
+    '''News API client, created on first use.'''
+    return NewsApiClient(api_key=app.config["NEWS_API_KEY"], session=api_session())
+
+
+def fetch_news_articles(term: str, page_size=100, num_pages=1, date_from: Optional[str]=None, date_to: Optional[str]=None) -> Optional[List[dict]]:
     """
-    Get news articles and get topics from them
+    Fetch the articles matching a search term, by default from the two
+    weeks before yesterday. Returns None if a request fails, or if the
+    daily request quota is used up for longer than NEWS_API_RATE_LIMIT_TIMEOUT.
     """
-    # get articles
-    docs = []
-    docs_dict = []
+    articles = []
     if date_from is None or date_to is None:
         date_to = date.today() - timedelta(days=1)
         date_to = date_to.strftime("%Y-%m-%d")
@@ -31,7 +42,12 @@ def get_trends(term: str, niche: str, page_size=100, num_pages=1, min_words=4, m
         date_from = date_from.strftime("%Y-%m-%d")
     for i in range(num_pages):
         try:
-            all_articles = newsapi.get_everything(
+            rate_limiter("newsapi").acquire(timeout=app.config["NEWS_API_RATE_LIMIT_TIMEOUT"])
+        except RateLimitTimeout as e:
+            log.error(f"Skipping news articles for {term}: {e}")
+            return None
+        try:
+            all_articles = get_newsapi().get_everything(
                 q=term,
                 from_param=date_from,
                 to=date_to,
@@ -40,10 +56,25 @@ def get_trends(term: str, niche: str, page_size=100, num_pages=1, min_words=4, m
                 page_size=page_size,
                 page=i + 1,
             )
-            docs += [a["title"] for a in all_articles["articles"]]
-            docs_dict += [{"title": a["title"], "url": a["url"], "published_date": a["publishedAt"]}  for a in all_articles["articles"]]
         except Exception as e:
-            return None, None
+            log.error(f"Error fetching news articles for {term}: {e}")
+            return None
+        articles += [{"title": a["title"], "url": a["url"], "published_date": a["publishedAt"]} for a in all_articles["articles"]]
+    return articles
+
+
+def get_trends(term: str, niche: str, page_size=100, num_pages=1, min_words=4, min_matches=2, date_from: Optional[str]=None, date_to: Optional[str]=None, articles: Optional[List[dict]]=None):
+    """
+    Get news articles and get topics from them.
+    Articles that were fetched already can be passed in.
+    """
+    # get articles
+    if articles is None:
+        articles = fetch_news_articles(term, page_size, num_pages, date_from, date_to)
+    if articles is None:
+        return None, None
+    docs = [a["title"] for a in articles]
+    docs_dict = articles
 
     # remove duplicate articles
     docs = list(set(docs))
@@ -55,7 +86,7 @@ def get_trends(term: str, niche: str, page_size=100, num_pages=1, min_words=4, m
                 break
 
     # get articles without stop words
-    docs_non_sw = remove_stop_words(docs)
+    docs_non_sw = preprocess(docs)
 
     # get article topics that appear more than once
     added_posts = []
@@ -73,62 +104,57 @@ def get_trends(term: str, niche: str, page_size=100, num_pages=1, min_words=4, m
             for d__ in matches:
                 added_posts.append(d__['title'])
 
-    topic_labels = []
-    for t in topic_articles:
-        topic_documents = "\n\n".join(["Message:    " + d_['title'][:1000] for d_ in t[:4]])
-        label, description = get_label_and_description_no_keywords(topic_documents)
-        if not is_topic_relevant_gpt(niche, description):
-            continue
-        topic_labels.append((label, description))
+    # label the article clusters concurrently
+    labels = LLM_EXECUTOR.map(
+        lambda t: label_topic_articles(t, niche), topic_articles
+    )
+    # keep articles aligned with the labels of the relevant topics
+    relevant = [(label, t) for label, t in zip(labels, topic_articles) if label is not None]
+    topic_labels = [label for label, _ in relevant]
+    topic_articles = [t for _, t in relevant]
 
     # TODO add a check if it is a headline and if it is about at most 2 topics and if it is about the niche
     return topic_labels, topic_articles
 
 
-def write_news_articles(posts: List[dict]) -> int:
+def label_topic_articles(articles: List[dict], niche: str) -> Optional[Tuple[str, str]]:
+    """
+    Get (label, description) for a cluster of articles with GPT,
+    or None if the topic isn't relevant to the niche.
+    """
+    topic_documents = pack_texts(
+        [a['title'] for a in articles[:4]],
+        PROMPT_BUDGETS["news_overview"],
+        prefix="Message:    ",
+    )
+    label, description = get_label_and_description_no_keywords(topic_documents)
+    if not is_topic_relevant_gpt(niche, description):
+        return None
+    return label, description
+
+
+def write_news_articles(posts: List[dict]) -> UpsertResult:
     """
-    Save news articles
+    Save news articles, articles are unique by URL.
+    The ids of new and existing articles are in the result.
     """
-    num_written = 0
-    for post in posts:
-        record = (
-            db.session.query(NewsArticle).filter(NewsArticle.id == post["id"]).first()
-        )
-        if record is None:
-            record = NewsArticle(**post)
-            try:
-                db.session.add(record)
-            except exc.SQLAlchemyError as e:
-                db.session.rollback()
-                logging.error(f"Error writing news article: {e}")
-            else:
-                db.session.commit()
-                num_written += 1
-    return num_written
-
-
-def write_modeled_topic_with_news_article(topic: dict, post_ids: List[int]) -> None:
+    return bulk_upsert(NewsArticle, posts, ["url"])
+
+
+def write_modeled_topic_with_news_article(
+        topic: dict,
+        post_ids: List,
+        writer: Optional[BatchWriter] = None,
+) -> None:
     """
-    Save a modeled topic to the database and associated news article IDs with the topic.
+    Save a modeled topic and associate news articles with the topic.
+    With a writer the rows are only added to it, to be flushed by the caller.
     """
-    modeled_topic = ModeledTopic(**topic)
-    try:
-        db.session.add(modeled_topic)
-    except exc.SQLAlchemyError as e:
-        db.session.rollback()
-        logging.error(f"Database error occured: {e}")
-    else:
-        db.session.commit()
-    try:
-        db.session.execute(
-            insert(news_modeled_topic_assoc),
-            [
-                {"news_id": pid, "modeled_topic_id": modeled_topic.id}
-                for pid in post_ids
-            ],
-        )
-    except exc.SQLAlchemyError as e:
-        db.session.rollback()
-        logging.error(f"Database error occured: {e}")
-    else:
-        db.session.commit()
+    batch = writer if writer is not None else BatchWriter()
+    modeled_topic = batch.add(ModeledTopic, dict(topic))
+    batch.add_all(news_modeled_topic_assoc, [
+        {"news_id": pid, "modeled_topic_id": modeled_topic["id"]}
+        for pid in post_ids
+    ])
+    if writer is None:
+        batch.flush()
@@ -0,0 +1,142 @@
+'''
+Bookkeeping of topic pipeline runs over all niches.
+
+The stages of every niche run on their own, on whichever worker picks
+them up, so a failing niche doesn't hold up or fail the others. Each stage
+records how it ended, and the last one to end logs the run summary.
+'''
+import logging
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from sqlalchemy import exc, func, select, update
+
+from .models import Niche, PipelineRun, PipelineRunStage, db
+
+log = logging.getLogger(__name__)
+
+PIPELINE_STAGES = ("news", "topics")
+# enough of the error to tell what failed, the full traceback is in the logs
+MAX_ERROR_LENGTH = 2000
+
+
+def init_pipeline_process():
+    '''
+    Initializer of the processes running niches, see
+    looped_tasks.all_niches_run_pipeline. It lives here because modules
+    importing topic_model.topic need an app context to be imported.
+    Each process gets its own app, and with it its own DB engine.
+    '''
+    from . import init_app
+    init_app().app_context().push()
+
+
+def start_run(niche_ids: Iterable, stages: Iterable[str] = PIPELINE_STAGES):
+    '''Record a run with a pending stage for each niche and return its id.'''
+    run = PipelineRun(started_at=datetime.utcnow())
+    db.session.add(run)
+    db.session.flush()
+    db.session.add_all(
+        PipelineRunStage(run_id=run.id, niche_id=niche_id, stage=stage, status="pending")
+        for niche_id in niche_ids for stage in stages
+    )
+    try:
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error starting pipeline run: {e}")
+        raise
+    return run.id
+
+
+def end_stage(run_id, niche_id, stage: str, error: Optional[str] = None) -> Optional[dict]:
+    '''
+    Record that a stage of a niche ended, failed if there's an error.
+    Returns the run summary if this was the last stage of the run.
+    '''
+    if run_id is None:
+        return None
+    db.session.execute(
+        update(PipelineRunStage)
+        .where(
+            PipelineRunStage.run_id == run_id,
+            PipelineRunStage.niche_id == niche_id,
+            PipelineRunStage.stage == stage,
+            # a stage ends once
+            PipelineRunStage.status == "pending",
+        )
+        .values(
+            status="ok" if error is None else "failed",
+            error=None if error is None else error[:MAX_ERROR_LENGTH],
+            finished_at=datetime.utcnow(),
+        )
+    )
+    try:
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error ending pipeline stage {stage} of niche {niche_id}: {e}")
+        return None
+
+    pending = db.session.scalar(
+        select(func.count())
+        .select_from(PipelineRunStage)
+        .where(PipelineRunStage.run_id == run_id, PipelineRunStage.status == "pending")
+    )
+    if pending:
+        return None
+    # stages ending at the same time can both see none pending,
+    # only the one that sets finished_at logs the summary
+    claimed = db.session.execute(
+        update(PipelineRun)
+        .where(PipelineRun.id == run_id, PipelineRun.finished_at.is_(None))
+        .values(finished_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return None
+    summary = run_summary(run_id)
+    log_summary(summary)
+    return summary
+
+
+def run_summary(run_id) -> dict:
+    '''Counts of the niches whose stages all ended ok, failed or are pending.'''
+    run = db.session.get(PipelineRun, run_id)
+    rows = db.session.execute(
+        select(PipelineRunStage, Niche.title)
+        .join(Niche, Niche.id == PipelineRunStage.niche_id)
+        .where(PipelineRunStage.run_id == run_id)
+    ).all()
+    niches = {}
+    for stage, title in rows:
+        niches.setdefault(title, []).append(stage)
+    failed = {
+        title: {s.stage: s.error for s in stages if s.status == "failed"}
+        for title, stages in niches.items()
+        if any(s.status == "failed" for s in stages)
+    }
+    pending: List[str] = [
+        title for title, stages in niches.items()
+        if title not in failed and any(s.status == "pending" for s in stages)
+    ]
+    end = run.finished_at or datetime.utcnow()
+    return {
+        "run_id": str(run_id),
+        "niches": len(niches),
+        "ok": len(niches) - len(failed) - len(pending),
+        "failed": failed,
+        "pending": pending,
+        "seconds": round((end - run.started_at).total_seconds(), 1),
+    }
+
+
+def log_summary(summary: dict) -> None:
+    log.info(
+        f"Topic pipeline run {summary['run_id']} took {summary['seconds']}s: "
+        f"niches={summary['niches']} ok={summary['ok']} "
+        f"failed={len(summary['failed'])} pending={len(summary['pending'])}"
+    )
+    for title, errors in summary["failed"].items():
+        for stage, error in errors.items():
+            log.error(f"Topic pipeline {stage} failed for niche {title}: {error}")
@@ -1,9 +1,9 @@
 import logging
-from typing import List
-
-from sqlalchemy import exc, insert, and_
+from typing import List, Optional
 
+from sqlalchemy import exc
 
+from .batch_writer import BatchWriter
 from .models import ModeledTopic, Schedule, ScheduledPost, schedule_topic_assoc, db
 
 log = logging.getLogger(__name__)
@@ -52,8 +52,11 @@ def create_schedule_text_only_trends(topics: List[ModeledTopic]):
     return None
 
 
-def write_schedule(schedule: dict):
+def write_schedule(schedule: dict, writer: Optional[BatchWriter] = None):
     record = Schedule(**schedule)
+    if writer is not None:
+        # the id is needed by the schedule's posts, it's committed with them
+        return writer.add_object(record)
     try:
         db.session.add(record)
     except exc.SQLAlchemyError as e:
@@ -64,34 +67,22 @@ def write_schedule(schedule: dict):
     return record
 
 
-def write_schedule_posts(schedule_posts: List[dict]):
-    records = []
-    for post in schedule_posts:
-        record = ScheduledPost(**post)
-        try:
-            db.session.add(record)
-        except exc.SQLAlchemyError as e:
-            db.session.rollback()
-            logging.error(f"Error writing schedule post: {e}")
-        else:
-            db.session.commit()
-            records.append(record)
-    return records
-
-
-def write_schedule_topic_assoc(schedule: Schedule, topic_ids: List[int]):
-    try:
-        print('topic_ids to execute: ', topic_ids)
-        db.session.execute(
-            insert(schedule_topic_assoc),
-            [
-                {"modeled_topic_id": tid, "schedule_id": schedule.id}
-                for tid in topic_ids
-            ],
-        )
-        print('topic_ids done: ', topic_ids)
-    except exc.SQLAlchemyError as e:
-        db.session.rollback()
-        log.error(f"Database error occured: {e}")
-    else:
-        db.session.commit()
+def write_schedule_posts(schedule_posts: List[dict], writer: Optional[BatchWriter] = None):
+    batch = writer if writer is not None else BatchWriter()
+    batch.add_all(ScheduledPost, schedule_posts)
+    if writer is None:
+        batch.flush()
+
+
+def write_schedule_topic_assoc(
+        schedule: Schedule,
+        topic_ids: List,
+        writer: Optional[BatchWriter] = None,
+):
+    batch = writer if writer is not None else BatchWriter()
+    batch.add_all(schedule_topic_assoc, [
+        {"modeled_topic_id": tid, "schedule_id": schedule.id}
+        for tid in topic_ids
+    ])
+    if writer is None:
+        batch.flush()
@@ -1,10 +1,11 @@
 from typing import List
 
 from sqlalchemy.orm import Query
-from sqlalchemy import and_
+from sqlalchemy import and_, func, select
 from sqlalchemy.dialects.postgresql import UUID
 
 from .models import (
+    db,
     Tweet,
     RedditPost,
     ModeledTopic,
@@ -38,6 +39,59 @@ def latest_post_edit(generated_post_id, user_id) -> PostEdit:
     )
 
 
+def edited_post_ids(generated_post_ids, user_id) -> set:
+    '''IDs of the generated posts the user has edited, in one query.'''
+    if len(generated_post_ids) == 0:
+        return set()
+    rows = (
+        PostEdit.query.with_entities(PostEdit.generated_post_id)
+        .filter(
+            and_(
+                PostEdit.generated_post_id.in_(generated_post_ids),
+                PostEdit.user_id == user_id,
+            )
+        )
+        .distinct()
+        .all()
+    )
+    return {r.generated_post_id for r in rows}
+
+
+def scheduled_post_texts(scheduled_post_ids) -> List[tuple]:
+    '''
+    (id, user id, text to tweet) of the unposted scheduled posts among
+    scheduled_post_ids, in one query. The text is the user's latest edit
+    of the generated post, if any.
+    '''
+    if len(scheduled_post_ids) == 0:
+        return []
+    latest_edit = (
+        select(PostEdit.generated_post_id, PostEdit.user_id, PostEdit.text)
+        .join(ScheduledPost, and_(
+            ScheduledPost.generated_post_id == PostEdit.generated_post_id,
+            ScheduledPost.user_id == PostEdit.user_id,
+        ))
+        .where(ScheduledPost.id.in_(scheduled_post_ids))
+        .distinct(PostEdit.generated_post_id, PostEdit.user_id)
+        .order_by(PostEdit.generated_post_id, PostEdit.user_id, PostEdit.id.desc())
+        .subquery()
+    )
+    return db.session.execute(
+        select(
+            ScheduledPost.id,
+            ScheduledPost.user_id,
+            func.coalesce(latest_edit.c.text, GeneratedPost.text),
+        )
+        .join(GeneratedPost, GeneratedPost.id == ScheduledPost.generated_post_id)
+        .outerjoin(latest_edit, and_(
+            latest_edit.c.generated_post_id == ScheduledPost.generated_post_id,
+            latest_edit.c.user_id == ScheduledPost.user_id,
+        ))
+        .where(ScheduledPost.id.in_(scheduled_post_ids), ScheduledPost.posted_at.is_(None))
+        .order_by(ScheduledPost.user_id, ScheduledPost.scheduled_for)
+    ).all()
+
+
 def latest_user_schedule(user_id):
     '''Look up most recent schedule for user'''
     return (
@@ -63,6 +117,19 @@ def get_scheduled_post(generated_post_id, user_id):
     )
 
 
+def oauth_sessions_by_user(user_ids) -> dict:
+    '''The latest OAuth session of each user, in one query.'''
+    if len(user_ids) == 0:
+        return {}
+    sessions = db.session.scalars(
+        select(OAuthSession)
+        .where(OAuthSession.user_id.in_(user_ids))
+        .distinct(OAuthSession.user_id)
+        .order_by(OAuthSession.user_id, OAuthSession.id.desc())
+    ).all()
+    return {s.user_id: s for s in sessions}
+
+
 def oauth_session_by_token(oauth_token) -> OAuthSession:
     return (
         OAuthSession.query
@@ -0,0 +1,161 @@
+'''
+Token bucket rate limits for the external APIs posts are fetched from.
+
+Fetch tasks run in several celery worker processes at once, so the buckets
+live in Redis (the celery broker by default) and every process draws from the
+same quota. Without Redis each process gets its own in-memory bucket.
+'''
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from flask import current_app as app
+
+log = logging.getLogger(__name__)
+
+# refill the bucket, then take the tokens if there are enough.
+# returns the seconds to wait before enough tokens are available, as a string
+# since Lua numbers are truncated to integers on the way out.
+# the clock is the Redis server's so workers on different hosts agree.
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+KEY_PREFIX = "pickr:rate_limit:"
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+class TokenBucket:
+    '''
+    In-process token bucket: rate tokens per second, holding at most
+    capacity tokens.
+    '''
+
+    def __init__(self, name: str, rate: float, capacity: float):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError(f"Invalid rate limit for {name}: rate={rate} capacity={capacity}")
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._ts) * self.rate
+            )
+            self._ts = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None) -> None:
+        '''
+        Block until tokens are taken from the bucket.
+        Raises RateLimitTimeout if that takes longer than timeout seconds.
+        '''
+        if tokens > self.capacity:
+            raise ValueError(f"Can't take {tokens} tokens from {self.name}, capacity={self.capacity}")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._take(tokens)
+            if wait == 0:
+                return
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise RateLimitTimeout(f"Timed out waiting for {self.name} rate limit")
+            time.sleep(wait)
+
+
+class RedisTokenBucket(TokenBucket):
+    '''
+    Token bucket kept in Redis and shared by every process using the same key.
+    If Redis can't be reached the bucket falls back to limiting this process.
+    '''
+
+    def __init__(self, name: str, rate: float, capacity: float, redis_client):
+        super().__init__(name, rate, capacity)
+        self._redis = redis_client
+        self._script = redis_client.register_script(TOKEN_BUCKET_LUA)
+        self._key = KEY_PREFIX + name
+        self._redis_down = False
+
+    def _take(self, tokens: float) -> float:
+        try:
+            wait = float(self._script(
+                keys=[self._key], args=[self.rate, self.capacity, tokens]
+            ))
+        except Exception as e:
+            if not self._redis_down:
+                log.warning(f"Rate limit {self.name} falling back to local bucket: {e}")
+                self._redis_down = True
+            return super()._take(tokens)
+        self._redis_down = False
+        return wait
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_buckets_pid = None
+_buckets_lock = threading.Lock()
+
+
+def _redis_url() -> Optional[str]:
+    url = app.config.get("RATE_LIMIT_REDIS_URL")
+    if url is None:
+        url = app.config["CELERY"].get("broker_url")
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return url
+    return None
+
+
+def _create_bucket(provider: str) -> TokenBucket:
+    limit = app.config["FETCH_RATE_LIMITS"][provider]
+    rate = limit["requests"] / limit["per_seconds"]
+    capacity = limit.get("burst", limit["requests"])
+    url = _redis_url()
+    if url is None:
+        return TokenBucket(provider, rate, capacity)
+    # local import, redis is only installed with celery[redis]
+    import redis
+    return RedisTokenBucket(provider, rate, capacity, redis.Redis.from_url(url))
+
+
+def rate_limiter(provider: str) -> TokenBucket:
+    '''
+    The bucket for an API provider ("reddit", "twitter" or "newsapi"),
+    shared by the threads of this process.
+    '''
+    global _buckets_pid
+    with _buckets_lock:
+        # celery forks workers, don't share a redis connection with the parent
+        if _buckets_pid != os.getpid():
+            _buckets.clear()
+            _buckets_pid = os.getpid()
+        if provider not in _buckets:
+            _buckets[provider] = _create_bucket(provider)
+        return _buckets[provider]
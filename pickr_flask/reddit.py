@@ -1,14 +1,21 @@
 import logging
+import math
+import threading
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from os import environ
-from typing import Union, List
+from typing import Dict, List, Optional, Union
 
 import pandas as pd
 import praw
-from sqlalchemy import exc, insert, and_
+from sqlalchemy import and_
 from sqlalchemy.orm import Query
-from topic_model.util import normalise_tweet, parse_html
+from topic_model.util import clean_reddit_text
 
+from .batch_writer import BatchWriter
+from .fetch_scheduler import api_session
+from .ingest import UpsertResult, bulk_upsert
+from .rate_limit import rate_limiter
 from .models import (
     db,
     Niche, ModeledTopic, GeneratedPost,
@@ -16,12 +23,53 @@ from .models import (
     reddit_modeled_topic_assoc
 )
 
+# submissions per listing request
+REDDIT_PAGE_SIZE = 100
+# posts asked for when a subreddit's posting rate isn't known yet
+DEFAULT_FETCH_LIMIT = 200
+MIN_FETCH_LIMIT = 25
+# reddit listings stop at about 1000 posts
+MAX_FETCH_LIMIT = 1000
+# ask for this many times the number of posts expected since the last fetch
+FETCH_HEADROOM = 1.5
+# weight of the latest fetch in the smoothed posting rate
+RATE_SMOOTHING = 0.3
+# shortest window a posting rate is measured over, one hour
+MIN_RATE_WINDOW_DAYS = 1 / 24
+
+
+@dataclass
+class SubredditFetch:
+    # newest first
+    posts: List[dict] = field(default_factory=list)
+    # the listing reached the watermark, or its end, so nothing new was missed
+    caught_up: bool = False
+    failed: bool = False
+
+
+_local = threading.local()
 
-reddit = praw.Reddit(
-    client_id=environ["REDDIT_CLIENT_ID"],
-    client_secret=environ["REDDIT_CLIENT_SECRET"],
-    user_agent=environ["REDDIT_USER_AGENT"]
-)
+
+def get_reddit() -> praw.Reddit:
+    '''
+    Reddit client, created on first use so importing this module
+    doesn't need the credentials or touch the network.
+    praw isn't thread safe, so each fetch thread gets its own client.
+    '''
+    reddit = getattr(_local, "reddit", None)
+    if reddit is None:
+        kwargs = {}
+        session = api_session()
+        if session is not None:
+            kwargs["requestor_kwargs"] = {"session": session}
+        reddit = praw.Reddit(
+            client_id=environ["REDDIT_CLIENT_ID"],
+            client_secret=environ["REDDIT_CLIENT_SECRET"],
+            user_agent=environ["REDDIT_USER_AGENT"],
+            **kwargs,
+        )
+        _local.reddit = reddit
+    return reddit
 
 
 def _to_dict(post: praw.models.Submission) -> dict:
@@ -41,10 +89,12 @@ def _to_dict(post: praw.models.Submission) -> dict:
     }
 
 
+def post_text(p: dict) -> str:
+    return p["title"] + "\n" + p["body"]
+
+
 def process_post(p: dict) -> str:
-    return normalise_tweet(
-        parse_html(p["title"] + "\n" + p["body"])
-    )
+    return clean_reddit_text(post_text(p))
 
 
 def search_subreddit_for_term(
@@ -53,7 +103,7 @@ def search_subreddit_for_term(
         time_filter="week"
 ) -> List[dict]:
     output_rows = []
-    sub_generator = reddit.subreddit(subreddit_string).search(
+    sub_generator = get_reddit().subreddit(subreddit_string).search(
         search_term, time_filter=time_filter
     )
     for submission in sub_generator:
@@ -73,28 +123,125 @@ def get_hot_submissions(subreddit):
 
 def find_subreddits(search_terms):
     found_subreddits = []
-    subreddits = reddit.subreddits
+    subreddits = get_reddit().subreddits
     for term in search_terms:
         found_subreddits += subreddits.search_by_name(term, include_nsfw=False)
     return [s.display_name for s in found_subreddits]
 
 
-def fetch_subreddit_posts(subreddit_name, num_posts=1000):
+def fetch_subreddit_posts(
+        subreddit_name,
+        num_posts=1000,
+        since: Optional[datetime] = None,
+        since_id: Optional[str] = None,
+) -> SubredditFetch:
     '''
-    Fetch new posts from a subreddit
+    Fetch new posts from a subreddit, newest first.
+    With a watermark (since / since_id) paging stops at the first post
+    that was fetched before, instead of reading all num_posts.
     '''
-    submissions = []
-    submission_generator = reddit.subreddit(subreddit_name).new(
+    fetch = SubredditFetch()
+    submission_generator = get_reddit().subreddit(subreddit_name).new(
         limit=num_posts
     )
-    # TODO: add rate-limit backoff
+    limiter = rate_limiter("reddit")
     try:
-        for submission in submission_generator:
-            submissions.append(_to_dict(submission))
+        for i in range(num_posts):
+            if i % REDDIT_PAGE_SIZE == 0:
+                # the next submission needs a new listing page
+                limiter.acquire()
+            submission = next(submission_generator, None)
+            if submission is None:
+                break
+            post = _to_dict(submission)
+            if post["reddit_id"] == since_id or (
+                    since is not None and post["created_at"] < since):
+                fetch.caught_up = True
+                break
+            fetch.posts.append(post)
     except Exception as e:
         logging.error(f"error fetching submissions for {subreddit_name}: {e}")
-        return submissions
-    return submissions
+        fetch.failed = True
+        return fetch
+    if since is None and since_id is None:
+        # nothing to catch up with
+        fetch.caught_up = len(fetch.posts) < num_posts
+    return fetch
+
+
+def fetch_reddit_engagement(reddit_ids: List[str]) -> Dict[str, dict]:
+    '''
+    Current score and comment count of posts, looked up by id
+    REDDIT_PAGE_SIZE at a time. Deleted posts are left out.
+    '''
+    engagement = {}
+    limiter = rate_limiter("reddit")
+    for i in range(0, len(reddit_ids), REDDIT_PAGE_SIZE):
+        batch = reddit_ids[i:i + REDDIT_PAGE_SIZE]
+        limiter.acquire()
+        for submission in get_reddit().info(fullnames=[f"t3_{rid}" for rid in batch]):
+            engagement[submission.id] = {
+                "score": submission.score,
+                "num_comments": submission.num_comments,
+            }
+    return engagement
+
+
+def fetch_limit(
+        subreddit: Subreddit,
+        now: datetime,
+        default: int = DEFAULT_FETCH_LIMIT,
+) -> int:
+    '''
+    Number of posts to ask for: the posts expected since the last fetch
+    at the subreddit's observed rate, with some headroom.
+    '''
+    if subreddit.last_fetched_at is None or subreddit.posts_per_day is None:
+        return default
+    days = (now - subreddit.last_fetched_at).total_seconds() / 86400
+    expected = math.ceil(subreddit.posts_per_day * days * FETCH_HEADROOM)
+    return min(MAX_FETCH_LIMIT, max(MIN_FETCH_LIMIT, expected))
+
+
+def advance_watermark(
+        subreddit: Subreddit,
+        fetch: SubredditFetch,
+        now: datetime,
+) -> None:
+    '''
+    Move the subreddit's watermark to the newest fetched post and update
+    its posting rate. The caller commits.
+    A failed fetch leaves the watermark alone, so the posts it missed are
+    fetched next time.
+    '''
+    if fetch.failed:
+        return
+    if fetch.caught_up and subreddit.last_fetched_at is not None:
+        # every post created since the last fetch was read
+        window_start = subreddit.last_fetched_at
+    elif fetch.posts:
+        # the limit cut the listing off, measure over the posts we have
+        window_start = min(p["created_at"] for p in fetch.posts)
+    else:
+        window_start = None
+    if window_start is not None:
+        days = max((now - window_start).total_seconds() / 86400, MIN_RATE_WINDOW_DAYS)
+        observed = len(fetch.posts) / days
+        if subreddit.posts_per_day is None:
+            subreddit.posts_per_day = observed
+        elif not fetch.caught_up:
+            # a lower bound, catch up with a burst of posts straight away
+            subreddit.posts_per_day = max(observed, subreddit.posts_per_day)
+        else:
+            subreddit.posts_per_day = (
+                RATE_SMOOTHING * observed
+                + (1 - RATE_SMOOTHING) * subreddit.posts_per_day
+            )
+    if fetch.posts:
+        newest = max(fetch.posts, key=lambda p: p["created_at"])
+        subreddit.last_post_created_at = newest["created_at"]
+        subreddit.last_reddit_id = newest["reddit_id"]
+    subreddit.last_fetched_at = now
 
 
 #############################################################################
@@ -106,75 +253,53 @@ def update_reddit_posts(posts: List[RedditPost]):
     db.session.commit()
 
 
-def write_reddit_posts(posts: List[dict]) -> int:
-    num_written = 0
+def write_reddit_posts(posts: List[dict]) -> UpsertResult:
+    '''
+    Insert new posts and refresh the score and comment count of posts
+    that were fetched before.
+    '''
     for post in posts:
-        record = (
-            db.session.query(RedditPost)
-            .filter(RedditPost.reddit_id == post["reddit_id"])
-            .first()
-        )
-        if record is None:
-            record = RedditPost(**post)
-            try:
-                db.session.add(record)
-            except exc.SQLAlchemyError as e:
-                db.session.rollback()
-                logging.error(f"Error writing reddit post: {e}")
-            else:
-                db.session.commit()
-                num_written += 1
-    return num_written
-
-
-def write_generated_posts(generated_posts: List[dict]) -> None:
+        post["updated_at"] = datetime.utcnow()
+    return bulk_upsert(
+        RedditPost, posts, ["reddit_id"],
+        update_columns=["score", "num_comments", "updated_at"],
+    )
+
+
+def write_generated_posts(
+        generated_posts: List[dict],
+        writer: Optional[BatchWriter] = None,
+) -> List[GeneratedPost]:
     """
+    Save generated posts with one multi-row insert.
+    Returns the new GeneratedPost objects, unless a writer is given,
+    in which case the rows are flushed by the caller.
     """
-    records = []
-    for post in generated_posts:
-        record = GeneratedPost(**post)
-        records.append(record)
-        try:
-            db.session.add(record)
-        except exc.SQLAlchemyError as e:
-            db.session.rollback()
-            logging.error(f"Database error occurred: {e}")
-        else:
-            db.session.commit()
-
-    return records
+    if writer is not None:
+        writer.add_all(GeneratedPost, generated_posts)
+        return []
+    writer = BatchWriter()
+    writer.add_all(GeneratedPost, generated_posts)
+    return writer.flush(returning=True).get(GeneratedPost, [])
 
 
 def write_modeled_topic_with_reddit_posts(
         topic: dict,
-        post_ids: List[int]
+        post_ids: List,
+        writer: Optional[BatchWriter] = None,
 ) -> None:
     '''
-    Save a modeled topic to the database and associate reddit IDs
-    with the topic.
+    Save a modeled topic and associate reddit posts with the topic.
+    With a writer the rows are only added to it, to be flushed by the caller.
     '''
-    modeled_topic = ModeledTopic(**topic)
-    try:
-        db.session.add(modeled_topic)
-    except exc.SQLAlchemyError as e:
-        db.session.rollback()
-        logging.error(f"Database error occured: {e}")
-    else:
-        db.session.commit()
-
-    try:
-        db.session.execute(
-            insert(reddit_modeled_topic_assoc),
-            [
-                {"reddit_id": pid, "modeled_topic_id": modeled_topic.id}
-                for pid in post_ids
-            ],
-        )
-    except exc.SQLAlchemyError as e:
-        db.session.rollback()
-        logging.error(f"Database error occured: {e}")
-    else:
-        db.session.commit()
+    batch = writer if writer is not None else BatchWriter()
+    modeled_topic = batch.add(ModeledTopic, dict(topic))
+    batch.add_all(reddit_modeled_topic_assoc, [
+        {"reddit_id": pid, "modeled_topic_id": modeled_topic["id"]}
+        for pid in post_ids
+    ])
+    if writer is None:
+        batch.flush()
 
 def reddit_posts_for_niches_query(niches: List) -> Query:
     '''
@@ -17,7 +17,6 @@ from flask_mail import Mail, Message
 from flask_wtf.csrf import CSRFError
 from sqlalchemy import Date, and_, cast, exc
 from werkzeug.security import check_password_hash, generate_password_hash
-from topic_model.topic import generate_informative_tweets_from_long_content
 from .auth import PASSWORD_HASH_METHOD, get_reset_token, verify_reset_token
 from .constants import (DATETIME_FRIENDLY_FMT, DATETIME_ISO_FMT,
                         MAX_FUTURE_SCHEDULE_DAYS, MAX_TWEET_LEN)
@@ -36,6 +35,7 @@ from .subscription import (handle_checkout_completed,
                            handle_subscription_updated, is_user_account_valid,
                            is_user_stripe_subscription_active)
 from .tasks import generate_niche_gpt_topics, create_schedule
+from .tweet_dispatcher import notify_scheduled_post
 from .util import log_user_activity, render_post_html_from_id, urlsafe_uuid
 from . import csrf
 from .twitter import X_Caller, get_top_twitter_posts_for_niches, twitter_posts_for_topic_query
@@ -304,6 +304,8 @@ def posts_from_blog():
 
     if form.validate_on_submit():
 
+        # local import, the topic model stack is only needed by this view
+        from topic_model.topic import generate_informative_tweets_from_long_content
         public_statements = generate_informative_tweets_from_long_content(form.blog_input.data)
         generated_post_dicts = [{
                 "topic_label": "post_from_content",
@@ -1054,6 +1056,8 @@ def schedule_post(post_id):
             scheduled_for=schedule_dt.astimezone(timezone.utc)
         )
         db.session.add(scheduled_post)
+        db.session.flush()
+        notify_scheduled_post(scheduled_post.id)
         db.session.commit()
 
         app.logger.info(
@@ -1104,6 +1108,7 @@ def unschedule_post(post_id):
         ScheduledPost.query.filter(
             ScheduledPost.id == sched_post.id
         ).delete()
+        notify_scheduled_post(sched_post.id)
         db.session.commit()
     return render_post_html_from_id(generated_post.id, current_user.id)
 
@@ -0,0 +1,316 @@
+'''
+Scheduler daemon for the periodic jobs that run outside celery.
+
+A single process sleeps until the next job is due, runs it in a thread of
+its own and goes back to sleep. Jobs have cron specs, read in the
+SCHEDULE_TIMEZONE. Scheduled tweets are a job due when the next tweet is
+scheduled for, rather than on a polling interval, see tweet_dispatcher.py.
+The last and next run of each job are kept in the scheduled_job table.
+'''
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, FrozenSet, List, Optional
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import exc
+
+from .models import ScheduledJob, db
+
+log = logging.getLogger(__name__)
+
+# longest sleep, due times found at runtime wake the scheduler when they
+# change, this is in case a wake up is missed
+MAX_SLEEP = timedelta(seconds=60)
+# a run missed while the daemon was down is made up if it's this recent
+MISFIRE_GRACE = timedelta(hours=1)
+# enough of the error to tell what failed, the full traceback is in the logs
+MAX_ERROR_LENGTH = 2000
+
+
+class CronSpec:
+    '''
+    A five field cron spec: minute hour day-of-month month day-of-week.
+    Fields are *, numbers, ranges a-b and lists of these, with an
+    optional step (*/15, 1-5/2). Days of the week are 0-6 from Sunday,
+    7 is Sunday too. As in cron, a day matches either restricted day field.
+    '''
+    FIELDS = (("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7))
+    # cron specs match some day within a few years, or never
+    MAX_DAYS = 366 * 5
+
+    def __init__(self, spec: str):
+        fields = spec.split()
+        if len(fields) != len(self.FIELDS):
+            raise ValueError(f"Cron spec needs {len(self.FIELDS)} fields: {spec!r}")
+        self.spec = spec
+        values = {
+            name: self._parse_field(field, lo, hi, spec)
+            for field, (name, lo, hi) in zip(fields, self.FIELDS)
+        }
+        self.minutes = sorted(values["minute"])
+        self.hours = sorted(values["hour"])
+        self.days = values["day"]
+        self.months = values["month"]
+        self.weekdays = frozenset(d % 7 for d in values["weekday"])
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse_field(field: str, lo: int, hi: int, spec: str) -> FrozenSet[int]:
+        values = set()
+        for part in field.split(","):
+            rng, _, step = part.partition("/")
+            if rng == "*":
+                start, end = lo, hi
+            elif "-" in rng:
+                start, end = (int(v) for v in rng.split("-", 1))
+            else:
+                start = end = int(rng)
+            step = int(step) if step else 1
+            if not (lo <= start <= end <= hi) or step < 1:
+                raise ValueError(f"Cron field {field!r} out of range {lo}-{hi}: {spec!r}")
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def matches_day(self, d: date) -> bool:
+        if d.month not in self.months:
+            return False
+        in_days = d.day in self.days
+        in_weekdays = d.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, after: datetime, tz: ZoneInfo) -> datetime:
+        '''
+        First time after `after` the spec matches, in UTC.
+        The spec is matched against the wall clock time of tz, so a job at
+        5:00 runs at 5:00 both sides of a daylight saving change. A time
+        skipped by the clocks going forward runs an hour later, a time
+        repeated by the clocks going back runs once.
+        '''
+        # from an hour earlier: a skipped time runs an hour later, so its
+        # wall clock time can be before after's and still be due
+        start = after.astimezone(tz).replace(tzinfo=None, second=0, microsecond=0) - timedelta(minutes=59)
+        for days in range(self.MAX_DAYS):
+            day = start.date() + timedelta(days=days)
+            if not self.matches_day(day):
+                continue
+            for hour in self.hours:
+                for minute in self.minutes:
+                    local = datetime(day.year, day.month, day.day, hour, minute)
+                    if local < start:
+                        continue
+                    run_at = local.replace(tzinfo=tz).astimezone(timezone.utc)
+                    if run_at > after:
+                        return run_at
+        raise ValueError(f"Cron spec never matches: {self.spec!r}")
+
+    def __repr__(self):
+        return f"CronSpec({self.spec!r})"
+
+
+@dataclass
+class Job:
+    name: str
+    func: Callable[[], object]
+    spec: Optional[CronSpec] = None
+    # for jobs due at times only known at runtime: the next due time
+    # after the given one, or None if there's nothing to do
+    next_due: Optional[Callable[[datetime], Optional[datetime]]] = None
+
+    def next_run(self, after: datetime, tz: ZoneInfo) -> Optional[datetime]:
+        if self.next_due is not None:
+            return self.next_due(after)
+        return self.spec.next_after(after, tz)
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _naive(dt: Optional[datetime]) -> Optional[datetime]:
+    # the tables keep naive UTC times
+    return None if dt is None else dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class Scheduler:
+    '''
+    Runs jobs when they're due, each in a thread with its own app context.
+    A job still running when it's due again is skipped rather than run twice.
+    '''
+
+    def __init__(
+            self,
+            app,
+            jobs: List[Job],
+            tz: ZoneInfo,
+            max_sleep: timedelta = MAX_SLEEP,
+            watchers: Optional[list] = None,
+    ):
+        self.app = app
+        # started and stopped with the scheduler, they wake it when due
+        # times change, see TweetDispatcher.start
+        self.watchers = watchers or []
+        self.jobs = {job.name: job for job in jobs}
+        self.tz = tz
+        self.max_sleep = max_sleep
+        self.next_runs: Dict[str, Optional[datetime]] = {}
+        self.running: Dict[str, threading.Thread] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wake.set()
+
+    def wake(self) -> None:
+        '''Recheck the due times, e.g. after a runtime due time changed.'''
+        self._wake.set()
+
+    def run(self) -> None:
+        '''Run jobs until stopped. Needs an app context.'''
+        for watcher in self.watchers:
+            watcher.start(self.app, on_change=self.wake)
+        self._load_next_runs(utcnow())
+        log.info(
+            "Scheduler started: " + ", ".join(
+                f"{name} next={_naive(at)}" for name, at in self.next_runs.items()
+            )
+        )
+        while not self._stopped:
+            self._wake.clear()
+            now = utcnow()
+            self.run_pending(now)
+            waits = [
+                (at - now).total_seconds() for name, at in self.next_runs.items()
+                if at is not None and name not in self.running
+            ]
+            timeout = min(waits + [self.max_sleep.total_seconds()])
+            self._wake.wait(max(timeout, 0))
+        for watcher in self.watchers:
+            watcher.stop()
+        if self.running:
+            log.info(f"Scheduler stopped with jobs running: {sorted(self.running)}")
+
+    def run_pending(self, now: datetime) -> List[str]:
+        '''Start the jobs due at now. Returns their names.'''
+        started = []
+        for name, job in self.jobs.items():
+            with self._lock:
+                if name in self.running:
+                    continue
+            if job.next_due is not None:
+                # due times found at runtime can move, e.g. new scheduled tweets
+                self.next_runs[name] = job.next_run(now, self.tz)
+            due = self.next_runs.get(name)
+            if due is None or due > now:
+                continue
+            self._start(job, now)
+            started.append(name)
+        return started
+
+    def _load_next_runs(self, now: datetime) -> None:
+        rows = {
+            row.name: row for row in
+            ScheduledJob.query.filter(ScheduledJob.name.in_(self.jobs)).all()
+        }
+        for name, job in self.jobs.items():
+            row = rows.get(name)
+            missed = (
+                None if row is None or row.next_run_at is None
+                else row.next_run_at.replace(tzinfo=timezone.utc)
+            )
+            if job.spec is not None and missed is not None and now - MISFIRE_GRACE <= missed <= now:
+                log.info(f"Making up run of {name} missed at {row.next_run_at}")
+                self.next_runs[name] = missed
+            else:
+                self.next_runs[name] = job.next_run(now, self.tz)
+
+    def _start(self, job: Job, now: datetime) -> None:
+        next_run = job.spec.next_after(now, self.tz) if job.spec is not None else None
+        self.next_runs[job.name] = next_run
+        self._record(
+            job, last_run_at=_naive(now), last_finished_at=None, last_status="running",
+            last_error=None, next_run_at=_naive(next_run),
+        )
+        thread = threading.Thread(target=self._run_job, args=(job,), name=job.name, daemon=True)
+        with self._lock:
+            self.running[job.name] = thread
+        thread.start()
+
+    def _run_job(self, job: Job) -> None:
+        with self.app.app_context():
+            start = time.perf_counter()
+            log.info(f"Running scheduled job {job.name}")
+            try:
+                job.func()
+            except Exception as e:
+                log.exception(f"Scheduled job {job.name} failed")
+                db.session.rollback()
+                status, error = "failed", repr(e)[:MAX_ERROR_LENGTH]
+            else:
+                status, error = "ok", None
+            log.info(
+                f"Scheduled job {job.name} {status} in {time.perf_counter() - start:.1f}s"
+            )
+            self._record(job, last_finished_at=_naive(utcnow()), last_status=status, last_error=error)
+        with self._lock:
+            self.running.pop(job.name, None)
+        self._wake.set()
+
+    def _record(self, job: Job, **fields) -> None:
+        row = db.session.get(ScheduledJob, job.name)
+        if row is None:
+            row = ScheduledJob(name=job.name)
+            db.session.add(row)
+        row.spec = job.spec.spec if job.spec is not None else None
+        for key, value in fields.items():
+            setattr(row, key, value)
+        try:
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            db.session.rollback()
+            log.error(f"Error recording scheduled job {job.name}: {e}")
+
+
+def scheduled_jobs(schedule: Dict[str, Optional[str]], dispatcher) -> List[Job]:
+    '''
+    The scheduler's jobs. schedule maps job names to cron specs,
+    a job without a spec doesn't run. Needs an app context.
+    '''
+    # imported here because looped_tasks needs an app context to be imported
+    from .looped_tasks import (all_niches_run_pipeline, all_niches_update,
+                               all_users_run_schedule)
+    from .tasks import run_marketing_functions
+
+    cron_jobs = {
+        "all_niches_update": all_niches_update,
+        "all_niches_run_pipeline": all_niches_run_pipeline,
+        "all_users_run_schedule": all_users_run_schedule,
+        "send_marketing_dms": run_marketing_functions,
+    }
+    unknown = set(schedule) - set(cron_jobs)
+    if unknown:
+        raise ValueError(f"Unknown scheduled jobs: {sorted(unknown)}")
+    jobs = [
+        Job(name, cron_jobs[name], spec=CronSpec(spec))
+        for name, spec in schedule.items() if spec
+    ]
+    jobs.append(Job("post_scheduled_tweets", dispatcher.post_due, next_due=dispatcher.next_due))
+    return jobs
+
+
+def build_scheduler(app) -> Scheduler:
+    '''Build the scheduler from the app config. Call .run() to start it.'''
+    from .tweet_dispatcher import TweetDispatcher
+
+    tz = ZoneInfo(app.config["SCHEDULE_TIMEZONE"])
+    dispatcher = TweetDispatcher()
+    return Scheduler(
+        app, scheduled_jobs(app.config["SCHEDULE"], dispatcher), tz, watchers=[dispatcher]
+    )
@@ -2,33 +2,59 @@ import logging
 import random
 import uuid
 import math
-import tweepy
 import itertools
+import calendar
+from functools import partial
 from datetime import datetime, timedelta
-from typing import List
+from typing import List, Union
 
 from celery import chain, shared_task
 from flask import current_app as app
-from sqlalchemy import exc, insert, and_
+from sqlalchemy import exc, insert, and_, select
 from topic_model import topic
+from topic_model.embedding_cache import encode_with_cache
+from topic_model.fit_archive import FitArchive
+from topic_model.incremental import (TopicModelStore, assign_new_docs,
+                                     fit_or_assign)
+from topic_model.model_registry import TOPIC_ENCODER, model_stats
+from topic_model.util import clean_reddit_text, clean_texts
 from .twitter import X_Caller
+from .artifacts import get_artifact, is_artifact_ref, prune_artifacts, put_artifact
+from .batch_writer import BatchWriter
+from .embedding_store import DBEmbeddingStore, embed_texts
+from .engagement import (TREND_WINDOW, add_streamed_posts,
+                         daily_engagement_gains, load_topic_trends,
+                         prune_daily_engagement, refresh_reddit_engagement,
+                         refresh_tweet_engagement, save_topic_trends,
+                         update_modeled_topic_ranks)
+from .fetch_scheduler import FetchJob, FetchScheduler
 from .models import (GeneratedPost, ModeledTopic, Niche, PickrUser, PostEdit, Tweet, TwitterTerm, RedditPost,
                      ScheduledPost, _to_dict, db, user_niche_assoc)
-from .newsapi import (get_trends, write_modeled_topic_with_news_article,
+from .newsapi import (fetch_news_articles, get_trends,
+                      write_modeled_topic_with_news_article,
                       write_news_articles)
 from .post_schedule import (write_schedule, write_schedule_posts,
                             get_simple_schedule_text, write_schedule_topic_assoc)
-from .queries import latest_post_edit, oauth_session_by_user
-from .reddit import (fetch_subreddit_posts, process_post,
+from .pipeline_runs import end_stage, start_run
+from .queries import edited_post_ids
+from .reddit import (DEFAULT_FETCH_LIMIT, advance_watermark,
+                     fetch_limit, fetch_subreddit_posts, post_text,
                      write_generated_posts,
                      write_modeled_topic_with_reddit_posts,write_reddit_posts)
-from .twitter import (get_twitter_posts_from_term, clean_tweet,
+from .tweet_dispatcher import post_scheduled
+from .twitter import (advance_term, allocate_twitter_budget,
+                      get_twitter_posts_from_term, clean_tweet,
+                      twitter_daily_budget,
                       write_modeled_topic_with_twitter_posts,
                       write_twitter_modeled_overview, write_twitter_posts)
 
 TOPIC_MODEL_MIN_DOCS = 20
+# stored outputs of pipeline stages are kept this long, for retries
+ARTIFACT_MAX_AGE = timedelta(days=3)
 MAX_MONTHLY_TWITTER_POSTS = 9500
-MAX_DAILY_TWITTER_POSTS = MAX_MONTHLY_TWITTER_POSTS / 30
+# tweets looked up again each day to refresh their engagement,
+# reserved out of the monthly cap
+TWEET_REFRESH_PER_DAY = 60
 TWITTER_NICHES = ["Entrepreneurship", "Marketing", "Personal Development"]
 
 log = logging.getLogger(__name__)
@@ -153,23 +179,22 @@ def create_schedule(user_id):
                     break
 
     # do tone matching for generated posts. sonly make a post edit if the user has tweet examples
+    # everything the schedule writes is committed together at the end
+    writer = BatchWriter()
     user_tweet_examples = user.tweet_examples
     if user_tweet_examples is not None and len(user_tweet_examples) >= 1000:
         # convert posts into a users tone if this hasn't already been done
+        edited = edited_post_ids([gp.id for gp in generated_posts], user_id)
         for gp in generated_posts:
-            post_edit = latest_post_edit(gp.id, user_id)
-            if post_edit is None:
+            if gp.id not in edited:
                 # a post edit hasn't been made. Which means this post needs to be tone matched
                 tone_matched_tweet = topic.rewrite_tweet_in_users_tone(gp.text, user_tweet_examples)
-
-                new_edit = PostEdit(
-                    text=tone_matched_tweet,
-                    created_at=datetime.now(),
-                    user_id=user_id,
-                    generated_post_id=gp.id
-                )
-                db.session.add(new_edit)
-                db.session.commit()
+                writer.add(PostEdit, {
+                    "text": tone_matched_tweet,
+                    "created_at": datetime.now(),
+                    "user_id": user_id,
+                    "generated_post_id": gp.id,
+                })
 
     # endfor
     #chosen_topics = list(set(chosen_topics))
@@ -189,7 +214,7 @@ def create_schedule(user_id):
         "week_number": datetime.now().isocalendar().week,
         "schedule_text": get_simple_schedule_text(),
         "schedule_niche_text": schedule_niche_text
-    })
+    }, writer)
 
     #  pick 3 random posts for each day
     scheduled_posts = []
@@ -208,9 +233,10 @@ def create_schedule(user_id):
             })
     log.info(f"Writing {len(scheduled_posts)} posts")
     print(f"Writing {len(scheduled_posts)} posts")
-    write_schedule_posts(scheduled_posts)
+    write_schedule_posts(scheduled_posts, writer)
     print('schdeule id',schedule.id)
-    write_schedule_topic_assoc(schedule, [t.id for t in chosen_topics])
+    write_schedule_topic_assoc(schedule, [t.id for t in chosen_topics], writer)
+    writer.flush()
     return schedule.id
 
 
@@ -226,109 +252,354 @@ def all_niches_update():
             .all()
     )
 
-    num_twitter_posts_per_niche = MAX_DAILY_TWITTER_POSTS / len(TWITTER_NICHES)
+    twitter_budgets = twitter_niche_budgets(niches)
     
     for niche in niches:
+        log.info(f"Updating posts for niche: {niche.title}")
+        update_niche_posts.apply_async(args=(niche.id, twitter_budgets[niche.id]))
 
-        if niche.title in TWITTER_NICHES:
-            log.info(f"Updating twitter posts for niche: {niche.title}")
-            update_niche_twitter.apply_async(args=(niche.id, num_twitter_posts_per_niche,))
-        
-        log.info(f"Updating subreddits for niche: {niche.title}")
-        update_niche_subreddits.apply_async(args=(niche.id,))
+
+def twitter_niche_budgets(niches) -> dict:
+    """
+    Split today's share of the monthly tweet budget across the terms of
+    the twitter niches by their yield.
+    Returns niche id -> {term id as a string: tweets to read}, the niche's
+    share is passed to update_niche_posts as is.
+    """
+    twitter_niche_ids = [n.id for n in niches if n.title in TWITTER_NICHES]
+    terms = TwitterTerm.query.filter(TwitterTerm.niche_id.in_(twitter_niche_ids)).all()
+    today = datetime.utcnow().date()
+    refresh_reserve = TWEET_REFRESH_PER_DAY * calendar.monthrange(today.year, today.month)[1]
+    daily_budget = twitter_daily_budget(MAX_MONTHLY_TWITTER_POSTS - refresh_reserve, today)
+    log.info(f"Twitter budget for today: {daily_budget} posts over {len(terms)} terms")
+    allocation = allocate_twitter_budget(terms, daily_budget)
+    budgets = {n.id: {} for n in niches}
+    for t in terms:
+        if allocation[t.id] > 0:
+            budgets[t.niche_id][str(t.id)] = allocation[t.id]
+    return budgets
 
 
 @shared_task
-def update_niche_twitter(niche_id, total_posts):
+def update_niche_posts(
+        niche_id,
+        term_budgets=None,
+        posts_per_subreddit=DEFAULT_FETCH_LIMIT,
+        stream_in_process=False,
+):
     """
-    Fetch new posts for each twitter term related to this niche.
-    Save the results to DB.
+    Fetch new posts for the subreddits and twitter terms of this niche
+    concurrently, sharing the API rate limits with other workers.
+    term_budgets maps twitter term ids to the tweets to read for them,
+    see twitter_niche_budgets. Save the results to DB, and queue the new posts to be assigned to
+    the niche's topics, or assign them here if stream_in_process is True,
+    for callers that run without celery workers.
     """
+    niche = Niche.query.get(niche_id)
+    now = datetime.utcnow()
+    jobs = subreddit_fetch_jobs(niche, now, posts_per_subreddit)
+    if term_budgets:
+        jobs += twitter_fetch_jobs(niche_id, term_budgets)
+    new_ids = save_fetched_posts(jobs, now)
+    stream_new_posts(niche_id, new_ids, in_process=stream_in_process)
+    return niche_id
 
-    twitter_terms = db.session.query(TwitterTerm).filter(TwitterTerm.niche_id == niche_id).all()
-    print('retrieved twitter terms', len(twitter_terms))
-    posts_per_term = int(total_posts / len(twitter_terms))
-    for twitter_term in twitter_terms:
-        print('term', twitter_term)
-        posts = get_twitter_posts_from_term(
-            twitter_term.term,
-            num_posts=posts_per_term,
-        )
 
-        for p in posts:
-            p["clean_text"] = clean_tweet(p['text'])
-            p["niche_id"] = niche_id
+@shared_task
+def refresh_niche_engagement(niche_id):
+    """
+    Look up the current engagement of the niche's posts inside the trend
+    window, so the topic model ranks trends by how fast posts are gaining
+    engagement rather than by their score when they were fetched.
+    """
+    niche = Niche.query.get(niche_id)
+    now = datetime.utcnow()
+    refresh_reddit_engagement(
+        [s.id for s in niche.subreddits], now, app.config["REDDIT_REFRESH_MAX_POSTS"]
+    )
+    if niche.title in TWITTER_NICHES:
+        refresh_tweet_engagement(niche_id, now, TWEET_REFRESH_PER_DAY // len(TWITTER_NICHES))
+    return niche_id
 
-        log.info(f"Fetched {len(posts)} posts: term={twitter_term}")
-        n_written = write_twitter_posts(posts)
-        log.info(f"Wrote {n_written} twitter posts: term={twitter_term}")
 
+@shared_task
+def update_niche_twitter(niche_id, total_posts):
+    """
+    Fetch new posts for each twitter term related to this niche,
+    total_posts split across them by their yield. Save the results to DB.
+    """
+    twitter_terms = TwitterTerm.query.filter(TwitterTerm.niche_id == niche_id).all()
+    allocation = allocate_twitter_budget(twitter_terms, int(total_posts))
+    term_budgets = {str(term_id): posts for term_id, posts in allocation.items()}
+    new_ids = save_fetched_posts(twitter_fetch_jobs(niche_id, term_budgets), datetime.utcnow())
+    stream_new_posts(niche_id, new_ids)
     return niche_id
 
 
 @shared_task
-def update_niche_subreddits(niche_id, posts_per_subreddit=200):
+def update_niche_subreddits(niche_id, posts_per_subreddit=DEFAULT_FETCH_LIMIT):
     """
-    Fetch new posts for each subreddit related to this niche.
-    Save the results to DB.
+    Fetch posts for each subreddit related to this niche that are newer
+    than the subreddit's watermark. Save the results to DB.
+    posts_per_subreddit is the limit for subreddits without a posting rate yet.
     """
     niche = Niche.query.get(niche_id)
+    now = datetime.utcnow()
+    new_ids = save_fetched_posts(subreddit_fetch_jobs(niche, now, posts_per_subreddit), now)
+    stream_new_posts(niche_id, new_ids)
+    return niche_id
+
+
+@shared_task
+def assign_new_posts(niche_id, source, post_ids):
+    """
+    Assign posts ingested since the last pipeline run to the topics of the
+    niche's saved topic model, and update the topics' sizes and trends.
+    Outliers that start forming a topic of their own get the model refit
+    on the next run. Does nothing until the niche has a saved model.
+    """
+    if not app.config["TOPIC_MODEL_INCREMENTAL"]:
+        return
+    if source == "twitter":
+        posts = db.session.query(Tweet.id, Tweet.clean_text, Tweet.likes).filter(
+            Tweet.id.in_(post_ids)
+        ).all()
+    else:
+        posts = db.session.query(RedditPost.id, RedditPost.clean_text, RedditPost.score).filter(
+            RedditPost.id.in_(post_ids)
+        ).all()
+    posts = [p for p in posts if p[1]]
+    if len(posts) == 0:
+        return
+
+    texts = [p[1] for p in posts]
+    store = TopicModelStore(app.config["TOPIC_MODEL_DIR"])
+    assigned = assign_new_docs(
+        store, f"{niche_id}/{source}", [str(p[0]) for p in posts], texts, embed_texts(texts)
+    )
+    if assigned is None:
+        return
+    ranks = add_streamed_posts(
+        niche_id, source, assigned.topics, [p[2] for p in posts], datetime.utcnow()
+    )
+    updated = update_modeled_topic_ranks(niche_id, source, ranks)
+    log.info(
+        f"Streamed {len(posts)} {source} posts: niche={niche_id} "
+        f"topics={len(ranks)} modeled_topics_updated={updated} "
+        f"emerging={[len(c) for c in assigned.emerging]}"
+    )
+
+
+def subreddit_fetch_jobs(niche, now, posts_per_subreddit) -> List[FetchJob]:
+    jobs = []
     for subreddit in niche.subreddits:
         # TODO: do we want top/hot from previous day here instead?
-        posts = fetch_subreddit_posts(
+        limit = fetch_limit(subreddit, now, default=posts_per_subreddit)
+        jobs.append(FetchJob("reddit", subreddit, partial(
+            fetch_subreddit_posts,
             subreddit.title,
-            num_posts=posts_per_subreddit,
-        )
-        for p in posts:
-            p["subreddit_id"] = subreddit.id
-            p["clean_text"] = process_post(p)
-        log.info(f"Fetched {len(posts)} posts: subredddit={subreddit.title}")
+            num_posts=limit,
+            since=subreddit.last_post_created_at,
+            since_id=subreddit.last_reddit_id,
+        )))
+    return jobs
 
-        n_written = write_reddit_posts(posts)
-        log.info(f"Wrote {n_written} reddit posts: subreddit={subreddit.title}")
 
-    return niche_id
+def twitter_fetch_jobs(niche_id, term_budgets: dict) -> List[FetchJob]:
+    """
+    A fetch job for each of the niche's twitter terms with a budget.
+    term_budgets maps term ids, as strings, to the tweets to read.
+    """
+    twitter_terms = db.session.query(TwitterTerm).filter(TwitterTerm.niche_id == niche_id).all()
+    log.info(f"Retrieved {len(twitter_terms)} twitter terms: niche={niche_id}")
+    return [
+        FetchJob("twitter", twitter_term, partial(
+            get_twitter_posts_from_term,
+            twitter_term.term,
+            num_posts=term_budgets[str(twitter_term.id)],
+            since_id=twitter_term.since_id,
+        ))
+        for twitter_term in twitter_terms
+        if term_budgets.get(str(twitter_term.id), 0) > 0
+    ]
+
+
+def save_fetched_posts(jobs: List[FetchJob], now: datetime) -> dict:
+    """
+    Run the fetch jobs concurrently and write each one's posts
+    as it finishes. now is when the jobs were created.
+    A job whose posts fail to write doesn't advance its watermark, so
+    they're fetched again next time, and the other jobs carry on.
+    Returns the ids of the new posts of each source.
+    """
+    new_ids = {"reddit": [], "twitter": []}
+    for done in FetchScheduler().run(jobs):
+        if done.error is not None:
+            continue
+        try:
+            if done.job.provider == "reddit":
+                new_ids["reddit"] += save_subreddit_posts(done.job.key, done.result, now)
+            elif done.job.provider == "twitter":
+                new_ids["twitter"] += save_twitter_term_posts(done.job.key, done.result, now)
+        except exc.SQLAlchemyError as e:
+            log.error(f"Error saving {done.job.provider} posts of {done.job.key}: {e}")
+    return new_ids
+
+
+def stream_new_posts(niche_id, new_ids: dict, in_process: bool = False) -> None:
+    """
+    Queue the assignment of new posts to the niche's saved topic models,
+    so their topics are updated before the next pipeline run.
+    With in_process the posts are assigned here rather than by a worker.
+    """
+    if not app.config["TOPIC_STREAMING"]:
+        return
+    for source, ids in new_ids.items():
+        if len(ids) == 0:
+            continue
+        if in_process:
+            assign_new_posts(niche_id, source, ids)
+        else:
+            assign_new_posts.apply_async(args=(niche_id, source, ids))
+
+
+def save_subreddit_posts(subreddit, fetch, now):
+    posts = fetch.posts
+    cleaned = clean_texts(
+        clean_reddit_text,
+        [post_text(p) for p in posts],
+        processes=app.config.get("TEXT_CLEANING_PROCESSES", 1),
+    )
+    for p, clean_text in zip(posts, cleaned):
+        p["subreddit_id"] = subreddit.id
+        p["clean_text"] = clean_text
+    log.info(
+        f"Fetched {len(posts)} new posts: "
+        f"caught_up={fetch.caught_up} subredddit={subreddit.title}"
+    )
+
+    written = write_reddit_posts(posts)
+    log.info(
+        f"Wrote reddit posts: inserted={written.inserted} "
+        f"updated={written.updated} subreddit={subreddit.title}"
+    )
+    advance_watermark(subreddit, fetch, now)
+    try:
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error saving watermark for {subreddit.title}: {e}")
+    # warm the embedding cache so the topic model run doesn't encode these
+    embed_texts([p["clean_text"] for p in posts])
+    return [written.ids[k] for k in written.new_keys]
+
+
+def save_twitter_term_posts(twitter_term, posts, now):
+    cleaned = clean_texts(
+        clean_tweet,
+        [p["text"] for p in posts],
+        processes=app.config.get("TEXT_CLEANING_PROCESSES", 1),
+    )
+    for p, clean_text in zip(posts, cleaned):
+        p["clean_text"] = clean_text
+        p["niche_id"] = twitter_term.niche_id
+
+    log.info(f"Fetched {len(posts)} posts: term={twitter_term.term}")
+    written = write_twitter_posts(posts)
+    log.info(
+        f"Wrote twitter posts: inserted={written.inserted} "
+        f"updated={written.updated} term={twitter_term.term}"
+    )
+    advance_term(twitter_term, posts, written, now)
+    try:
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        log.error(f"Error saving state of twitter term {twitter_term.term}: {e}")
+    # warm the embedding cache so the topic model run doesn't encode these
+    embed_texts([p["clean_text"] for p in posts])
+    return [written.ids[k] for k in written.new_keys]
+
+
+def prune_pipeline_data(now: datetime) -> None:
+    """
+    Delete what earlier pipeline runs left behind that is no longer read.
+    Called at the start of both the celery and the looped pipeline runs.
+    """
+    # daily engagement older than the trend window is no longer read
+    prune_daily_engagement(now)
+    prune_artifacts(now - ARTIFACT_MAX_AGE)
 
 
 @shared_task
 def all_niches_run_pipeline():
     """
-    Scheduled daily task to run topic pipeline for each niche
+    Scheduled daily task to run topic pipeline for each niche.
+    The niches run in parallel, as many at a time as there are workers,
+    and the last stage to end logs a summary of the run.
     """
+    prune_pipeline_data(datetime.utcnow())
+
     niches = (
         Niche.query.filter(and_(Niche.is_active, Niche.subreddits.any()))
             .order_by(Niche.title)
             .all()
     )
+    run_id = start_run([niche.id for niche in niches])
+    log.info(f"Starting topic pipeline run {run_id}: niches={len(niches)}")
 
     for niche in niches:
         log.info(f"Running topic model for niche: {niche.title}")
-        print(f"Running topic model for niche: {niche.title}")
-        run_topic_pipeline(niche.id)
+        run_topic_pipeline(niche.id, run_id)
+    return str(run_id)
 
 
-def run_topic_pipeline(niche_id):
+def run_topic_pipeline(niche_id, run_id=None):
     """
     Topic pipeline is done by chaining celery tasks, so different workers
     can process different steps of the pipeline.
+    The news and topic model chains of a niche are independent. Each ends
+    by recording that it's done, or its first failing task records the error,
+    so a failing niche doesn't stop the others.
     """
 
     # get trending topics from news api
     pipeline_news = chain(
         run_niche_trends.s(),
-        generate_modeled_topic_tweets.s()
-    )
+        generate_modeled_topic_tweets.s(),
+        end_pipeline_stage.si(run_id, niche_id, "news"),
+    ).on_error(fail_pipeline_stage.s(run_id, niche_id, "news"))
     pipeline_news.apply_async(args=(niche_id,))
 
     # get evergreen topics from reddit
     pipeline = chain(
+        refresh_niche_engagement.s(),
         run_niche_topic_model.s(),
         generate_niche_topic_overviews.s(niche_id),
         generate_modeled_topic_tweets.s(),
-    )
+        end_pipeline_stage.si(run_id, niche_id, "topics"),
+    ).on_error(fail_pipeline_stage.s(run_id, niche_id, "topics"))
     pipeline.apply_async(args=(niche_id,))
 
 
+@shared_task
+def end_pipeline_stage(run_id, niche_id, stage):
+    """
+    Last task of a pipeline chain: record that the niche's stage is done.
+    """
+    return end_stage(run_id, niche_id, stage)
+
+
+@shared_task
+def fail_pipeline_stage(request, exc, traceback, run_id, niche_id, stage):
+    """
+    Errback of a pipeline chain: record which task of the niche's stage
+    failed and why. The rest of the chain doesn't run.
+    """
+    log.error(f"Topic pipeline {stage} failed for niche {niche_id} in {request.task}: {exc!r}")
+    end_stage(run_id, niche_id, stage, error=f"{request.task}: {exc!r}")
+
+
 @shared_task
 def run_niche_trends(niche_id) -> List[uuid.UUID]:
     """
@@ -339,12 +610,32 @@ def run_niche_trends(niche_id) -> List[uuid.UUID]:
     terms = [t.term for t in niche.news_terms]
     print('niche terms', niche.title, ':', terms)
     # get trends
+    # fetch the articles of all terms at once, then find their topics
+    term_articles = {
+        done.job.key: done.result
+        for done in FetchScheduler().run(
+            FetchJob("newsapi", term, partial(fetch_news_articles, term))
+            for term in terms
+        )
+    }
     all_topics = []
+    writer = BatchWriter()
     for term in terms:
-        topic_labels, topic_articles = get_trends(term, niche.title)
+        if term_articles.get(term) is None:
+            continue
+        topic_labels, topic_articles = get_trends(
+            term, niche.title, articles=term_articles[term]
+        )
         print('topic_labels for term,', term, ':', topic_labels)
         if topic_labels is None:
             continue
+
+        # write the articles of all the term's topics at once,
+        # articles seen in earlier runs keep their ids
+        written = write_news_articles([
+            {"title": n["title"], "url": n["url"], "published_date": n["published_date"]}
+            for articles in topic_articles for n in articles
+        ])
         for i, title_desc in enumerate(topic_labels):
 
             # create modeled topic
@@ -357,25 +648,28 @@ def run_niche_trends(niche_id) -> List[uuid.UUID]:
                 "size": 0,
                 "trend_class": "trending",
             }
-
-            # create news articles
-            news_articles = []
-            for n in topic_articles[i]:
-                news_article = {"id": uuid.uuid4(), "title": n["title"], "url": n["url"],
-                                "published_date": n["published_date"]}
-                news_articles.append(news_article)
-
-            # write to db
-            write_news_articles(news_articles)
-            write_modeled_topic_with_news_article(
-                modeled_topic, [n["id"] for n in news_articles]
-            )
+            news_ids = list(dict.fromkeys(
+                written.ids[n["url"]] for n in topic_articles[i] if n["url"] in written.ids
+            ))
+            write_modeled_topic_with_news_article(modeled_topic, news_ids, writer)
             all_topics.append(modeled_topic)
 
+    writer.flush()
+    if topic.LLM_CACHE is not None:
+        log.info(f"LLM cache stats: {topic.LLM_CACHE.stats()}")
+    log.info(f"LLM token usage: {topic.TOKEN_USAGE.summary()}")
     return [t["id"] for t in all_topics]
 
 
-def build_topic_dicts(posts, source, niche):
+def build_topic_dicts(posts, source, niche, incremental=True, data_date=None):
+    """
+    Run the topic model over the posts of a niche and analyze the topics.
+    In incremental mode the posts are assigned to the niche's saved model,
+    which is only refit when its assignment has gone stale, and the trends
+    of its topics are updated with the days since the last run.
+    Every fit is archived under data_date, today by default. Other runs
+    reuse the archived fit of the same date and posts, e.g. a rerun backfill.
+    """
 
     if len(posts) < TOPIC_MODEL_MIN_DOCS:
         log.error(f"Not enough posts for topic model: niche={niche.title}")
@@ -383,18 +677,56 @@ def build_topic_dicts(posts, source, niche):
 
     post_dicts = [_to_dict(p) for p in posts]
     texts = [p["clean_text"] for p in post_dicts]
-
-    log.info(f"Building topic model: niche={niche.title}")
-    if source == "reddit":
-        topic_model = topic.build_subtopic_model(texts)
+    doc_ids = [str(p["id"]) for p in post_dicts]
+    key = f"{niche.id}/{source}"
+    archive = FitArchive(app.config["TOPIC_MODEL_DIR"])
+    data_date = data_date or datetime.utcnow().date()
+    incremental = incremental and app.config["TOPIC_MODEL_INCREMENTAL"]
+
+    saved = None if incremental else archive.find(key, data_date, doc_ids)
+    if saved is not None:
+        log.info(f"Reusing archived topic model fit: niche={niche.title} version={saved.version}")
+        topics, probs = saved.topics.tolist(), saved.probs.tolist()
+        topic_keywords, topic_rep_docs = saved.topic_keywords, saved.topic_rep_docs
+        trends = None
     else:
-        topic_model = topic.build_subtopic_model(texts, min_samples=5, min_cluster_size=5)
-    topics, probs = topic_model.topics_, topic_model.probabilities_
-    topic_keywords = topic_model.get_topic_info()["Representation"].tolist()
+        log.info(f"Building topic model: niche={niche.title}")
+        embeddings = encode_with_cache(TOPIC_ENCODER, texts, DBEmbeddingStore())
+        if source == "reddit":
+            fit = partial(topic.build_subtopic_model, texts, embeddings=embeddings)
+        else:
+            fit = partial(
+                topic.build_subtopic_model, texts, min_samples=5,
+                min_cluster_size=5, embeddings=embeddings
+            )
+
+        model_version = None
+        if incremental:
+            store = TopicModelStore(app.config["TOPIC_MODEL_DIR"])
+            topic_fit = fit_or_assign(store, key, texts, embeddings, fit)
+            topic_model = topic_fit.topic_model
+            topics, probs = topic_fit.topics, topic_fit.probs
+            # a refit renumbers the topics
+            trends = {} if topic_fit.refit else load_topic_trends(niche.id, source)
+            # the archived model of the saved model, unless it was just refit
+            model_version = (store.read_meta(key) or {}).get("archive_version")
+        else:
+            topic_model = fit()
+            topics, probs = topic_model.topics_, topic_model.probabilities_
+            trends = None
+        version = archive_fit(
+            archive, key, data_date, topic_model, topics, probs, embeddings, doc_ids, model_version
+        )
+        if incremental and version is not None and model_version is None:
+            store.update_meta(key, archive_version=version)
 
-    # TODO topic_rep_docs shouldn't be sent to the celery broker,
-    # it makes payload too large
-    topic_rep_docs = topic_model.get_topic_info()["Representative_Docs"].tolist()
+        topic_info = topic_model.get_topic_info()
+        topic_keywords = topic_info["Representation"].tolist()
+        topic_rep_docs = topic_info["Representative_Docs"].tolist()
+
+    engagement = daily_engagement_gains(
+        source, [p["id"] for p in post_dicts], datetime.utcnow() - TREND_WINDOW
+    )
     topic_dicts = topic.analyze_topics(
         topics,
         probs,
@@ -402,22 +734,59 @@ def build_topic_dicts(posts, source, niche):
         topic_rep_docs,
         post_dicts,
         source,
-        trend_prev_days=14,
+        trend_prev_days=TREND_WINDOW.days,
+        engagement=engagement,
+        trends=trends,
     )
+    if trends is not None:
+        save_topic_trends(
+            niche.id, source, trends, {t["topic_id"]: t["size"] for t in topic_dicts}
+        )
+        # ties the modeled topics to the saved model, for streamed updates
+        for t in topic_dicts:
+            t["model_topic_id"] = t["topic_id"]
+    log.info(f"Sentence model stats: {model_stats()}")
 
     return topic_dicts
 
 
+def archive_fit(archive, key, data_date, topic_model, topics, probs, embeddings, doc_ids, model_version):
+    """
+    Archive a topic model fit, see topic_model/fit_archive.py.
+    Failing to archive doesn't stop the pipeline. Returns the version.
+    """
+    try:
+        version = archive.save(
+            key, data_date, topic_model, topics, probs, embeddings, doc_ids,
+            model_version=model_version,
+        )
+        archive.prune(key, app.config["TOPIC_FIT_KEEP_DAYS"])
+    except Exception as e:
+        log.error(f"Error archiving topic model fit {key}: {e}")
+        return None
+    return version
+
+
 @shared_task
-def run_niche_topic_model(niche_id, date_from=None, date_to=None) -> List[dict]:
+def run_niche_topic_model(
+        niche_id, date_from=None, date_to=None, as_artifact=True
+) -> Union[dict, List[dict]]:
     """
     First step of topic pipeline:
     read recent posts for the niche and run the BERTopic model.
+
+    Returns a reference to the stored topic dicts, which are too large
+    to pass through the celery broker. Callers in the same process pass
+    as_artifact=False to get the topic dicts themselves.
     """
     print('building topics')
     niche = Niche.query.get(niche_id)
     sub_ids = [sub.id for sub in niche.subreddits]
     topic_dicts = []
+    # backfills over a fixed date range always do a full refit
+    backfill = date_from is not None and date_to is not None
+    # backfills are archived under the last day of their range
+    data_date = datetime.fromisoformat(str(date_to)).date() if backfill else None
     # what data do we want to use here?
 
     if niche.title in ["Entrepreneurship", "Marketing", "Personal Development"]:
@@ -437,7 +806,9 @@ def run_niche_topic_model(niche_id, date_from=None, date_to=None) -> List[dict]:
                 )
             ).all()
 
-        topic_dicts = build_topic_dicts(twitter_posts, "twitter", niche)
+        topic_dicts = build_topic_dicts(
+            twitter_posts, "twitter", niche, incremental=not backfill, data_date=data_date
+        )
         print(' in twitter, type of topic dict', type(topic_dicts))
 
     if date_from is not None and date_to is not None:
@@ -456,13 +827,33 @@ def run_niche_topic_model(niche_id, date_from=None, date_to=None) -> List[dict]:
             )
         ).all()
 
-    topic_dicts = topic_dicts + build_topic_dicts(reddit_posts, "reddit", niche)
-    return topic_dicts
+    topic_dicts = topic_dicts + build_topic_dicts(
+        reddit_posts, "reddit", niche, incremental=not backfill, data_date=data_date
+    )
+    if not as_artifact:
+        return topic_dicts
+    return put_artifact("topic_dicts", topic_dicts, niche_id=niche_id)
+
+
+def topic_post_texts(topic_dict: dict) -> List[str]:
+    """
+    Query the text of the representative posts for a topic
+    """
+    post_ids = topic_dict["post_ids"]
+    if topic_dict["source"] == "twitter":
+        posts_query = db.session.query(Tweet.clean_text).filter(
+            Tweet.id.in_(post_ids[:4])
+        )
+    else:
+        posts_query = db.session.query(RedditPost.clean_text).filter(
+            RedditPost.id.in_(post_ids[:4])
+        )
+    return [t for (t,) in posts_query.all()]
 
 
 @shared_task
 def generate_niche_topic_overviews(
-        topic_dicts: List[dict],
+        topic_dicts: Union[List[dict], dict],
         niche_id: uuid.UUID,
         max_modeled_topics=13,
         topic_date=None
@@ -470,61 +861,67 @@ def generate_niche_topic_overviews(
     """
     Second step of topic pipeline:
     given the output of run_niche_topic_model, generate modeled topics
-    and store them to the database.
+    and store them to the database. topic_dicts can also be a reference
+    to stored topic dicts.
 
     Returns list of modeled topic IDs that were created.
     """
     print('generating topic overview')
     print('type of topic_dicts', type(topic_dicts))
+    if is_artifact_ref(topic_dicts):
+        topic_dicts = get_artifact(topic_dicts)
 
     niche = Niche.query.get(niche_id)
     modeled_topic_ids = []
     count = 0
-    for topic_dict in topic_dicts:
-        if count >= max_modeled_topics:
-            break
-        # query the text of the representative posts for this topic
-        post_ids = topic_dict["post_ids"]
-
-        if topic_dict["source"] == "twitter":
-            posts_query = db.session.query(Tweet.clean_text).filter(
-                Tweet.id.in_(post_ids[:4])
-            )
-        else:
-            posts_query = db.session.query(RedditPost.clean_text).filter(
-                RedditPost.id.in_(post_ids[:4])
-            )
-
-        texts = [t for (t,) in posts_query.all()]
-
-        topic_label, topic_desc = topic.generate_topic_overview(
-            texts,
-            topic_dict["topic_keywords"],
-            topic_dict["topic_rep_docs"],
+    writer = BatchWriter()
+    remaining = list(topic_dicts)
+    while remaining and count < max_modeled_topics:
+        # label just enough topics concurrently to fill the remaining slots.
+        # Most topics are kept, so this is usually a single wave.
+        wave = remaining[:max_modeled_topics - count]
+        remaining = remaining[len(wave):]
+        overviews = topic.generate_topic_overviews(
+            [
+                (
+                    topic_post_texts(topic_dict),
+                    topic_dict["topic_keywords"],
+                    topic_dict["topic_rep_docs"],
+                )
+                for topic_dict in wave
+            ],
             niche.title,
         )
-        if topic_label == "" or topic_desc == "":
-            continue  # discard this topic
-        
-        if topic_date is None:
-            topic_date = datetime.now()
-        modeled_topic = {
-            "id": uuid.uuid4(),
-            "niche_id": niche_id,
-            "name": topic_label,
-            "description": topic_desc,
-            "date": topic_date,
-            "size": topic_dict["rank"],
-        }
-        if topic_dict["source"] == "twitter":
-            modeled_topic["trend_class"] = "twitter"
-            write_modeled_topic_with_twitter_posts(modeled_topic, post_ids)
-        else:
-            write_modeled_topic_with_reddit_posts(modeled_topic, post_ids)
-        modeled_topic_ids.append(modeled_topic["id"])
-        count += 1
 
+        for topic_dict, (topic_label, topic_desc) in zip(wave, overviews):
+            if topic_label == "" or topic_desc == "":
+                continue  # discard this topic
+
+            if topic_date is None:
+                topic_date = datetime.now()
+            post_ids = topic_dict["post_ids"]
+            modeled_topic = {
+                "id": uuid.uuid4(),
+                "niche_id": niche_id,
+                "name": topic_label,
+                "description": topic_desc,
+                "date": topic_date,
+                "size": topic_dict["rank"],
+                "model_topic_id": topic_dict.get("model_topic_id"),
+            }
+            if topic_dict["source"] == "twitter":
+                modeled_topic["trend_class"] = "twitter"
+                write_modeled_topic_with_twitter_posts(modeled_topic, post_ids, writer)
+            else:
+                write_modeled_topic_with_reddit_posts(modeled_topic, post_ids, writer)
+            modeled_topic_ids.append(modeled_topic["id"])
+            count += 1
+
+    writer.flush()
     log.info(f"{count} modeled topics created: niche={niche_id}")
+    if topic.LLM_CACHE is not None:
+        log.info(f"LLM cache stats: {topic.LLM_CACHE.stats()}")
+    log.info(f"LLM token usage: {topic.TOKEN_USAGE.summary()}")
     return modeled_topic_ids
 
 
@@ -535,6 +932,7 @@ def generate_modeled_topic_tweets(modeled_topic_ids):
     generate tweets for each modeled topic
     """
     print('type of modeled_topic_ids', type(modeled_topic_ids))
+    writer = BatchWriter()
     for mt_id in modeled_topic_ids:
         modeled_topic = ModeledTopic.query.get(mt_id)
         generated_tweets = topic.generate_tweets_for_topic(
@@ -548,7 +946,9 @@ def generate_modeled_topic_tweets(modeled_topic_ids):
         log.info(
             f"generated {num_tweets} tweets for modeled topic: {modeled_topic.name}"
         )
-        write_generated_posts(generated_tweets)
+        write_generated_posts(generated_tweets, writer)
+    writer.flush()
+    log.info(f"LLM token usage: {topic.TOKEN_USAGE.summary()}")
 
 
 @shared_task
@@ -581,21 +981,18 @@ def generate_niche_gpt_topics(niche_id):
         post["modeled_topic_id"] = modeled_topic["id"]
 
     log.info(f"Created topic and post dicts")
-    write_modeled_overview(modeled_topics)
-    write_generated_posts(generated_tweets)
+    writer = BatchWriter()
+    writer.add_all(ModeledTopic, modeled_topics)
+    write_generated_posts(generated_tweets, writer)
+    writer.flush()
     log.info(f"Written topic and post dicts to db")
 
 def write_modeled_overview(topic_overviews: List[dict]) -> None:
     """
     """
-    for topic in topic_overviews:
-        try:
-            db.session.add(ModeledTopic(**topic))
-        except exc.SQLAlchemyError as e:
-            db.session.rollback()
-            log.error(f"Database error occurred: {e}")
-        else:
-            db.session.commit()
+    writer = BatchWriter()
+    writer.add_all(ModeledTopic, topic_overviews)
+    writer.flush()
     log.info(f"wrote overview for {len(topic_overviews)} modeled topics.")
 
 
@@ -603,77 +1000,17 @@ def write_modeled_overview(topic_overviews: List[dict]) -> None:
 def post_scheduled_tweets():
     '''
     Retrieve any scheduled tweets that need to be posted from the DB
-    and post them to twitter.
+    and post them to twitter. The scheduler daemon posts them as they're
+    due instead, see tweet_dispatcher.py.
     '''
-    scheduled_posts = (
-        ScheduledPost.query.filter(
-            and_(
-                ScheduledPost.posted_at.is_(None),
-                ScheduledPost.scheduled_for < datetime.now()
-            )
+    due_ids = db.session.scalars(
+        select(ScheduledPost.id).where(
+            ScheduledPost.posted_at.is_(None),
+            # scheduled_for is written in UTC
+            ScheduledPost.scheduled_for < datetime.utcnow(),
         )
-            .order_by(
-            ScheduledPost.user_id, ScheduledPost.scheduled_for
-        )
-            .all()
-    )
-    if not scheduled_posts:
-        log.info("no tweets to schedule")
-        return
-
-    # post the tweets grouped by user
-    uid_to_posts = {}
-    for p in scheduled_posts:
-        uid = p.user_id
-        if uid not in uid_to_posts.keys():
-            uid_to_posts[uid] = []
-        uid_to_posts[uid].append(p)
-
-    for user_id, posts in uid_to_posts.items():
-        oauth_sess = oauth_session_by_user(user_id)
-        if oauth_sess is None or oauth_sess.access_token is None \
-           or oauth_sess.access_token_secret is None:
-            log.error(
-                f"no twitter credentials found for user: user_id={user_id}"
-            )
-            continue
-
-        client = tweepy.Client(
-            consumer_key=app.config["TWITTER_API_KEY"],
-            consumer_secret=app.config["TWITTER_API_KEY_SECRET"],
-            access_token=oauth_sess.access_token,
-            access_token_secret=oauth_sess.access_token_secret,
-            wait_on_rate_limit=True,
-        )
-
-        num_posted = 0
-        for p in posts:
-            post_edit = latest_post_edit(p.generated_post_id, user_id)
-            if post_edit is None:
-                gp = GeneratedPost.query.get(p.generated_post_id)
-                post_text = gp.text
-            else:
-                post_text = post_edit.text
-
-            try:
-                resp = client.create_tweet(text=post_text)
-            except (tweepy.errors.BadRequest, tweepy.errors.Unauthorized) as e:
-                log.error(
-                    f"error posting tweet for user_id={user_id}: {e}"
-                )
-                break
-
-            p.tweet_id = resp.data["id"]
-            p.posted_at = datetime.now()
-            db.session.add(p)
-            db.session.commit()
-            num_posted += 1
-        # endfor
-
-        log.info(
-            f"posted {num_posted} tweets for user_id={user_id}"
-        )
-    # endfor
+    ).all()
+    post_scheduled(due_ids)
 
 
 def clean_all_generated_tweets():
@@ -0,0 +1,324 @@
+'''
+Posting of scheduled tweets, at the time they're scheduled for.
+
+The dispatcher keeps a min-heap of the times the unposted tweets are due,
+so the scheduler daemon can sleep until exactly the next one. The web app
+notifies the dispatcher through a postgres NOTIFY when a post is scheduled
+or unscheduled, and only that post is re-read. The table is read in full
+at start up and every RESYNC_INTERVAL, in case a notification is missed.
+
+scheduled_for is written in UTC, see routes.schedule_post.
+'''
+import heapq
+import logging
+import select as io_select
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import requests
+import tweepy
+from flask import current_app as app
+from sqlalchemy import exc, func, select, update
+
+from .models import ScheduledPost, db
+from .queries import oauth_sessions_by_user, scheduled_post_texts
+
+log = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = "scheduled_post"
+# a tweet that failed to post is retried after this long
+RETRY_INTERVAL = timedelta(minutes=5)
+# full re-read of the unposted tweets, for notifications missed
+# while the listener was reconnecting
+RESYNC_INTERVAL = timedelta(minutes=15)
+# wait before reconnecting the listener after an error
+RECONNECT_DELAY = 5
+
+
+def notify_scheduled_post(scheduled_post_id) -> None:
+    '''
+    Tell the dispatcher a scheduled post was added, changed or deleted.
+    Call it in the transaction making the change, the notification is
+    only sent when it commits.
+    '''
+    db.session.execute(
+        func.pg_notify(NOTIFY_CHANNEL, str(scheduled_post_id)).select()
+    )
+
+
+class TwitterClients:
+    '''
+    tweepy clients by user, reused while the user's access token doesn't
+    change. tweepy.Client holds a requests session, so reusing it reuses
+    the connection to twitter too.
+    '''
+
+    def __init__(self):
+        self._clients: Dict[object, Tuple[tuple, tweepy.Client]] = {}
+
+    def get(self, user_id, access_token, access_token_secret) -> tweepy.Client:
+        tokens = (access_token, access_token_secret)
+        cached = self._clients.get(user_id)
+        if cached is not None and cached[0] == tokens:
+            return cached[1]
+        client = tweepy.Client(
+            consumer_key=app.config["TWITTER_API_KEY"],
+            consumer_secret=app.config["TWITTER_API_KEY_SECRET"],
+            access_token=access_token,
+            access_token_secret=access_token_secret,
+            wait_on_rate_limit=True,
+        )
+        self._clients[user_id] = (tokens, client)
+        return client
+
+    def drop(self, user_id) -> None:
+        self._clients.pop(user_id, None)
+
+
+def post_scheduled(scheduled_post_ids: Iterable[int], clients: Optional[TwitterClients] = None) -> Tuple[List[int], List[int]]:
+    '''
+    Post the scheduled tweets to twitter, grouped by user.
+    The texts and the users' credentials are read in one query each.
+    After an error, from twitter, the connection or saving a posted
+    tweet, the user's remaining tweets are left for a retry.
+    Returns the ids posted and the ids left unposted.
+    '''
+    clients = clients or TwitterClients()
+    # plain rows rather than models, which would be reloaded after
+    # every commit
+    rows = scheduled_post_texts(list(scheduled_post_ids))
+    if not rows:
+        log.info("no tweets to schedule")
+        return [], []
+
+    uid_to_posts = {}
+    for post_id, user_id, text in rows:
+        uid_to_posts.setdefault(user_id, []).append((post_id, text))
+    tokens = {
+        user_id: (s.access_token, s.access_token_secret)
+        for user_id, s in oauth_sessions_by_user(list(uid_to_posts)).items()
+    }
+
+    posted, unposted = [], []
+    for user_id, posts in uid_to_posts.items():
+        access_token, access_token_secret = tokens.get(user_id, (None, None))
+        if access_token is None or access_token_secret is None:
+            log.error(
+                f"no twitter credentials found for user: user_id={user_id}"
+            )
+            unposted.extend(post_id for post_id, _ in posts)
+            continue
+
+        client = clients.get(user_id, access_token, access_token_secret)
+        num_posted = 0
+        for i, (post_id, text) in enumerate(posts):
+            try:
+                resp = client.create_tweet(text=text)
+            except (tweepy.errors.TweepyException, requests.RequestException) as e:
+                log.error(
+                    f"error posting tweet for user_id={user_id}: {e!r}"
+                )
+                if isinstance(e, tweepy.errors.Unauthorized):
+                    clients.drop(user_id)
+                unposted.extend(q for q, _ in posts[i:])
+                break
+            # it's on twitter, whether or not it's saved
+            posted.append(post_id)
+            num_posted += 1
+
+            # committed per tweet, so a crash can't post it twice
+            try:
+                db.session.execute(
+                    update(ScheduledPost)
+                    .where(ScheduledPost.id == post_id)
+                    .values(tweet_id=resp.data["id"], posted_at=datetime.now())
+                )
+                db.session.commit()
+            except exc.SQLAlchemyError as e:
+                db.session.rollback()
+                log.error(
+                    f"error saving posted tweet_id={resp.data['id']} of "
+                    f"scheduled_post_id={post_id}: {e}"
+                )
+                unposted.extend(q for q, _ in posts[i + 1:])
+                break
+
+        log.info(
+            f"posted {num_posted} tweets for user_id={user_id}"
+        )
+    return posted, unposted
+
+
+def _utc(dt: datetime) -> datetime:
+    return dt.replace(tzinfo=timezone.utc)
+
+
+class TweetDispatcher:
+    '''
+    Min-heap of the unposted scheduled tweets by due time.
+    Entries are never removed from the middle of the heap: a post that is
+    rescheduled or unscheduled gets a new entry or none in `due_at`, and
+    heap entries that don't match it are dropped when they reach the top.
+    Tweets that failed to post are due again at their retry time, which
+    `retry_at` keeps over a resync.
+    '''
+
+    def __init__(self):
+        self.clients = TwitterClients()
+        self._heap: List[Tuple[datetime, int]] = []
+        self._due_at: Dict[int, datetime] = {}
+        self._retry_at: Dict[int, datetime] = {}
+        self._lock = threading.Lock()
+        self._on_change: Optional[Callable[[], None]] = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def sync(self) -> int:
+        '''Re-read all unposted scheduled tweets. Returns how many there are.'''
+        rows = db.session.execute(
+            select(ScheduledPost.id, ScheduledPost.scheduled_for).where(
+                ScheduledPost.posted_at.is_(None),
+                ScheduledPost.scheduled_for.is_not(None),
+            )
+        ).all()
+        db.session.commit()
+        with self._lock:
+            # a pending retry is kept if it's later than scheduled_for
+            self._due_at = {
+                post_id: max(_utc(at), self._retry_at.get(post_id, _utc(at)))
+                for post_id, at in rows
+            }
+            self._retry_at = {
+                post_id: at for post_id, at in self._retry_at.items() if post_id in self._due_at
+            }
+            self._heap = [(at, post_id) for post_id, at in self._due_at.items()]
+            heapq.heapify(self._heap)
+        return len(rows)
+
+    def refresh(self, post_ids: Iterable[int]) -> None:
+        '''Re-read the posts a notification was sent for.'''
+        post_ids = set(post_ids)
+        rows = db.session.execute(
+            select(ScheduledPost.id, ScheduledPost.scheduled_for).where(
+                ScheduledPost.id.in_(post_ids),
+                ScheduledPost.posted_at.is_(None),
+                ScheduledPost.scheduled_for.is_not(None),
+            )
+        ).all()
+        db.session.commit()
+        with self._lock:
+            # the post was changed, it's due when it's now scheduled for
+            for post_id in post_ids:
+                self._due_at.pop(post_id, None)
+                self._retry_at.pop(post_id, None)
+            for post_id, at in rows:
+                self._push(post_id, _utc(at))
+
+    def _push(self, post_id: int, at: datetime) -> None:
+        self._due_at[post_id] = at
+        heapq.heappush(self._heap, (at, post_id))
+
+    def _drop_stale(self) -> None:
+        while self._heap and self._due_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_due(self, after: Optional[datetime] = None) -> Optional[datetime]:
+        '''When the next tweet is due, in UTC, or None if there's none.'''
+        with self._lock:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> List[int]:
+        '''Take the ids of the tweets due at now off the heap.'''
+        due = []
+        with self._lock:
+            self._drop_stale()
+            while self._heap and self._heap[0][0] <= now:
+                _, post_id = heapq.heappop(self._heap)
+                del self._due_at[post_id]
+                self._retry_at.pop(post_id, None)
+                due.append(post_id)
+                self._drop_stale()
+        return due
+
+    def post_due(self) -> None:
+        '''Post the tweets that are due. Tweets that fail are retried later.'''
+        now = datetime.now(timezone.utc)
+        due = self.pop_due(now)
+        if not due:
+            return
+        posted = []
+        try:
+            posted, _ = post_scheduled(due, self.clients)
+        finally:
+            # everything not posted, including after an unexpected error,
+            # is off the heap and must go back on it
+            retry_at = now + RETRY_INTERVAL
+            with self._lock:
+                for post_id in set(due).difference(posted):
+                    # a notification may have rescheduled it meanwhile
+                    if post_id not in self._due_at:
+                        self._push(post_id, retry_at)
+                        self._retry_at[post_id] = retry_at
+
+    def start(self, flask_app, on_change: Callable[[], None]) -> None:
+        '''
+        Read the unposted tweets and listen for changes in a thread,
+        calling on_change when the next due time may have moved.
+        '''
+        self._on_change = on_change
+        self._thread = threading.Thread(
+            target=self._listen, args=(flask_app,), name="tweet-dispatcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _listen(self, flask_app) -> None:
+        with flask_app.app_context():
+            while not self._stopped.is_set():
+                try:
+                    self._listen_once()
+                except Exception as e:
+                    log.error(f"Tweet dispatcher listener failed, reconnecting: {e!r}")
+                    db.session.rollback()
+                    self._stopped.wait(RECONNECT_DELAY)
+
+    def _listen_once(self) -> None:
+        # a connection of its own, outside the pool: it's in autocommit
+        # mode and blocks on notifications
+        conn = db.engine.raw_connection()
+        dbapi_conn = conn.driver_connection
+        conn.detach()
+        try:
+            dbapi_conn.autocommit = True
+            with dbapi_conn.cursor() as cur:
+                cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            # changes made before LISTEN weren't notified
+            log.info(f"Tweet dispatcher listening: unposted={self.sync()}")
+            self._changed()
+            last_sync = time.monotonic()
+            while not self._stopped.is_set():
+                timeout = RESYNC_INTERVAL.total_seconds() - (time.monotonic() - last_sync)
+                # wakes up at least once a second to check for stop
+                readable, _, _ = io_select.select([dbapi_conn], [], [], min(max(timeout, 0), 1))
+                if readable:
+                    dbapi_conn.poll()
+                    post_ids = {int(n.payload) for n in dbapi_conn.notifies}
+                    dbapi_conn.notifies.clear()
+                    if post_ids:
+                        self.refresh(post_ids)
+                        self._changed()
+                elif time.monotonic() - last_sync >= RESYNC_INTERVAL.total_seconds():
+                    self.sync()
+                    self._changed()
+                    last_sync = time.monotonic()
+        finally:
+            conn.close()
+
+    def _changed(self) -> None:
+        if self._on_change is not None:
+            self._on_change()
@@ -1,16 +1,19 @@
 import pandas as pd
+import calendar
 import logging
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 import tweepy
 import time
 from flask import current_app as app
-from typing import Union, List
-import emoji
-import nltk
+from typing import Dict, List, Optional, Union
 from sqlalchemy.orm import Query
-from sqlalchemy import exc, insert, and_
-import re
-from topic_model.util import normalise_tweet, parse_html
+from sqlalchemy import and_, func
+from topic_model.util import clean_tweet  # noqa: F401
+from .batch_writer import BatchWriter
+from .fetch_scheduler import api_session
+from .ingest import UpsertResult, bulk_upsert
+from .rate_limit import rate_limiter
 from .models import (
     db,
     Niche, ModeledTopic, GeneratedPost,
@@ -19,6 +22,16 @@ from .models import (
 )
 
 log = logging.getLogger(__name__)
+# tweets per recent search page, the API allows 10 to 100
+SEARCH_PAGE_SIZE = 100
+MIN_SEARCH_RESULTS = 10
+RECENT_SEARCH_WINDOW = timedelta(days=7)
+# tweet ids hold milliseconds since this epoch in their top bits
+TWITTER_EPOCH_MS = 1288834974657
+# weight of the latest fetch in a term's smoothed yield
+YIELD_SMOOTHING = 0.3
+# smallest budget weight of a term, so it keeps being sampled
+MIN_TERM_WEIGHT = 0.05
 TWITTER_USERS_CSV = "data/all_competitor_followers.csv"
 AUTO_DM_MESSAGE = """Hi!. I can see you're building your X following.
 
@@ -46,7 +59,7 @@ class X_Caller:
         self.client = self.create_client()
 
     def create_client(self):
-        return tweepy.Client(
+        client = tweepy.Client(
             bearer_token=app.config["TWITTER_BEARER_TOKEN"],
             consumer_key=app.config["TWITTER_CLIENT_ID"],
             consumer_secret=app.config["TWITTER_CLIENT_SECRET"],
@@ -54,6 +67,10 @@ class X_Caller:
             access_token_secret=app.config["TWITTER_ACCESS_TOKEN_SECRET"],
             wait_on_rate_limit=True,
         )
+        session = api_session()
+        if session is not None:
+            client.session = session
+        return client
 
     def auto_dm(self, user_id, message):
 
@@ -141,8 +158,12 @@ class X_Caller:
 
         return tweet_dicts
 
-    def search_tweets(self, search_term, max_results=100):
-        """Search tweets on twitter from the last 7 days using search term """
+    def search_tweets(self, search_term, max_results=100, since_id=None):
+        """
+        Search tweets on twitter from the last 7 days using search term,
+        newest first, paging until max_results tweets are read.
+        With since_id only tweets newer than that tweet are returned.
+        """
 
         """
         [attachments,author_id,card_uri,context_annotations,conversation_id,created_at,
@@ -151,14 +172,37 @@ class X_Caller:
         public_metrics,referenced_tweets,reply_settings,source,text,withheld]
         """
 
-        # This endpoint/method returns Tweets from the last seven days
-        max_results = min(100, max_results)
-        response = self.client.search_recent_tweets(search_term, tweet_fields=['created_at', 'public_metrics', 'author_id'], max_results=max_results)
-        # The method returns a Response object, a named tuple with data, includes,
-        # errors, and meta fields
+        # This endpoint/method returns Tweets from the last seven days,
+        # and rejects a since_id older than that
+        if since_id is not None and snowflake_time(since_id) < datetime.utcnow() - RECENT_SEARCH_WINDOW:
+            since_id = None
+        tweets = []
+        next_token = None
+        limiter = rate_limiter("twitter")
+        while len(tweets) < max_results:
+            # every tweet returned counts against the monthly cap,
+            # so the last page only asks for what's left, and a remainder
+            # below the smallest page isn't fetched
+            if max_results - len(tweets) < MIN_SEARCH_RESULTS:
+                break
+            page_size = min(SEARCH_PAGE_SIZE, max_results - len(tweets))
+            limiter.acquire()
+            response = self.client.search_recent_tweets(
+                search_term,
+                tweet_fields=['created_at', 'public_metrics', 'author_id'],
+                max_results=page_size,
+                since_id=since_id,
+                next_token=next_token,
+            )
+            # The method returns a Response object, a named tuple with data, includes,
+            # errors, and meta fields
 
-        # The data field of the Response returned is a list of Tweets that need to be reformatted
-        tweets = self.clean_tweet_response(response)
+            # The data field of the Response returned is a list of Tweets that need to be reformatted
+            if response.data:
+                tweets += self.clean_tweet_response(response)
+            next_token = (response.meta or {}).get("next_token")
+            if next_token is None:
+                break
 
         return tweets
 
@@ -186,73 +230,36 @@ class X_Caller:
         return "FALSE"
 
 
-def write_twitter_posts(posts: List[dict]) -> int:
-    num_written = 0
+def write_twitter_posts(posts: List[dict]) -> UpsertResult:
+    '''
+    Insert new tweets and refresh the metrics of tweets
+    that were fetched before.
+    '''
     for post in posts:
-        record = (
-            db.session.query(Tweet)
-            .filter(Tweet.id == post["id"])
-            .first()
-        )
-        if record is None:
-            record = Tweet(**post)
-            try:
-                db.session.add(record)
-            except exc.SQLAlchemyError as e:
-                db.session.rollback()
-                log.error(f"Error writing twitter post: {e}")
-            else:
-                db.session.commit()
-                num_written += 1
-    return num_written
-
-
-def write_generated_posts(generated_posts: List[dict]) -> None:
-    """
-    """
-    for post in generated_posts:
-        record = GeneratedPost(**post)
-        try:
-            db.session.add(record)
-        except exc.SQLAlchemyError as e:
-            db.session.rollback()
-            log.error(f"Database error occurred: {e}")
-        else:
-            db.session.commit()
+        post["updated_at"] = datetime.utcnow()
+    return bulk_upsert(
+        Tweet, posts, ["id"],
+        update_columns=["likes", "retweets", "updated_at"],
+    )
 
 
 def write_modeled_topic_with_twitter_posts(
         topic: dict,
-        post_ids: List[int]
+        post_ids: List,
+        writer: Optional[BatchWriter] = None,
 ) -> None:
     '''
-    Save a modeled topic to the database and associate twitter IDs
-    with the topic.
+    Save a modeled topic and associate tweets with the topic.
+    With a writer the rows are only added to it, to be flushed by the caller.
     '''
-    modeled_topic = ModeledTopic(**topic)
-    try:
-        db.session.add(modeled_topic)
-    except exc.SQLAlchemyError as e:
-        db.session.rollback()
-        log.error(f"Database error occured: {e}")
-    else:
-        db.session.commit()
-
-    try:
-        print('pids to execute: ', post_ids)
-        db.session.execute(
-            insert(tweet_modeled_topic_assoc),
-            [
-                {"tweet_id": pid, "modeled_topic_id": modeled_topic.id}
-                for pid in post_ids
-            ],
-        )
-        print('pids done: ', post_ids)
-    except exc.SQLAlchemyError as e:
-        db.session.rollback()
-        log.error(f"Database error occured: {e}")
-    else:
-        db.session.commit()
+    batch = writer if writer is not None else BatchWriter()
+    modeled_topic = batch.add(ModeledTopic, dict(topic))
+    batch.add_all(tweet_modeled_topic_assoc, [
+        {"tweet_id": pid, "modeled_topic_id": modeled_topic["id"]}
+        for pid in post_ids
+    ])
+    if writer is None:
+        batch.flush()
 
 def twitter_posts_for_topic_query(topic_id) -> Query:
     '''
@@ -297,31 +304,161 @@ def get_top_twitter_posts_for_niches(niches, num_posts=200):
     return top_twitter_posts
 
 
-def clean_tweet(tweet: str) -> str:
-    tweet = re.sub("@[A-Za-z0-9]+","",tweet) #Remove @ sign
-    tweet = re.sub(r"(?:\@|http?\://|https?\://|www)\S+", "", tweet) #Remove http links
-    tweet = " ".join(tweet.split())
-    tweet = emoji.replace_emoji(tweet, replace='')
-    return tweet
-
-
 def write_twitter_modeled_overview(topic_overviews: List[dict]) -> None:
     """
     """
-    for topic in topic_overviews:
-        try:
-            db.session.add(ModeledTopic(**topic))
-        except exc.SQLAlchemyError as e:
-            db.session.rollback()
-            log.error(f"Database error occurred: {e}")
-        else:
-            db.session.commit()
+    writer = BatchWriter()
+    writer.add_all(ModeledTopic, topic_overviews)
+    writer.flush()
     log.info(f"wrote overview for {len(topic_overviews)} modeled topics.")
 
 
-def get_twitter_posts_from_term(search_term: str, num_posts) -> List[dict]:
-    x_caller = X_Caller()
-    num_posts = min(100, num_posts)
-    tweet_dicts = x_caller.search_tweets(search_term, max_results=num_posts)
-    return tweet_dicts
+@lru_cache(maxsize=1)
+def get_x_caller() -> X_Caller:
+    '''
+    X_Caller for fetching, created on first use and shared by the fetch threads.
+    '''
+    return X_Caller()
+
+
+def get_twitter_posts_from_term(search_term: str, num_posts, since_id=None) -> List[dict]:
+    return get_x_caller().search_tweets(
+        search_term, max_results=num_posts, since_id=since_id
+    )
+
+
+def fetch_tweet_engagement(tweet_ids: List[int]) -> Dict[int, dict]:
+    '''
+    Current likes and retweets of tweets, looked up by id
+    SEARCH_PAGE_SIZE at a time. Deleted tweets are left out.
+    Every tweet returned counts against the monthly cap.
+    '''
+    engagement = {}
+    client = get_x_caller().client
+    limiter = rate_limiter("twitter")
+    for i in range(0, len(tweet_ids), SEARCH_PAGE_SIZE):
+        limiter.acquire()
+        response = client.get_tweets(
+            ids=tweet_ids[i:i + SEARCH_PAGE_SIZE], tweet_fields=["public_metrics"]
+        )
+        for tweet in response.data or []:
+            engagement[tweet.id] = {
+                "likes": tweet.public_metrics["like_count"],
+                "retweets": tweet.public_metrics["retweet_count"],
+            }
+    return engagement
+
+
+def snowflake_time(tweet_id: int) -> datetime:
+    '''UTC time a tweet id was created, from the timestamp in its top bits.'''
+    return datetime.utcfromtimestamp(((tweet_id >> 22) + TWITTER_EPOCH_MS) / 1000)
+
+
+def is_engaging(post: dict) -> bool:
+    # same filter the topic model reads tweets with
+    return (post["likes"] or 0) >= 1 and (post["retweets"] or 0) >= 1
+
+
+def useful_posts(posts: List[dict], written: UpsertResult) -> int:
+    '''
+    Number of fetched tweets that were new, engaging and not a copy of
+    another tweet in the batch.
+    '''
+    texts = set()
+    useful = 0
+    for p in posts:
+        if p["id"] not in written.new_keys or not is_engaging(p):
+            continue
+        if not p["clean_text"] or p["clean_text"] in texts:
+            continue
+        texts.add(p["clean_text"])
+        useful += 1
+    return useful
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def twitter_daily_budget(monthly_posts: int, today: date) -> int:
+    '''
+    Tweets that can be read today: what's left of this month's cap,
+    spread over the days left in the month.
+    '''
+    read = db.session.query(
+        func.coalesce(func.sum(TwitterTerm.posts_read_month), 0)
+    ).filter(TwitterTerm.budget_month == month_start(today)).scalar()
+    days_left = calendar.monthrange(today.year, today.month)[1] - today.day + 1
+    return max(0, int((monthly_posts - read) / days_left))
+
+
+def allocate_twitter_budget(terms: List[TwitterTerm], total_posts: int) -> Dict:
+    '''
+    Split total_posts across terms in proportion to their yield of useful
+    tweets. Terms without a yield yet get the average, and every term keeps
+    a small share so a quiet term can earn its budget back.
+    A search reads at least MIN_SEARCH_RESULTS tweets, so a funded term gets
+    at least that many. When the budget can't cover every term, only the
+    highest weight ones are funded. The allocations never add up to more
+    than total_posts.
+    Returns term id -> tweets to read.
+    '''
+    allocation = {t.id: 0 for t in terms}
+    if len(terms) == 0 or total_posts < MIN_SEARCH_RESULTS:
+        return allocation
+    known = [t.yield_rate for t in terms if t.yield_rate is not None]
+    prior = sum(known) / len(known) if known else 1.0
+    weights = {
+        t.id: max(MIN_TERM_WEIGHT, prior if t.yield_rate is None else t.yield_rate)
+        for t in terms
+    }
+    funded = sorted(weights, key=weights.get, reverse=True)[:total_posts // MIN_SEARCH_RESULTS]
+    # terms whose share is under the minimum get the minimum,
+    # the others split what's left by weight
+    floored = set()
+    while True:
+        rest = [term_id for term_id in funded if term_id not in floored]
+        left = total_posts - MIN_SEARCH_RESULTS * len(floored)
+        rest_weight = sum(weights[term_id] for term_id in rest)
+        low = {
+            term_id for term_id in rest
+            if left * weights[term_id] / rest_weight < MIN_SEARCH_RESULTS
+        }
+        if not low:
+            break
+        floored |= low
+    for term_id in floored:
+        allocation[term_id] = MIN_SEARCH_RESULTS
+    for term_id in rest:
+        allocation[term_id] = int(left * weights[term_id] / rest_weight)
+    return allocation
+
+
+def advance_term(
+        twitter_term: TwitterTerm,
+        posts: List[dict],
+        written: UpsertResult,
+        now: datetime,
+) -> None:
+    '''
+    Move the term's since_id to the newest fetched tweet, count the tweets
+    against this month's budget and update the term's yield.
+    The caller commits.
+    '''
+    if twitter_term.budget_month != month_start(now.date()):
+        twitter_term.budget_month = month_start(now.date())
+        twitter_term.posts_read_month = 0
+    twitter_term.posts_read_month = (twitter_term.posts_read_month or 0) + len(posts)
+    if len(posts) > 0:
+        newest = max(p["id"] for p in posts)
+        twitter_term.since_id = max(newest, twitter_term.since_id or 0)
+        observed = useful_posts(posts, written) / len(posts)
+        if twitter_term.yield_rate is None:
+            twitter_term.yield_rate = observed
+        else:
+            twitter_term.yield_rate = (
+                YIELD_SMOOTHING * observed
+                + (1 - YIELD_SMOOTHING) * twitter_term.yield_rate
+            )
+    twitter_term.last_fetched_at = now
 
@@ -0,0 +1,117 @@
+'''
+Compare the daily full refit of the topic model with incremental mode.
+
+Replays the last --days nightly runs for a niche over its reddit posts.
+For each mode it reports wall time per run and topic stability, the adjusted
+Rand index of the assignments of posts that are in consecutive windows.
+It also reports how well incremental assignments agree with a full refit.
+
+usage: python scripts/benchmark_incremental_topics.py "Marketing" --days 7
+'''
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pickr_flask import init_app  # noqa: E402
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def stability(prev: dict, curr: dict) -> float:
+    '''ARI over the posts assigned in both runs.'''
+    common = sorted(set(prev) & set(curr))
+    if len(common) < 2:
+        return float("nan")
+    return adjusted_rand_score(
+        [prev[i] for i in common], [curr[i] for i in common]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("niche")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--window", type=int, default=7)
+    args = parser.parse_args()
+
+    app = init_app()
+    with app.app_context():
+        from topic_model import topic
+        from topic_model.embedding_cache import encode_with_cache
+        from topic_model.incremental import TopicModelStore, fit_or_assign
+        from topic_model.model_registry import TOPIC_ENCODER
+        from pickr_flask.embedding_store import DBEmbeddingStore
+        from pickr_flask.models import Niche, RedditPost
+
+        niche = Niche.query.filter(Niche.title == args.niche).one()
+        sub_ids = [s.id for s in niche.subreddits]
+        end = datetime.now()
+        start = end - timedelta(days=args.days + args.window)
+        posts = (
+            RedditPost.query
+            .filter(
+                RedditPost.subreddit_id.in_(sub_ids),
+                RedditPost.created_at > start,
+            )
+            .order_by(RedditPost.created_at)
+            .all()
+        )
+        texts = [p.clean_text for p in posts]
+        # embeddings are shared by both modes, so they are not timed
+        embeddings = encode_with_cache(TOPIC_ENCODER, texts, DBEmbeddingStore())
+        created = np.array([p.created_at for p in posts])
+        print(f"{len(posts)} posts for niche {niche.title}")
+
+        store = TopicModelStore(tempfile.mkdtemp(prefix="topic_bench_"))
+        results = {"full": [], "incremental": []}
+        prev = {"full": {}, "incremental": {}}
+        for day in range(args.days, 0, -1):
+            run_date = end - timedelta(days=day)
+            mask = (created > run_date - timedelta(days=args.window)) & (created <= run_date)
+            idx = np.flatnonzero(mask)
+            window_texts = [texts[i] for i in idx]
+            window_emb = embeddings[idx]
+            fit = lambda: topic.build_subtopic_model(window_texts, embeddings=window_emb)  # noqa: E731
+
+            t0 = time.perf_counter()
+            full_topics = fit().topics_
+            full_secs = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            inc = fit_or_assign(store, "bench", window_texts, window_emb, fit)
+            inc_secs = time.perf_counter() - t0
+
+            curr = {
+                "full": dict(zip(idx, full_topics)),
+                "incremental": dict(zip(idx, inc.topics)),
+            }
+            for mode, secs in (("full", full_secs), ("incremental", inc_secs)):
+                results[mode].append((secs, stability(prev[mode], curr[mode])))
+            prev = curr
+            print(
+                f"{run_date.date()} docs={len(idx):5d} "
+                f"full={full_secs:6.1f}s incremental={inc_secs:6.1f}s "
+                f"refit={inc.refit!s:5} {inc.reason} "
+                f"agreement={adjusted_rand_score(full_topics, inc.topics):.2f}"
+            )
+
+        for mode, rows in results.items():
+            secs = [r[0] for r in rows]
+            stab = [r[1] for r in rows[1:]]
+            print(
+                f"{mode:12s} total={sum(secs):7.1f}s mean={np.mean(secs):6.1f}s "
+                f"stability={np.nanmean(stab) if stab else float('nan'):.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
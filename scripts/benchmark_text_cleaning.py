@@ -0,0 +1,105 @@
+'''
+Benchmark of the ingest text cleaners on the example tweets.
+
+Builds a corpus from tweet_examples.txt and long_tweet_examples.txt, plus
+copies with HTML markup, emoji and links so every branch is exercised. It
+reports docs/sec for the previous cleaners (kept here as legacy_*), for the
+single-pass cleaners, and for the batch API with a process pool. It also
+checks that the outputs match.
+
+usage: python scripts/benchmark_text_cleaning.py [--docs 20000] [--processes 4]
+'''
+import argparse
+import itertools
+import os
+import re
+import sys
+import time
+
+import emoji
+from bs4 import BeautifulSoup
+from funcy import rcompose, lfilter, lmap, complement, partial
+from nltk.tokenize import TweetTokenizer
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from topic_model.prompt_budget import split_examples  # noqa: E402
+from topic_model.util import (clean_reddit_text, clean_texts,  # noqa: E402
+                              clean_tweet)
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+
+legacy_tweet_tokenizer = TweetTokenizer(
+    preserve_case=False, reduce_len=True, strip_handles=True
+)
+legacy_normalise_tweet = rcompose(
+    lambda t: re.sub(r"http\S+", "", t),
+    lambda t: re.sub(r"^RT @\S+:\s+", "", t),
+    legacy_tweet_tokenizer.tokenize,
+    partial(lfilter, complement(emoji.is_emoji)),
+    partial(lmap, lambda w: w.lstrip("#")),
+    lambda ts: " ".join(ts),
+)
+
+
+def legacy_clean_reddit_text(text):
+    return legacy_normalise_tweet(BeautifulSoup(text, "html.parser").get_text())
+
+
+def legacy_clean_tweet(tweet):
+    tweet = re.sub("@[A-Za-z0-9]+", "", tweet)
+    tweet = re.sub(r"(?:\@|http?\://|https?\://|www)\S+", "", tweet)
+    tweet = " ".join(tweet.split())
+    tweet = emoji.replace_emoji(tweet, replace='')
+    return tweet
+
+
+def corpus(n_docs):
+    examples = []
+    for name in ("tweet_examples.txt", "long_tweet_examples.txt"):
+        with open(os.path.join(ROOT, name), encoding="utf-8") as f:
+            examples += split_examples(f.read())
+    variants = []
+    for e in examples:
+        variants += [
+            e,
+            f"RT @pickr: {e} https://t.co/abc123 @someone",
+            f"<p>{e}</p><p>&amp; more at <a href='https://x.com'>x.com</a></p>",
+            f"{e} \U0001F525\U0001F680 #growth",
+        ]
+    return list(itertools.islice(itertools.cycle(variants), n_docs))
+
+
+def rate(fn, docs):
+    start = time.perf_counter()
+    out = fn(docs)
+    return len(docs) / (time.perf_counter() - start), out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=20_000)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    docs = corpus(args.docs)
+    cleaners = [
+        ("reddit", legacy_clean_reddit_text, clean_reddit_text),
+        ("twitter", legacy_clean_tweet, clean_tweet),
+    ]
+    for source, legacy, clean in cleaners:
+        old_rate, old = rate(lambda d: [legacy(t) for t in d], docs)
+        new_rate, new = rate(lambda d: clean_texts(clean, d), docs)
+        pool_rate, pooled = rate(
+            lambda d: clean_texts(clean, d, processes=args.processes), docs
+        )
+        print(
+            f"{source:8s} docs={len(docs)} legacy={old_rate:9.0f}/s "
+            f"single-pass={new_rate:9.0f}/s "
+            f"pool({args.processes})={pool_rate:9.0f}/s "
+            f"same_output={old == new == pooled}"
+        )
+
+
+if __name__ == "__main__":
+    main()
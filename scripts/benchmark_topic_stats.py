@@ -0,0 +1,122 @@
+'''
+Microbenchmark of topic.analyze_topics on synthetic BERTopic output.
+
+Compares the vectorised engine with the previous per-topic implementation
+(kept here as legacy_analyze_topics) at 10k and 100k posts, and checks that
+both return the same topics.
+
+usage: python scripts/benchmark_topic_stats.py [--sizes 10000 100000]
+'''
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from flask import Flask
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# topic.py reads the OpenAI key from the app config at import
+bench_app = Flask(__name__)
+bench_app.config["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY")
+with bench_app.app_context():
+    from topic_model import topic  # noqa: E402
+
+
+def legacy_analyze_topics(topics, probs, topic_keywords, topic_rep_docs, posts, source, trend_prev_days=14):
+    n_topics = max(topics) + 1
+    topic_avg_prob = [0] * n_topics
+    topic_count = [0] * n_topics
+    for topic_id, pr in zip(topics, probs):
+        if topic_id == -1:
+            continue
+        topic_count[topic_id] += 1
+        topic_avg_prob[topic_id] += pr
+    for i, pr in enumerate(topic_avg_prob):
+        if topic_count[i] > 0:
+            topic_avg_prob[i] = pr / topic_count[i]
+    valid_topics = [i for i in range(n_topics) if topic_avg_prob[i] > 0.5]
+
+    posts_df = pd.DataFrame(posts)
+    posts_df["date"] = posts_df["created_at"].apply(lambda x: x.date())
+    posts_df["probs"] = probs
+    metric = "likes" if source == "twitter" else "score"
+    topics_list = []
+    for topic_id in valid_topics:
+        topic_posts_idx = [i for i, t in enumerate(topics) if t == topic_id]
+        topic_df = posts_df.iloc[topic_posts_idx].sort_values(["probs"], ascending=False)
+        grp = topic_df.groupby("date", as_index=False).agg({metric: "sum", "url": "count"})
+        date_thres = datetime.now() - timedelta(days=trend_prev_days)
+        recent = grp[grp["date"] >= date_thres.date()]
+        rank = 5 if len(recent) == 0 else topic.trend_type(recent[metric].values)
+        topics_list.append({
+            "topic_id": topic_id,
+            "topic_keywords": topic_keywords[topic_id + 1],
+            "topic_rep_docs": topic_rep_docs[topic_id + 1],
+            "size": len(topic_df),
+            "likes": int(topic_df[metric].sum()),
+            "rank": rank,
+            "post_ids": topic_df["id"].apply(str).tolist(),
+            "source": source,
+        })
+    return sorted(topics_list, key=lambda t: (t["rank"], -t["likes"]))
+
+
+def synthetic_posts(n_posts, n_topics, seed=42):
+    rng = np.random.default_rng(seed)
+    topics = rng.integers(-1, n_topics, n_posts).tolist()
+    # distinct probabilities keep the post_ids order unambiguous
+    probs = rng.permutation(n_posts) / n_posts
+    now = datetime.now()
+    posts = [
+        {
+            "id": i,
+            "created_at": now - timedelta(days=int(d), hours=int(h)),
+            "score": int(s),
+            "url": f"https://reddit.com/{i}",
+        }
+        for i, d, h, s in zip(
+            range(n_posts),
+            rng.integers(0, 21, n_posts),
+            rng.integers(0, 24, n_posts),
+            rng.poisson(20, n_posts),
+        )
+    ]
+    keywords = [[f"kw{t}"] for t in range(-1, n_topics)]
+    rep_docs = [[f"doc{t}"] for t in range(-1, n_topics)]
+    return topics, probs.tolist(), keywords, rep_docs, posts
+
+
+def timed(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--topics", type=int, default=200)
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        data = synthetic_posts(n, args.topics)
+        new_secs, new = timed(topic.analyze_topics, *data, "reddit")
+        old_secs, old = timed(legacy_analyze_topics, *data, "reddit", repeat=1)
+        same = [t["topic_id"] for t in new] == [t["topic_id"] for t in old] \
+            and all(a == b for a, b in zip(new, old))
+        print(
+            f"posts={n:7d} topics={args.topics} "
+            f"legacy={old_secs * 1000:9.1f}ms vectorised={new_secs * 1000:8.1f}ms "
+            f"speedup={old_secs / new_secs:6.1f}x same_output={same}"
+        )
+
+
+if __name__ == "__main__":
+    main()
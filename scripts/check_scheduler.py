@@ -0,0 +1,198 @@
+'''
+Check of the scheduler daemon's cron handling in pickr_flask/scheduler.py.
+
+CronSpec.next_after is compared with a brute-force scan of UTC minutes,
+matching each minute's wall clock time in --timezone, for the specs in
+config SCHEDULE and some harder ones. Half the start times are near the
+daylight saving changes. As in next_after, a time repeated when the clocks
+go back runs once, and a time skipped when they go forward runs an hour
+later. A few known cases and invalid specs are checked too. It then runs a failing cron job through Scheduler.run_pending and
+checks it's recorded once and not started again before its next cron time.
+No database is needed.
+
+usage: python scripts/check_scheduler.py [--cases 60] [--timezone Europe/London]
+'''
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from flask import Flask
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from config import Config  # noqa: E402
+from pickr_flask import db  # noqa: E402
+from pickr_flask.scheduler import CronSpec, Job, Scheduler  # noqa: E402
+
+EXTRA_SPECS = [
+    "*/15 9-17 * * 1-5",
+    "30 1 * * *",  # inside the hour skipped and repeated in London
+    "0 0 1,15 * *",
+    "0 12 13 * 5",  # either day field matches
+    "5 2 29 2 *",
+    "0 1 * * 0",
+]
+
+
+def skipped(local: datetime, tz: ZoneInfo) -> bool:
+    '''Whether a naive wall clock time doesn't exist in tz.'''
+    there_and_back = local.replace(tzinfo=tz).astimezone(timezone.utc).astimezone(tz)
+    return there_and_back.replace(tzinfo=None) != local
+
+
+def matches(spec: CronSpec, local: datetime) -> bool:
+    return (
+        local.minute in spec.minutes and local.hour in spec.hours
+        and spec.matches_day(local.date())
+    )
+
+
+def brute_force_next(spec: CronSpec, after: datetime, tz: ZoneInfo) -> datetime:
+    t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    while True:
+        local = t.astimezone(tz)
+        wall = local.replace(tzinfo=None)
+        # fold 1 is the second pass through a repeated hour
+        if local.fold == 0 and matches(spec, wall):
+            return t
+        hour_before = wall - timedelta(hours=1)
+        if skipped(hour_before, tz) and matches(spec, hour_before):
+            return t
+        if not spec.matches_day(wall.date()) and not spec.matches_day(hour_before.date()):
+            # nothing matches before the next hour, the clocks change on the hour
+            t += timedelta(minutes=60 - wall.minute)
+        else:
+            t += timedelta(minutes=1)
+
+
+def clock_changes(tz: ZoneInfo, years) -> list:
+    '''UTC times the UTC offset of tz changes, to the hour.'''
+    changes = []
+    t = datetime(years[0], 1, 1, tzinfo=timezone.utc)
+    end = datetime(years[-1] + 1, 1, 1, tzinfo=timezone.utc)
+    offset = t.astimezone(tz).utcoffset()
+    while t < end:
+        t += timedelta(hours=1)
+        new = t.astimezone(tz).utcoffset()
+        if new != offset:
+            changes.append(t)
+            offset = new
+    return changes
+
+
+def check_next_after(specs, tz: ZoneInfo, cases: int, rng: random.Random) -> int:
+    years = [2024, 2025, 2026]
+    changes = clock_changes(tz, years)
+    start = datetime(years[0], 1, 1, tzinfo=timezone.utc)
+    minutes = 366 * 24 * 60 * len(years)
+    mismatches = checked = 0
+    for spec_text in specs:
+        spec = CronSpec(spec_text)
+        for i in range(cases):
+            if changes and i % 2 == 0:
+                after = rng.choice(changes) + timedelta(minutes=rng.randrange(-2 * 24 * 60, 2 * 24 * 60))
+            else:
+                after = start + timedelta(minutes=rng.randrange(minutes), seconds=rng.randrange(60))
+            got, want = spec.next_after(after, tz), brute_force_next(spec, after, tz)
+            checked += 1
+            if got != want:
+                mismatches += 1
+                print(f"MISMATCH {spec_text!r} after {after}: next_after={got} brute force={want}")
+    print(f"next_after: checked {checked} cases over {len(specs)} specs, mismatches={mismatches}")
+    return mismatches
+
+
+# (spec, after, next run) in UTC, Europe/London
+KNOWN_CASES = [
+    # 1:30 is skipped on 2024-03-31, it runs at 2:30 BST
+    ("30 1 * * *", datetime(2024, 3, 31, 0, 0), datetime(2024, 3, 31, 1, 30)),
+    ("30 1 * * *", datetime(2024, 3, 31, 1, 10), datetime(2024, 3, 31, 1, 30)),
+    # 1:30 happens twice on 2024-10-27, it runs the first time only
+    ("30 1 * * *", datetime(2024, 10, 27, 0, 0), datetime(2024, 10, 27, 0, 30)),
+    ("30 1 * * *", datetime(2024, 10, 27, 0, 30), datetime(2024, 10, 28, 1, 30)),
+    # a weekly job stays at 4:59 wall clock time over the change
+    ("59 4 * * 1", datetime(2024, 10, 21, 3, 59), datetime(2024, 10, 28, 4, 59)),
+    ("59 4 * * 1", datetime(2024, 3, 25, 4, 59), datetime(2024, 4, 1, 3, 59)),
+    ("0 15 * * *", datetime(2025, 3, 30, 14, 0), datetime(2025, 3, 31, 14, 0)),
+]
+INVALID_SPECS = ["* * * *", "60 * * * *", "* 24 * * *", "5-1 * * * *", "*/0 * * * *", "0 0 0 * *"]
+
+
+def check_known_cases() -> list:
+    tz = ZoneInfo("Europe/London")
+    failures = []
+    for spec_text, after, want in KNOWN_CASES:
+        after, want = after.replace(tzinfo=timezone.utc), want.replace(tzinfo=timezone.utc)
+        got = CronSpec(spec_text).next_after(after, tz)
+        if got != want:
+            failures.append(f"{spec_text!r} after {after}: next_after={got}, expected {want}")
+    spec = CronSpec("*/20 9-17/4 1,15 * 7")
+    fields = (spec.minutes, spec.hours, sorted(spec.days), sorted(spec.weekdays))
+    if fields != ([0, 20, 40], [9, 13, 17], [1, 15], [0]):
+        failures.append(f"parsed {spec!r} as {fields}")
+    for spec_text in INVALID_SPECS:
+        try:
+            CronSpec(spec_text)
+        except ValueError:
+            continue
+        failures.append(f"invalid spec {spec_text!r} accepted")
+    print(f"known cases: checked {len(KNOWN_CASES)} cases and {len(INVALID_SPECS)} invalid specs")
+    return failures
+
+
+def check_failing_job(tz: ZoneInfo) -> list:
+    '''A failing job runs once and is next due at its next cron time.'''
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db.init_app(app)
+    calls, records = [], []
+
+    def fail():
+        calls.append(datetime.now(timezone.utc))
+        raise RuntimeError("job failed")
+
+    spec = CronSpec("*/5 * * * *")
+    scheduler = Scheduler(app, [Job("fails", fail, spec=spec)], tz)
+    scheduler._record = lambda job, **fields: records.append(fields)
+    now = datetime(2024, 3, 31, 0, 55, tzinfo=timezone.utc)
+    scheduler.next_runs["fails"] = now
+    failures = []
+    for seconds in range(0, 240, 5):
+        scheduler.run_pending(now + timedelta(seconds=seconds))
+        for thread in list(scheduler.running.values()):
+            thread.join()
+    statuses = [r["last_status"] for r in records if "last_status" in r]
+    if len(calls) != 1:
+        failures.append(f"failing job ran {len(calls)} times in 4 minutes")
+    if statuses != ["running", "failed"]:
+        failures.append(f"failing job recorded as {statuses}")
+    if scheduler.next_runs["fails"] != spec.next_after(now, tz):
+        failures.append(f"failing job next due {scheduler.next_runs['fails']}")
+    print(f"failing job: runs={len(calls)} statuses={statuses} next={scheduler.next_runs['fails']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=60)
+    parser.add_argument("--timezone", default=Config.SCHEDULE_TIMEZONE)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    tz = ZoneInfo(args.timezone)
+    specs = list(dict.fromkeys(list(Config.SCHEDULE.values()) + EXTRA_SPECS))
+    failures = []
+    if check_next_after(specs, tz, args.cases, random.Random(args.seed)):
+        failures.append("next_after differs from the brute-force scan")
+    failures += check_known_cases()
+    failures += check_failing_job(tz)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
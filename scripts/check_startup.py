@@ -0,0 +1,76 @@
+'''
+Startup regression check for the web tier.
+
+Runs init_app() in a fresh interpreter and fails if it takes longer than
+--max-seconds, uses more than --max-rss-mb resident memory, or imports any of
+the ML stacks that should only be loaded on first use (torch, BERTopic, ...).
+
+usage: python scripts/check_startup.py [--max-seconds 5] [--max-rss-mb 200]
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# modules that must not be imported by init_app()
+HEAVY_MODULES = [
+    "torch",
+    "transformers",
+    "sentence_transformers",
+    "bertopic",
+    "hdbscan",
+    "umap",
+    "sklearn",
+]
+
+CHILD = f'''
+import json, sys, time
+start = time.perf_counter()
+from pickr_flask import init_app
+init_app()
+seconds = time.perf_counter() - start
+from topic_model.model_registry import rss_mb
+heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+print(json.dumps({{"seconds": seconds, "rss_mb": rss_mb(), "heavy_modules": heavy}}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-seconds", type=float, default=5.0)
+    parser.add_argument("--max-rss-mb", type=float, default=200.0)
+    args = parser.parse_args()
+
+    proc = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        print(proc.stderr, file=sys.stderr)
+        sys.exit(proc.returncode)
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    failures = []
+    if result["seconds"] > args.max_seconds:
+        failures.append(f"init_app took {result['seconds']:.2f}s > {args.max_seconds}s")
+    if result["rss_mb"] > args.max_rss_mb:
+        failures.append(f"RSS {result['rss_mb']:.0f}MB > {args.max_rss_mb}MB")
+    if result["heavy_modules"]:
+        failures.append(f"imported at startup: {', '.join(result['heavy_modules'])}")
+
+    print(
+        f"init_app: {result['seconds']:.2f}s rss={result['rss_mb']:.0f}MB "
+        f"heavy_modules={result['heavy_modules']}"
+    )
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+'''
+Check of the incremental trend scoring in topic_model/trend.py.
+
+Feeds random daily engagement series, with repeated days, gaps and gaps
+longer than MAX_GAP_DAYS, to a TrendState one day at a time. After every
+update its slope is compared with a weighted np.polyfit over all the days
+it covers, each day weighted 0.5 ** (age / half life). The slope with the
+provisional value of an open day is checked the same way. It also reports
+the time per update.
+
+usage: python scripts/check_trend_state.py [--series 300] [--days 120]
+'''
+import argparse
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from topic_model.trend import MAX_GAP_DAYS, MIN_POINTS, TrendState  # noqa: E402
+
+
+def polyfit_slope(values: dict, last_day: date, half_life_days: float):
+    '''Weighted least squares slope of day -> value, x relative to last_day.'''
+    if len(values) < MIN_POINTS:
+        return None
+    x = np.array([(d - last_day).days for d in values], dtype=float)
+    y = np.array(list(values.values()), dtype=float)
+    w = 0.5 ** (-x / half_life_days)
+    # polyfit weights multiply the residuals, not their squares
+    return float(np.polyfit(x, y, 1, w=np.sqrt(w))[0])
+
+
+def close(a, b, rel=1e-9) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    return abs(a - b) <= rel * max(1.0, abs(a), abs(b))
+
+
+def check_series(rng: np.random.Generator, num_days: int) -> int:
+    '''Run one random series and return the number of mismatches.'''
+    half_life = float(rng.choice([3.0, 7.0, 14.0]))
+    state = TrendState(half_life_days=half_life)
+    # what the state should cover: every day since the first or since the
+    # last reset, skipped days at zero
+    expected = {}
+    day = date(2024, 1, 1)
+    mismatches = 0
+    for _ in range(num_days):
+        step = rng.choice([0, 1, 1, 1, 2, 5, MAX_GAP_DAYS + 10], p=[.1, .4, .2, .1, .1, .08, .02])
+        day += timedelta(days=int(step))
+        value = float(rng.exponential(20.0)) if rng.random() > 0.2 else 0.0
+        if expected and (day - max(expected)).days > MAX_GAP_DAYS:
+            expected = {}
+        start = max(expected) if expected else day
+        for i in range((day - start).days + 1):
+            expected.setdefault(start + timedelta(days=i), 0.0)
+        expected[day] += value
+        state.add(day, value)
+
+        want = polyfit_slope(expected, day, half_life)
+        if state.points != len(expected) or not close(state.slope(), want):
+            mismatches += 1
+            print(f"MISMATCH day={day} points={state.points}/{len(expected)} "
+                  f"slope={state.slope()} polyfit={want}")
+
+        # a provisional value for the next day counts as that day's point
+        open_day = day + timedelta(days=1)
+        open_value = float(rng.exponential(20.0))
+        state.add_open(open_day, open_value)
+        with_open = dict(expected)
+        with_open[open_day] = open_value
+        want = polyfit_slope(with_open, open_day, half_life)
+        if not close(state.current_slope(), want):
+            mismatches += 1
+            print(f"MISMATCH open day={open_day} slope={state.current_slope()} polyfit={want}")
+        # the open day is dropped once it's over, and the state round trips
+        # through the topic_trend columns
+        state.close(open_day)
+        state = TrendState.from_dict(state.to_dict())
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--series", type=int, default=300)
+    parser.add_argument("--days", type=int, default=120)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    mismatches = sum(check_series(rng, args.days) for _ in range(args.series))
+    print(f"checked {args.series} series of {args.days} updates: mismatches={mismatches}")
+
+    state = TrendState()
+    day = date(2024, 1, 1)
+    updates = 100_000
+    start = time.perf_counter()
+    for i in range(updates):
+        state.add(day + timedelta(days=i // 2), 1.0)
+    print(f"{(time.perf_counter() - start) / updates * 1e6:.2f}us per update")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
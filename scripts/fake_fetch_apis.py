@@ -0,0 +1,257 @@
+'''
+Run the post fetchers against a local fake of the reddit, twitter and news
+APIs, to check the fetch scheduler and its rate limits without API keys.
+
+The fake server answers reddit OAuth, /new listings and /api/info, twitter
+recent search and tweet lookup, and news api /everything after a fixed latency, and records when each request
+arrived. The subreddits and terms are fetched serially and then with the
+scheduler's thread pool. For each run the script reports the wall time, the
+requests per provider and the highest request rate seen over any window the
+length of the provider's rate limit period. With --redis the buckets are
+kept in that Redis server, so runs started from several shells at once share
+the limits and each run's peak rates drop accordingly.
+
+usage: python scripts/fake_fetch_apis.py [--subreddits 8] [--terms 4]
+           [--latency 0.2] [--workers 8] [--redis redis://localhost:6379/1]
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from flask import Flask
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from config import Config  # noqa: E402
+from pickr_flask import rate_limit  # noqa: E402
+from pickr_flask.fetch_scheduler import FetchJob, FetchScheduler  # noqa: E402
+
+POSTS_PER_SUBREDDIT = 250
+TWEETS_PER_TERM = 250
+TWITTER_EPOCH_MS = 1288834974657
+REDDIT_PAGE = 100
+# small limits so the runs hit them: (requests, per seconds, burst)
+TEST_RATE_LIMITS = {
+    "reddit": dict(requests=20, per_seconds=2, burst=4),
+    "twitter": dict(requests=4, per_seconds=2, burst=2),
+    "newsapi": dict(requests=4, per_seconds=2, burst=2),
+}
+
+
+class FakeAPI(BaseHTTPRequestHandler):
+    latency = 0.0
+    started = time.time()
+    requests = defaultdict(list)  # provider -> arrival times
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, provider, body):
+        with self.lock:
+            self.requests[provider].append(time.monotonic())
+        time.sleep(self.latency)
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        # reddit application-only OAuth
+        self._reply("reddit-auth", {
+            "access_token": "fake", "token_type": "bearer",
+            "expires_in": 3600, "scope": "*",
+        })
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        host, _, path = url.path.lstrip("/").partition("/")
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if host == "oauth.reddit.com" and path.startswith("api/info"):
+            self._reply("reddit", self.reddit_info(query))
+        elif host == "oauth.reddit.com":
+            self._reply("reddit", self.reddit_listing(path.split("/")[1], query))
+        elif host == "api.twitter.com" and "ids" in query:
+            self._reply("twitter", self.tweet_lookup(query))
+        elif host == "api.twitter.com":
+            self._reply("twitter", self.tweets(query))
+        elif host == "newsapi.org":
+            self._reply("newsapi", self.articles(query))
+        else:
+            self.send_error(404)
+
+    def reddit_listing(self, subreddit, query):
+        start = int(query.get("after", "t3_x-0").split("-")[-1])
+        limit = min(int(query.get("limit", REDDIT_PAGE)), REDDIT_PAGE)
+        end = min(start + limit, POSTS_PER_SUBREDDIT)
+        now = time.time()
+        children = [{"kind": "t3", "data": {
+            "id": f"{subreddit}-{i}",
+            "name": f"t3_{subreddit}-{i + 1}",
+            "title": f"post {i} in {subreddit}",
+            "selftext": "body",
+            "score": i,
+            "num_comments": 0,
+            "created": now - 600 * i,
+            "created_utc": now - 600 * i,
+            "url": f"https://example.com/{subreddit}/{i}",
+            "permalink": f"/r/{subreddit}/{i}",
+        }} for i in range(start, end)]
+        after = children[-1]["data"]["name"] if end < POSTS_PER_SUBREDDIT else None
+        return {"kind": "Listing", "data": {"after": after, "children": children}}
+
+    def reddit_info(self, query):
+        # posts gain a point a minute after they're fetched
+        gained = int((time.time() - self.started) // 60)
+        children = [{"kind": "t3", "data": {
+            "id": name[3:],
+            "name": name,
+            "score": int(name.split("-")[-1]) + gained,
+            "num_comments": gained,
+        }} for name in query.get("id", "").split(",") if name]
+        return {"kind": "Listing", "data": {"after": None, "children": children}}
+
+    def tweet_lookup(self, query):
+        gained = int((time.time() - self.started) // 60)
+        return {"data": [{
+            "id": i,
+            "text": "",
+            "edit_history_tweet_ids": [i],
+            "public_metrics": {"retweet_count": gained, "like_count": gained + 1,
+                               "reply_count": 0, "quote_count": 0},
+        } for i in query["ids"].split(",")]}
+
+    def tweets(self, query):
+        # TWEETS_PER_TERM tweets a minute apart, newest first, with real
+        # looking ids so since_id works
+        newest = int(self.started * 1000) - TWITTER_EPOCH_MS
+        term = zlib.crc32(query["query"].encode()) & 0xfff
+        ids = [((newest - 60_000 * i) << 22) + term for i in range(TWEETS_PER_TERM)]
+        since_id = int(query.get("since_id", 0))
+        ids = [i for i in ids if i > since_id]
+        start = int(query.get("next_token", 0))
+        n = int(query.get("max_results", 10))
+        page = ids[start:start + n]
+        meta = {"result_count": len(page)}
+        if page:
+            meta.update(newest_id=str(page[0]), oldest_id=str(page[-1]))
+        if start + n < len(ids):
+            meta["next_token"] = str(start + n)
+        return {"data": [{
+            "id": str(i),
+            "text": f"tweet {i >> 22} about {query['query']}",
+            "created_at": datetime.utcfromtimestamp(
+                ((i >> 22) + TWITTER_EPOCH_MS) / 1000
+            ).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "author_id": "1",
+            "edit_history_tweet_ids": [str(i)],
+            "public_metrics": {"retweet_count": (i >> 22) // 60_000 % 3, "like_count": (i >> 22) // 60_000 % 5,
+                               "reply_count": 0, "quote_count": 0},
+        } for i in page], "meta": meta}
+
+    def articles(self, query):
+        n = int(query.get("pageSize", 20))
+        return {"status": "ok", "totalResults": n, "articles": [{
+            "title": f"article {i} about {query['q']}",
+            "url": f"https://news.example.com/{query['q']}/{query.get('page')}/{i}",
+            "publishedAt": "2024-02-01T00:00:00Z",
+        } for i in range(n)]}
+
+
+def max_rate(stamps, window):
+    '''Most requests seen in any window of the given length, per second.'''
+    stamps = sorted(stamps)
+    best, j = 0, 0
+    for i, t in enumerate(stamps):
+        while t - stamps[j] > window:
+            j += 1
+        best = max(best, i - j + 1)
+    return best / window
+
+
+def run(app, jobs, workers):
+    FakeAPI.requests.clear()
+    # fresh buckets for each run
+    rate_limit._buckets.clear()
+    with app.app_context():
+        scheduler = FetchScheduler(max_workers=workers)
+        start = time.perf_counter()
+        results = list(scheduler.run(jobs))
+        elapsed = time.perf_counter() - start
+    errors = [r for r in results if r.error is not None]
+    counts = {p: len(ts) for p, ts in sorted(FakeAPI.requests.items())}
+    print(f"workers={workers:2d} time={elapsed:6.2f}s jobs={len(results)} "
+          f"errors={len(errors)} requests={counts}")
+    for provider, limit in TEST_RATE_LIMITS.items():
+        stamps = FakeAPI.requests.get(provider, [])
+        allowed = (limit["requests"] + limit["burst"]) / limit["per_seconds"]
+        print(f"    {provider:8s} peak={max_rate(stamps, limit['per_seconds']):5.1f}/s "
+              f"limit={limit['requests'] / limit['per_seconds']:.1f}/s "
+              f"(+burst {allowed:.1f}/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subreddits", type=int, default=8)
+    parser.add_argument("--terms", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--redis", default="")
+    args = parser.parse_args()
+
+    FakeAPI.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ.update(
+        REDDIT_CLIENT_ID="fake", REDDIT_CLIENT_SECRET="fake",
+        REDDIT_USER_AGENT="pickr fake api check",
+    )
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config.update(
+        FETCH_API_BASE_URL=f"http://127.0.0.1:{server.server_port}",
+        FETCH_RATE_LIMITS=TEST_RATE_LIMITS,
+        RATE_LIMIT_REDIS_URL=args.redis,
+        NEWS_API_KEY="fake",
+    )
+    # these read the app config on import
+    with app.app_context():
+        from pickr_flask.newsapi import fetch_news_articles
+        from pickr_flask.reddit import fetch_subreddit_posts
+        from pickr_flask.twitter import get_twitter_posts_from_term
+
+    jobs = [
+        FetchJob("reddit", f"sub{i}", partial(
+            fetch_subreddit_posts, f"sub{i}", num_posts=POSTS_PER_SUBREDDIT
+        ))
+        for i in range(args.subreddits)
+    ] + [
+        FetchJob("twitter", f"term{i}", partial(
+            get_twitter_posts_from_term, f"term{i}", num_posts=150
+        ))
+        for i in range(args.terms)
+    ] + [
+        FetchJob("newsapi", f"news{i}", partial(fetch_news_articles, f"news{i}", num_pages=2))
+        for i in range(args.terms)
+    ]
+    run(app, jobs, 1)
+    run(app, jobs, args.workers)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Content-addressed embedding cache.
+
+Embeddings are keyed by (encoder name, sha256 of the text), so a document
+only has to be encoded once no matter how many topic model runs it is part of.
+The storage backend is anything with `get_many` and `put_many` methods,
+see pickr_flask.embedding_store for the database backed store.
+"""
+import hashlib
+import logging
+from typing import Dict, List, Protocol
+
+import numpy as np
+
+from topic_model.model_registry import get_sentence_model
+
+log = logging.getLogger(__name__)
+
+
+class EmbeddingStore(Protocol):
+
+    def get_many(self, model_name: str, hashes: List[str]) -> Dict[str, np.ndarray]:
+        ...
+
+    def put_many(self, model_name: str, embeddings: Dict[str, np.ndarray]) -> None:
+        ...
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def encode_with_cache(
+        model_name: str,
+        texts: List[str],
+        store: EmbeddingStore,
+        model=None,
+) -> np.ndarray:
+    '''
+    Return embeddings for `texts` in order,
+    reading from `store` and only encoding the texts that are missing.
+    '''
+    if len(texts) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+
+    hashes = [text_hash(t) for t in texts]
+    cached = store.get_many(model_name, list(set(hashes)))
+
+    # encode each distinct missing text once
+    missing = {}
+    for h, t in zip(hashes, texts):
+        if h not in cached and h not in missing:
+            missing[h] = t
+
+    log.info(
+        f"Embedding cache: model={model_name} hits={len(texts) - len(missing)} "
+        f"misses={len(missing)}"
+    )
+    if missing:
+        if model is None:
+            model = get_sentence_model(model_name)
+        new_embeddings = model.encode(
+            list(missing.values()), show_progress_bar=False
+        ).astype(np.float32)
+        encoded = dict(zip(missing.keys(), new_embeddings))
+        store.put_many(model_name, encoded)
+        cached.update(encoded)
+
+    return np.vstack([cached[h] for h in hashes])
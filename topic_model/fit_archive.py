@@ -0,0 +1,231 @@
+"""
+Versioned archive of topic model fits.
+
+Every topic model run saves what it computed for a niche and date: the
+topic and probability of each doc, the doc embeddings and ids, the topic
+keywords and representative docs, and the BERTopic model in its
+safetensors format, which unlike a pickle is safe to load from a shared
+volume. Runs that only assign docs to an earlier model point to that
+version's model instead of saving it again.
+
+The arrays are saved as .npy files and memory-mapped on load, so reading a
+fit back to re-label its topics, rerun a backfill or assign a late post
+to its topics takes milliseconds instead of a refit.
+"""
+import json
+import logging
+import os
+import shutil
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from topic_model.model_registry import TOPIC_ENCODER, get_sentence_model
+
+log = logging.getLogger(__name__)
+
+VERSIONS_DIR = "versions"
+MODEL_DIR = "model"
+META_FILE = "meta.json"
+TOPIC_INFO_FILE = "topic_info.json"
+DOC_IDS_FILE = "doc_ids.json"
+TOPICS_FILE = "topics.npy"
+PROBS_FILE = "probs.npy"
+# float16 halves the size, plenty for cosine similarity
+EMBEDDINGS_FILE = "embeddings.npy"
+
+
+@dataclass
+class SavedFit:
+    path: str
+    version: str
+    meta: dict
+    topics: np.ndarray
+    probs: np.ndarray
+    embeddings: np.ndarray
+    doc_ids: List[str]
+    topic_keywords: List[List[str]]
+    topic_rep_docs: List[List[str]]
+    _centroids: Optional[Tuple[np.ndarray, np.ndarray]] = field(default=None, repr=False)
+
+    def topic_model(self):
+        '''Load the BERTopic model of the fit, with the registry's encoder.'''
+        # local import because this import is slow
+        from bertopic import BERTopic
+
+        model_path = os.path.join(
+            os.path.dirname(self.path), self.meta["model_version"], MODEL_DIR
+        )
+        return BERTopic.load(model_path, embedding_model=get_sentence_model(TOPIC_ENCODER))
+
+    def centroids(self) -> Tuple[np.ndarray, np.ndarray]:
+        '''Topic ids and the unit-norm mean embedding of each, outliers left out.'''
+        if self._centroids is None:
+            topic_ids = np.unique(self.topics[self.topics != -1])
+            centroids = np.stack([
+                self.embeddings[self.topics == t].astype(np.float32).mean(axis=0)
+                for t in topic_ids
+            ]) if len(topic_ids) else np.empty((0, self.embeddings.shape[1]), np.float32)
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            self._centroids = topic_ids, centroids / np.where(norms > 0, norms, 1)
+        return self._centroids
+
+    def assign(self, embeddings: np.ndarray, min_similarity: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Assign docs to the topic with the closest centroid, without loading
+        the model. Docs less similar than min_similarity to every centroid
+        are outliers (-1). Returns the topics and the similarities.
+        '''
+        topic_ids, centroids = self.centroids()
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if len(topic_ids) == 0:
+            return np.full(len(embeddings), -1), np.zeros(len(embeddings), np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        sims = (embeddings / np.where(norms > 0, norms, 1)) @ centroids.T
+        best = sims.argmax(axis=1)
+        best_sims = sims[np.arange(len(best)), best]
+        topics = np.where(best_sims >= min_similarity, topic_ids[best], -1)
+        return topics, best_sims
+
+
+class FitArchive:
+    '''
+    Directory of saved fits, with one version per run of each
+    (niche, source) key: {root_dir}/{key}/versions/{version}/.
+    Versions are named after the date of the data and the time they were
+    saved, so they sort in order.
+    '''
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root_dir, key, VERSIONS_DIR)
+
+    def versions(self, key: str) -> List[str]:
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return []
+        return sorted(v for v in os.listdir(path) if not v.startswith("."))
+
+    def save(
+            self,
+            key: str,
+            data_date: date,
+            topic_model,
+            topics,
+            probs,
+            embeddings: np.ndarray,
+            doc_ids: List[str],
+            model_version: Optional[str] = None,
+    ) -> str:
+        '''
+        Save a fit and return its version. The model is saved with it
+        unless model_version names an earlier version holding the same model.
+        '''
+        now = datetime.now()
+        version = f"{data_date:%Y-%m-%d}_{now:%Y%m%dT%H%M%S%f}"
+        path = os.path.join(self.path(key), version)
+        # written next to the versions and renamed, so a version is
+        # either complete or not there
+        tmp_path = os.path.join(self.path(key), f".{version}.tmp")
+        os.makedirs(tmp_path)
+        try:
+            np.save(os.path.join(tmp_path, TOPICS_FILE), np.asarray(topics, dtype=np.int32))
+            np.save(os.path.join(tmp_path, PROBS_FILE), np.asarray(probs, dtype=np.float32))
+            np.save(os.path.join(tmp_path, EMBEDDINGS_FILE), np.asarray(embeddings, dtype=np.float16))
+            with open(os.path.join(tmp_path, DOC_IDS_FILE), "w", encoding="utf-8") as f:
+                json.dump([str(i) for i in doc_ids], f)
+            info = topic_model.get_topic_info()
+            with open(os.path.join(tmp_path, TOPIC_INFO_FILE), "w", encoding="utf-8") as f:
+                json.dump({
+                    "topic_keywords": info["Representation"].tolist(),
+                    "topic_rep_docs": info["Representative_Docs"].tolist(),
+                }, f)
+            if model_version is None:
+                topic_model.save(
+                    os.path.join(tmp_path, MODEL_DIR),
+                    serialization="safetensors",
+                    save_ctfidf=True,
+                    save_embedding_model=TOPIC_ENCODER,
+                )
+            with open(os.path.join(tmp_path, META_FILE), "w", encoding="utf-8") as f:
+                json.dump({
+                    "key": key,
+                    "version": version,
+                    "data_date": data_date.isoformat(),
+                    "saved_at": now.isoformat(),
+                    "num_docs": len(doc_ids),
+                    "model_version": model_version or version,
+                }, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        log.info(f"Saved topic model fit {key} {version}: docs={len(doc_ids)}")
+        return version
+
+    def load(self, key: str, version: Optional[str] = None, mmap: bool = True) -> Optional[SavedFit]:
+        '''Load a version of a fit, the latest by default.'''
+        if version is None:
+            versions = self.versions(key)
+            if len(versions) == 0:
+                return None
+            version = versions[-1]
+        path = os.path.join(self.path(key), version)
+        if not os.path.isdir(path):
+            return None
+        mmap_mode = "r" if mmap else None
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(os.path.join(path, DOC_IDS_FILE), encoding="utf-8") as f:
+            doc_ids = json.load(f)
+        with open(os.path.join(path, TOPIC_INFO_FILE), encoding="utf-8") as f:
+            info = json.load(f)
+        return SavedFit(
+            path=path,
+            version=version,
+            meta=meta,
+            topics=np.load(os.path.join(path, TOPICS_FILE), mmap_mode=mmap_mode),
+            probs=np.load(os.path.join(path, PROBS_FILE), mmap_mode=mmap_mode),
+            embeddings=np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode=mmap_mode),
+            doc_ids=doc_ids,
+            topic_keywords=info["topic_keywords"],
+            topic_rep_docs=info["topic_rep_docs"],
+        )
+
+    def find(self, key: str, data_date: date, doc_ids: List[str]) -> Optional[SavedFit]:
+        '''The latest fit of the date over exactly these docs, in this order.'''
+        doc_ids = [str(i) for i in doc_ids]
+        prefix = f"{data_date:%Y-%m-%d}_"
+        for version in reversed(self.versions(key)):
+            if not version.startswith(prefix):
+                continue
+            saved = self.load(key, version)
+            if saved is not None and saved.doc_ids == doc_ids:
+                return saved
+        return None
+
+    def prune(self, key: str, keep_days: int) -> int:
+        '''
+        Delete versions saved more than keep_days ago, except the ones
+        holding the model of a version that's kept.
+        Returns the number of versions deleted.
+        '''
+        cutoff = datetime.now() - timedelta(days=keep_days)
+        metas = {}
+        for version in self.versions(key):
+            with open(os.path.join(self.path(key), version, META_FILE), encoding="utf-8") as f:
+                metas[version] = json.load(f)
+        old = {
+            v for v, m in metas.items()
+            if datetime.fromisoformat(m["saved_at"]) < cutoff
+        }
+        needed = {m["model_version"] for v, m in metas.items() if v not in old}
+        deleted = 0
+        for version in sorted(old - needed):
+            shutil.rmtree(os.path.join(self.path(key), version))
+            deleted += 1
+        return deleted
@@ -0,0 +1,393 @@
+"""
+Incremental topic modeling.
+
+Instead of refitting UMAP+HDBSCAN+BERTopic on the whole window every day,
+the fitted model of each niche is persisted and the current window is
+assigned to its existing clusters with approximate prediction.
+A full refit only happens when the assignment looks stale:
+too many outliers (topic -1), the corpus drifted away from the
+fit-time corpus, or the model is older than max_age_days.
+
+Between runs, newly ingested posts are assigned to the saved model as they
+arrive (assign_new_docs). Their outliers are kept with the model, and when
+enough of them are close together to make a topic of their own the model
+is flagged to be refit on the next run.
+"""
+import fcntl
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from topic_model.model_registry import TOPIC_ENCODER, get_sentence_model
+
+log = logging.getLogger(__name__)
+
+MODEL_FILE = "model.pkl"
+META_FILE = "meta.json"
+OUTLIER_FILE = "outliers.npz"
+OUTLIER_LOCK_FILE = "outliers.lock"
+# models kept loaded per process by load_cached, least recently used
+# are dropped first
+MAX_LOADED_MODELS = 4
+
+
+@dataclass
+class RefitPolicy:
+    # refit when this share of the window is assigned to topic -1 ...
+    max_outlier_share: float = 0.5
+    # ... or when the outlier share grew this much since the fit
+    max_outlier_increase: float = 0.15
+    # cosine distance between fit-time and current corpus centroids
+    max_centroid_drift: float = 0.1
+    max_age_days: int = 7
+    # this many outliers of new docs close together are an emerging topic,
+    # if their mean cosine similarity to their centroid is at least this
+    min_emerging_cluster: int = 10
+    min_emerging_similarity: float = 0.5
+    # outliers older than this don't count towards emerging topics
+    outlier_window_days: int = 3
+
+
+@dataclass
+class StreamAssignment:
+    topics: List[int]
+    probs: List[float]
+    # ids of the outliers in each emerging cluster, if any were found
+    emerging: List[List[str]]
+
+
+@dataclass
+class TopicFit:
+    topic_model: object
+    topics: List[int]
+    probs: List[float]
+    refit: bool
+    reason: str
+
+
+def outlier_share(topics) -> float:
+    topics = np.asarray(topics)
+    if len(topics) == 0:
+        return 0.0
+    return float(np.mean(topics == -1))
+
+
+def corpus_centroid(embeddings: np.ndarray) -> np.ndarray:
+    centroid = np.asarray(embeddings, dtype=np.float32).mean(axis=0)
+    norm = np.linalg.norm(centroid)
+    return centroid / norm if norm > 0 else centroid
+
+
+def centroid_drift(a: np.ndarray, b: np.ndarray) -> float:
+    '''Cosine distance between two unit-norm centroids.'''
+    return float(1.0 - np.dot(a, b))
+
+
+class TopicModelStore:
+    '''
+    Directory of fitted models, one per (niche, source) key.
+    The BERTopic model is saved with its HDBSCAN prediction data
+    but without the sentence encoder, which comes from the model registry.
+    '''
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root_dir, key)
+
+    def save(self, key: str, topic_model, meta: dict) -> None:
+        path = self.path(key)
+        os.makedirs(path, exist_ok=True)
+        topic_model.save(
+            os.path.join(path, MODEL_FILE),
+            serialization="pickle",
+            save_embedding_model=False,
+        )
+        self._write_meta(key, meta)
+        # the new model's outliers are different docs
+        with self.outliers_locked(key):
+            if os.path.exists(os.path.join(path, OUTLIER_FILE)):
+                os.remove(os.path.join(path, OUTLIER_FILE))
+
+    def _write_meta(self, key: str, meta: dict) -> None:
+        meta_path = os.path.join(self.path(key), META_FILE)
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def read_meta(self, key: str) -> Optional[dict]:
+        meta_path = os.path.join(self.path(key), META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def update_meta(self, key: str, **fields) -> None:
+        meta_path = os.path.join(self.path(key), META_FILE)
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        meta.update(fields)
+        self._write_meta(key, meta)
+
+    @contextmanager
+    def outliers_locked(self, key: str):
+        '''
+        Hold the lock of the key's outliers, across processes, e.g. around
+        load_outliers and save_outliers so concurrent batches don't drop
+        each other's outliers.
+        '''
+        with open(os.path.join(self.path(key), OUTLIER_LOCK_FILE), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load_outliers(self, key: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''Ids, embeddings and assignment times of the outliers of new docs.'''
+        path = os.path.join(self.path(key), OUTLIER_FILE)
+        if not os.path.exists(path):
+            return np.array([], dtype=str), None, np.array([], dtype=float)
+        with np.load(path) as f:
+            return f["ids"], f["embeddings"], f["seen"]
+
+    def save_outliers(self, key: str, ids, embeddings, seen) -> None:
+        path = os.path.join(self.path(key), OUTLIER_FILE)
+        # np.savez adds .npz to names without it
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, ids=ids, embeddings=embeddings, seen=seen)
+        os.replace(tmp_path, path)
+
+    # model path -> (file mtime, model), for load_cached
+    _loaded: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+
+    def load_cached(self, key: str) -> Optional[Tuple[object, dict]]:
+        '''
+        Like load, but the model stays loaded in this process until it is
+        saved again, or MAX_LOADED_MODELS other models are loaded after it.
+        Meant for the frequent small assignments of new docs.
+        '''
+        model_path = os.path.join(self.path(key), MODEL_FILE)
+        try:
+            mtime = os.path.getmtime(model_path)
+        except OSError:
+            return None
+        cached = self._loaded.get(model_path)
+        if cached is not None and cached[0] == mtime:
+            self._loaded.move_to_end(model_path)
+            with open(os.path.join(self.path(key), META_FILE), encoding="utf-8") as f:
+                return cached[1], json.load(f)
+        # drop the stale model before loading its replacement
+        self._loaded.pop(model_path, None)
+        saved = self.load(key)
+        if saved is not None:
+            self._loaded[model_path] = (mtime, saved[0])
+            while len(self._loaded) > MAX_LOADED_MODELS:
+                self._loaded.popitem(last=False)
+        return saved
+
+    def load(self, key: str) -> Optional[Tuple[object, dict]]:
+        path = self.path(key)
+        model_path = os.path.join(path, MODEL_FILE)
+        meta_path = os.path.join(path, META_FILE)
+        if not (os.path.exists(model_path) and os.path.exists(meta_path)):
+            return None
+
+        # local import because this import is slow
+        from bertopic import BERTopic
+
+        try:
+            topic_model = BERTopic.load(
+                model_path, embedding_model=get_sentence_model(TOPIC_ENCODER)
+            )
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except Exception as e:
+            log.error(f"Could not load topic model {key}: {e}")
+            return None
+        return topic_model, meta
+
+
+def fit_meta(topics, embeddings: np.ndarray) -> dict:
+    return {
+        "fitted_at": datetime.now().isoformat(),
+        "num_docs": len(topics),
+        "outlier_share": outlier_share(topics),
+        "centroid": corpus_centroid(embeddings).tolist(),
+    }
+
+
+def refit_reason(
+        meta: dict,
+        topics,
+        embeddings: np.ndarray,
+        policy: RefitPolicy,
+) -> str:
+    '''
+    Return why the persisted model should be refit,
+    or an empty string if the assignment can be used.
+    '''
+    age = datetime.now() - datetime.fromisoformat(meta["fitted_at"])
+    if age.days >= policy.max_age_days:
+        return f"model is {age.days} days old"
+    if meta.get("emerging_clusters"):
+        sizes = [c["size"] for c in meta["emerging_clusters"]]
+        return f"emerging outlier clusters of sizes {sizes}"
+
+    share = outlier_share(topics)
+    if share > policy.max_outlier_share:
+        return f"outlier share {share:.2f}"
+    if share - meta["outlier_share"] > policy.max_outlier_increase:
+        return f"outlier share grew {meta['outlier_share']:.2f} -> {share:.2f}"
+
+    drift = centroid_drift(
+        np.asarray(meta["centroid"], dtype=np.float32),
+        corpus_centroid(embeddings),
+    )
+    if drift > policy.max_centroid_drift:
+        return f"centroid drift {drift:.3f}"
+    return ""
+
+
+def fit_or_assign(
+        store: TopicModelStore,
+        key: str,
+        texts: List[str],
+        embeddings: np.ndarray,
+        fit: Callable[[], object],
+        policy: Optional[RefitPolicy] = None,
+) -> TopicFit:
+    '''
+    Assign `texts` to the clusters of the persisted model for `key`,
+    falling back to `fit()` (a full refit) when there is no usable model
+    or the refit policy is triggered.
+    '''
+    policy = policy or RefitPolicy()
+    reason = "no saved model"
+
+    saved = store.load(key)
+    if saved is not None:
+        topic_model, meta = saved
+        start = time.perf_counter()
+        topics, probs = topic_model.transform(texts, embeddings)
+        log.info(
+            f"Assigned {len(texts)} docs to saved topic model {key} "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+        reason = refit_reason(meta, topics, embeddings, policy)
+        if not reason:
+            return TopicFit(topic_model, list(topics), list(probs), False, "")
+
+    log.info(f"Refitting topic model {key}: {reason}")
+    start = time.perf_counter()
+    topic_model = fit()
+    topics, probs = topic_model.topics_, topic_model.probabilities_
+    log.info(f"Fit topic model {key} in {time.perf_counter() - start:.1f}s")
+    store.save(key, topic_model, fit_meta(topics, embeddings))
+    return TopicFit(topic_model, list(topics), list(probs), True, reason)
+
+
+def emerging_clusters(
+        topic_model,
+        embeddings: np.ndarray,
+        min_cluster_size: int,
+        min_similarity: float,
+) -> List[np.ndarray]:
+    '''
+    Groups of outlier docs dense enough to make a topic of their own,
+    clustered like the model's topics in its reduced embedding space.
+    The outliers may all be one group, so a single cluster is allowed,
+    and groups that aren't close in the original space are dropped.
+    Returns the indices of the docs of each group.
+    '''
+    if embeddings is None or len(embeddings) < min_cluster_size:
+        return []
+    # local import because this import is slow
+    from hdbscan import HDBSCAN
+
+    reduced = topic_model.umap_model.transform(embeddings)
+    labels = HDBSCAN(
+        min_cluster_size=min_cluster_size,
+        metric="euclidean",
+        cluster_selection_method="eom",
+        allow_single_cluster=True,
+    ).fit_predict(reduced)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    unit = embeddings / np.where(norms > 0, norms, 1)
+    clusters = []
+    for label in sorted(set(labels) - {-1}):
+        members = np.flatnonzero(labels == label)
+        if float(np.mean(unit[members] @ corpus_centroid(unit[members]))) >= min_similarity:
+            clusters.append(members)
+    return clusters
+
+
+def assign_new_docs(
+        store: TopicModelStore,
+        key: str,
+        ids: List[str],
+        texts: List[str],
+        embeddings: np.ndarray,
+        policy: Optional[RefitPolicy] = None,
+) -> Optional[StreamAssignment]:
+    '''
+    Assign newly ingested docs to the clusters of the saved model for key
+    with approximate prediction. The outliers are added to the model's
+    recent outliers, and if some of those now form a cluster the model is
+    flagged so the next run refits it.
+    Returns None when there is no saved model yet.
+    '''
+    policy = policy or RefitPolicy()
+    saved = store.load_cached(key)
+    if saved is None:
+        return None
+    topic_model, meta = saved
+    start = time.perf_counter()
+    topics, probs = topic_model.transform(texts, embeddings)
+    topics = np.asarray(topics)
+
+    # recent outliers, with the new ones
+    now = time.time()
+    new = topics == -1
+    with store.outliers_locked(key):
+        out_ids, out_embeddings, seen = store.load_outliers(key)
+        keep = seen >= now - policy.outlier_window_days * 24 * 3600
+        out_ids = np.concatenate([out_ids[keep], np.asarray(ids, dtype=str)[new]])
+        new_embeddings = np.asarray(embeddings, dtype=np.float32)[new]
+        if out_embeddings is not None:
+            new_embeddings = np.concatenate([out_embeddings[keep], new_embeddings])
+        seen = np.concatenate([seen[keep], np.full(int(new.sum()), now)])
+        store.save_outliers(key, out_ids, new_embeddings, seen)
+
+    emerging = []
+    if new.any():
+        clusters = emerging_clusters(
+            topic_model, new_embeddings,
+            policy.min_emerging_cluster, policy.min_emerging_similarity,
+        )
+        emerging = [out_ids[c].tolist() for c in clusters]
+    if emerging:
+        log.warning(
+            f"Emerging outlier clusters in topic model {key}: "
+            f"sizes={[len(c) for c in emerging]}"
+        )
+        store.update_meta(key, emerging_clusters=[
+            {"size": len(c), "doc_ids": c[:20], "flagged_at": datetime.now().isoformat()}
+            for c in emerging
+        ])
+    log.info(
+        f"Assigned {len(texts)} new docs to topic model {key} "
+        f"in {time.perf_counter() - start:.2f}s: outliers={int(new.sum())} "
+        f"recent_outliers={len(out_ids)}"
+    )
+    return StreamAssignment(topics.tolist(), list(probs), emerging)
@@ -0,0 +1,137 @@
+"""
+Persistent cache of LLM responses.
+
+Deterministic, low temperature prompts (classification, labeling) are
+repeated across runs and backfills, so their responses are stored in a local
+SQLite file keyed by (model, temperature, prompt). Entries expire after a TTL
+and the least recently used entries are evicted above max_entries.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# evict expired/excess entries after this many writes
+EVICT_EVERY = 100
+
+
+def cache_key(model: str, temperature: float, message: str) -> str:
+    return hashlib.sha256(
+        f"{model}\x00{temperature}\x00{message}".encode("utf-8")
+    ).hexdigest()
+
+
+class LLMCache:
+
+    def __init__(self, path: str, ttl_seconds: float, max_entries: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # opened on first use so importing the module doesn't touch disk
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # WAL lets worker processes on this host read while one writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_response (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS llm_response_last_used "
+                "ON llm_response (last_used)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connection()
+                row = conn.execute(
+                    "SELECT response, created_at FROM llm_response WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    conn.execute(
+                        "UPDATE llm_response SET last_used = ? WHERE key = ?",
+                        (now, key),
+                    )
+                    conn.commit()
+                    self.hits += 1
+                    return row[0]
+            except sqlite3.Error as e:
+                log.error(f"LLM cache read error: {e}")
+            self.misses += 1
+            return None
+
+    def set(self, key: str, response: str) -> None:
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO llm_response VALUES (?, ?, ?, ?)",
+                    (key, response, now, now),
+                )
+                conn.commit()
+                self._writes += 1
+                if self._writes % EVICT_EVERY == 0:
+                    self._evict(conn, now)
+            except sqlite3.Error as e:
+                log.error(f"LLM cache write error: {e}")
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute(
+            "DELETE FROM llm_response WHERE created_at < ?",
+            (now - self.ttl_seconds,),
+        )
+        conn.execute(
+            """
+            DELETE FROM llm_response WHERE key IN (
+                SELECT key FROM llm_response
+                ORDER BY last_used DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
+        conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            try:
+                entries = self._connection().execute(
+                    "SELECT COUNT(*) FROM llm_response"
+                ).fetchone()[0]
+            except sqlite3.Error:
+                entries = None
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "entries": entries,
+            }
@@ -0,0 +1,80 @@
+"""
+Bounded-concurrency execution of independent LLM requests.
+
+GPT calls spend nearly all their time waiting on the network, so independent
+prompts are sent concurrently and the results collected in submission order.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Iterable, List, Optional, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+THREAD_MODE = "thread"
+ASYNCIO_MODE = "asyncio"
+
+
+class LLMExecutor:
+    '''
+    Run a function over a batch of inputs with at most max_concurrency
+    calls in flight, returning results in the order of the inputs.
+
+    In "thread" mode calls go through a shared thread pool.
+    In "asyncio" mode the async version of the call is gathered on an event
+    loop, if the caller provides one, otherwise the thread pool is used.
+
+    Functions submitted to the executor must not submit to it themselves,
+    since they would wait on a pool that they are occupying.
+    '''
+
+    def __init__(self, max_concurrency: int = 8, mode: str = THREAD_MODE):
+        if mode not in (THREAD_MODE, ASYNCIO_MODE):
+            raise ValueError(f"Unknown LLM executor mode: {mode}")
+        self.max_concurrency = max(1, max_concurrency)
+        self.mode = mode
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _thread_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency,
+                    thread_name_prefix="llm",
+                )
+            return self._pool
+
+    def map(
+            self,
+            fn: Callable[[T], R],
+            items: Iterable[T],
+            async_fn: Optional[Callable[[T], Awaitable[R]]] = None,
+    ) -> List[R]:
+        items = list(items)
+        if len(items) == 0:
+            return []
+        if len(items) == 1:
+            return [fn(items[0])]
+        if self.mode == ASYNCIO_MODE and async_fn is not None:
+            return asyncio.run(self._gather(async_fn, items))
+        return list(self._thread_pool().map(fn, items))
+
+    async def _gather(self, async_fn, items):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(item):
+            async with semaphore:
+                return await async_fn(item)
+
+        return await asyncio.gather(*(run(item) for item in items))
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
@@ -0,0 +1,90 @@
+"""
+Process-wide registry of sentence encoders.
+
+Loading a SentenceTransformer takes seconds and a few hundred MB of memory,
+so each named encoder is loaded at most once per worker process and shared
+by every caller (topic model fits, TextEmbedder, post deduplication).
+"""
+import logging
+import os
+import resource
+import threading
+import time
+from typing import Dict
+
+log = logging.getLogger(__name__)
+
+# encoder used to embed documents for the BERTopic fit
+TOPIC_ENCODER = "all-MiniLM-L6-v2"
+# encoder used for semantic similarity of generated posts
+SIMILARITY_ENCODER = "multi-qa-MiniLM-L6-cos-v1"
+
+_models = {}
+_load_stats = {}
+_lock = threading.Lock()
+
+
+def rss_mb() -> float:
+    '''
+    Resident memory of this process in MB.
+    Falls back to peak RSS on platforms without /proc.
+    '''
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def get_sentence_model(name: str = TOPIC_ENCODER):
+    '''
+    Return the SentenceTransformer called `name`,
+    loading it on first use.
+    '''
+    model = _models.get(name)
+    if model is not None:
+        return model
+
+    with _lock:
+        # another thread may have loaded it while we waited
+        if name in _models:
+            return _models[name]
+
+        # local import because this import is slow
+        from sentence_transformers import SentenceTransformer
+
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        model = SentenceTransformer(name)
+        load_secs = time.perf_counter() - start
+        rss_delta = rss_mb() - rss_before
+
+        _models[name] = model
+        _load_stats[name] = {
+            "load_seconds": round(load_secs, 3),
+            "rss_delta_mb": round(rss_delta, 1),
+            "pid": os.getpid(),
+        }
+        log.info(
+            f"Loaded sentence model {name} in {load_secs:.2f}s "
+            f"(+{rss_delta:.0f}MB, rss={rss_mb():.0f}MB)"
+        )
+        return model
+
+
+def model_stats() -> Dict[str, dict]:
+    '''
+    Load time and memory cost for each encoder loaded in this process.
+    '''
+    return {
+        "models": dict(_load_stats),
+        "rss_mb": round(rss_mb(), 1),
+    }
+
+
+def clear_models() -> None:
+    '''Drop all loaded encoders, e.g. before forking worker processes.'''
+    with _lock:
+        _models.clear()
+        _load_stats.clear()
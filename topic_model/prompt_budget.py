@@ -0,0 +1,116 @@
+"""
+Token budgets for GPT prompts.
+
+Prompts are packed by token count rather than characters, so each call type
+has a predictable input size and never overflows the context window.
+Tokens are counted with tiktoken when it is installed, otherwise estimated.
+"""
+import logging
+import re
+import threading
+from collections import defaultdict
+from functools import lru_cache
+from typing import List
+
+log = logging.getLogger(__name__)
+
+# max. prompt tokens for the variable part of each call type
+PROMPT_BUDGETS = {
+    # representative docs of a topic for labeling/summarising
+    "topic_overview": 1200,
+    # news headlines of a cluster for labeling/summarising
+    "news_overview": 600,
+    # blog or article text to write statements from
+    "long_content": 1500,
+    # example statements included in generation prompts
+    "tweet_examples": 700,
+}
+# no single document can take more than this share of a budget
+MAX_DOC_SHARE = 0.4
+TOKENIZER_ENCODING = "cl100k_base"
+# rough chars per token for English when tiktoken isn't available
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    '''
+    The tiktoken encoding, or None to estimate token counts.
+    tiktoken fetches its BPE file on first use unless it is already in
+    TIKTOKEN_CACHE_DIR, so a failed download also falls back to estimates.
+    '''
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        log.warning(f"tiktoken unavailable, estimating token counts: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    '''Cut text down to at most max_tokens tokens.'''
+    encoding = _encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def pack_texts(
+        texts: List[str],
+        budget: int,
+        prefix: str = "",
+        separator: str = "\n\n",
+        max_doc_share: float = MAX_DOC_SHARE,
+) -> str:
+    '''
+    Join as many of texts (in order) as fit into budget tokens.
+    Each text is truncated to its share of the budget so that one long
+    document can't crowd out the others.
+    '''
+    max_doc_tokens = max(1, int(budget * max_doc_share))
+    separator_tokens = count_tokens(separator)
+    packed = []
+    used = 0
+    for text in texts:
+        doc = prefix + truncate_tokens(text, max_doc_tokens)
+        tokens = count_tokens(doc) + (separator_tokens if packed else 0)
+        if used + tokens > budget:
+            break
+        packed.append(doc)
+        used += tokens
+    return separator.join(packed)
+
+
+def split_examples(examples_text: str) -> List[str]:
+    '''Split the examples file into examples, each starts with "here is".'''
+    examples = re.split(r"\n\s*\n(?=here is)", examples_text, flags=re.IGNORECASE)
+    return [e.strip() for e in examples if e.strip()]
+
+
+class TokenUsage:
+    '''Thread-safe counters of prompt/completion tokens per call type.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usage = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+
+    def record(self, call_type: str, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            usage = self._usage[call_type]
+            usage["calls"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {k: dict(v) for k, v in self._usage.items()}
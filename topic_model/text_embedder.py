@@ -1,13 +1,18 @@
-from sentence_transformers import SentenceTransformer, util
 import numpy as np
 from typing import List, Tuple, Dict
 
+from topic_model.model_registry import SIMILARITY_ENCODER, get_sentence_model
+
 
 class TextEmbedder():
 
-    def __init__(self):
-        self.embedding_model = SentenceTransformer('multi-qa-MiniLM-L6-cos-v1')
+    def __init__(self, model_name=SIMILARITY_ENCODER):
+        self.model_name = model_name
 
+    @property
+    def embedding_model(self):
+        # shared with every other user of this encoder in the process
+        return get_sentence_model(self.model_name)
 
     def embed(self, str_or_list) -> np.array:
         """converts text in to a sentence embedding representation"""
@@ -15,12 +20,68 @@ class TextEmbedder():
         return text_embeddings
 
     def get_embedding_comparison_list(self, topic_strings):
+        # local import because this import is slow
+        from sentence_transformers import util
         # Compute cosine-similarities
         topic_embeddings = self.embed(topic_strings)
         cosine_scores = util.cos_sim(topic_embeddings, topic_embeddings)
         return cosine_scores
 
     def embedding_simimalrity(self, embeddings1, embeddings2):
+        from sentence_transformers import util
         # Compute cosine-similarities
         cosine_scores = util.cos_sim([embeddings1], [embeddings2])
-        return cosine_scores
\ No newline at end of file
+        return cosine_scores
+
+    def embed_normalized(self, texts: List[str]) -> np.ndarray:
+        """embeds a batch of texts in one call, each row has unit norm"""
+        embeddings = np.asarray(
+            self.embedding_model.encode(texts, show_progress_bar=False),
+            dtype=np.float32,
+        ).reshape(len(texts), -1)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return embeddings / norms
+
+    def most_similar(
+            self,
+            queries: List[str],
+            corpus: List[str],
+            top_k=5,
+            threshold=None
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        For each query return the (corpus index, cosine similarity) of its
+        top_k most similar corpus texts, most similar first.
+        Matches below threshold are dropped.
+        """
+        if len(queries) == 0 or len(corpus) == 0:
+            return [[] for _ in queries]
+        scores = self.embed_normalized(queries) @ self.embed_normalized(corpus).T
+        top_k = min(top_k, len(corpus))
+        # unordered top k per row, then sort just those k
+        top_idx = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        results = []
+        for row, idx in zip(scores, top_idx):
+            idx = idx[np.argsort(-row[idx])]
+            results.append([
+                (int(i), float(row[i])) for i in idx
+                if threshold is None or row[i] > threshold
+            ])
+        return results
+
+    def deduplicate(self, texts: List[str], threshold=0.75) -> List[int]:
+        """
+        Greedily keep texts in order, dropping any text whose cosine
+        similarity to an already kept text is above threshold.
+        Returns the indices of the kept texts.
+        """
+        if len(texts) == 0:
+            return []
+        embeddings = self.embed_normalized(texts)
+        scores = embeddings @ embeddings.T
+        kept = np.zeros(len(texts), dtype=bool)
+        for i in range(len(texts)):
+            if not (scores[i, kept] > threshold).any():
+                kept[i] = True
+        return np.flatnonzero(kept).tolist()
@@ -1,31 +1,54 @@
 """
 Module to compute topic info
 """
+import logging
 import string
 import os
 import math
 import uuid
-from typing import List, Tuple
-from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
 import re
 
 import pandas as pd
 import numpy as np
 import backoff
 import openai
-from openai.error import OpenAIError
+from openai.error import InvalidRequestError, OpenAIError
 from flask import current_app as app
-from sklearn.feature_extraction.text import CountVectorizer
 # from sklearn.metrics.pairwise import cosine_similarity
+from topic_model.embedding_cache import encode_with_cache
+from topic_model.llm_cache import LLMCache, cache_key
+from topic_model.llm_executor import LLMExecutor
+from topic_model.model_registry import TOPIC_ENCODER, get_sentence_model
+from topic_model.prompt_budget import (PROMPT_BUDGETS, TokenUsage, pack_texts,
+                                       split_examples, truncate_tokens)
 from topic_model.text_embedder import TextEmbedder
+from topic_model.trend import TrendState, rank_from_slope, update_trends
 
 EMBEDDER = TextEmbedder()
+log = logging.getLogger(__name__)
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 RANDOM_STATE = 42
 
 openai_key = app.config["OPENAI_API_KEY"]
 openai.api_key = openai_key
 OPEN_AI_MODEL = "gpt-4-1106-preview"
+LLM_EXECUTOR = LLMExecutor(
+    app.config.get("OPENAI_MAX_CONCURRENCY", 8),
+    mode=app.config.get("OPENAI_EXECUTOR_MODE", "thread"),
+)
+LLM_CACHE = None
+if app.config.get("LLM_CACHE_PATH"):
+    LLM_CACHE = LLMCache(
+        app.config["LLM_CACHE_PATH"],
+        ttl_seconds=app.config.get("LLM_CACHE_TTL_DAYS", 30) * 24 * 3600,
+        max_entries=app.config.get("LLM_CACHE_MAX_ENTRIES", 100000),
+    )
+LLM_CACHE_MAX_TEMPERATURE = app.config.get("LLM_CACHE_MAX_TEMPERATURE", 0.2)
+# prompt/completion tokens used by each call type in this process
+TOKEN_USAGE = TokenUsage()
 STRIP_CHARS = "'" + '"' + " \t\n"
 BRAND_VOICES = [
     "Playful and Youthful",
@@ -34,22 +57,44 @@ BRAND_VOICES = [
     "Friendly and Supportive",
     "Bold and Innovative",
 ]
-with open('long_tweet_examples.txt', mode='r', encoding="utf-8") as read_file:
-    TWEET_EXAMPLES = read_file.read()
-    
+TWEET_EXAMPLES_PATH = "long_tweet_examples.txt"
+
+
+@lru_cache(maxsize=1)
+def tweet_examples() -> str:
+    '''As many whole examples as fit the examples token budget.'''
+    with open(TWEET_EXAMPLES_PATH, mode='r', encoding="utf-8") as read_file:
+        return pack_texts(
+            split_examples(read_file.read()),
+            PROMPT_BUDGETS["tweet_examples"],
+            max_doc_share=1.0,
+        )
 
-def build_subtopic_model(texts: List[str], min_samples=1, min_cluster_size=3, reduce_topics=False):
+
+def build_subtopic_model(
+        texts: List[str],
+        min_samples=1,
+        min_cluster_size=3,
+        reduce_topics=False,
+        embedding_store=None,
+        embeddings=None,
+):
     '''
     Take a list of document text and returns trained BERTopic model.
+    If an embedding_store is given, cached embeddings are read from it
+    and only the texts missing from the cache are encoded.
+    Precomputed embeddings can also be passed directly.
     '''
     # local import because this import is slow
     from bertopic import BERTopic
     from bertopic.representation import KeyBERTInspired
     from hdbscan import HDBSCAN
-    from sentence_transformers import SentenceTransformer
+    from sklearn.feature_extraction.text import CountVectorizer
 
     vectorizer_model = CountVectorizer(stop_words="english")
-    sentence_model = SentenceTransformer("all-MiniLM-L6-v2")
+    # the encoder is loaded once per process and shared between fits,
+    # the clustering models are stateful so they are rebuilt every fit
+    sentence_model = get_sentence_model(TOPIC_ENCODER)
     representation_model = KeyBERTInspired()
     hdbscan_model = HDBSCAN(
         min_cluster_size=min_cluster_size,
@@ -66,7 +111,12 @@ def build_subtopic_model(texts: List[str], min_samples=1, min_cluster_size=3, re
         representation_model=representation_model
     )
 
-    embeddings = sentence_model.encode(texts, show_progress_bar=False)
+    if embeddings is None and embedding_store is not None:
+        embeddings = encode_with_cache(
+            TOPIC_ENCODER, texts, embedding_store, model=sentence_model
+        )
+    elif embeddings is None:
+        embeddings = sentence_model.encode(texts, show_progress_bar=False)
     topic_model.fit_transform(texts, embeddings)
     if reduce_topics:
         topic_model.reduce_topics(texts, nr_topics='auto')
@@ -82,56 +132,100 @@ def analyze_topics(
         source: str,
         min_date=None,
         trend_prev_days=14,
+        engagement: Optional[pd.DataFrame] = None,
+        trends: Optional[Dict[int, TrendState]] = None,
 ):
     '''
     Analyze the trend and rank of each topic given a trained BERTopic model and
     the posts it was trained on.
     Trends are ranked from 0-5, with 0 the highest.
 
+    The stats of all topics are computed together: one groupby for the
+    per-topic totals and daily series, and one pass of closed-form
+    least squares for the trend slopes.
+
     @topics: topics[i] is the BERTopic ID of the posts[i].
     @probs: probs[i] is the probability of posts[i] belonging to topics[i].
     @param source: "reddit" or "twitter"
+    @param engagement: engagement gained by posts per day, columns id, date
+        and gain. Posts in it count the gains on the days they were made,
+        the others count all of their engagement on the day they were posted.
+    @param trends: running trend state of each topic, from an earlier run
+        of the same model. When given, only the days each state hasn't seen
+        yet are added, up to yesterday, and the states are updated in place.
     '''
     valid_topics = filter_topics(topics, probs)
+    if len(valid_topics) == 0:
+        return []
+    metric = "likes" if source == "twitter" else "score"
 
     posts_df = pd.DataFrame(posts)
     date_key = "created_at" if "created_at" in posts_df.columns else "published_at"
-    posts_df["date"] = posts_df[date_key].apply(lambda x: x.date())
-    posts_df["probs"] = probs
+    posts_df["date"] = pd.to_datetime(posts_df[date_key]).dt.normalize()
+    posts_df["probs"] = np.asarray(probs, dtype=float)
+    posts_df["topic"] = np.asarray(topics)
+    posts_df = posts_df[posts_df["topic"].isin(valid_topics)]
+
+    # post ids of each topic, most probable first
+    posts_df = posts_df.sort_values(
+        ["topic", "probs"], ascending=[True, False], kind="mergesort"
+    )
+    topic_ids, starts, sizes = np.unique(
+        posts_df["topic"].values, return_index=True, return_counts=True
+    )
+    post_ids = np.split(posts_df["id"].astype(str).values, starts[1:])
+    likes = posts_df.groupby("topic")[metric].sum()
+
+    # daily engagement series of each topic inside the trend window
+    daily = posts_df[["topic", "date", metric]]
+    if engagement is not None and len(engagement) > 0:
+        post_topics = pd.DataFrame({
+            "id": posts_df["id"].astype(str).values, "topic": posts_df["topic"].values,
+        })
+        gains = (
+            engagement.assign(id=engagement["id"].astype(str))
+            .merge(post_topics, on="id")
+            .rename(columns={"gain": metric})
+        )
+        gains["date"] = pd.to_datetime(gains["date"]).dt.normalize()
+        tracked = post_topics["id"].isin(gains["id"]).values
+        daily = pd.concat([daily[~tracked], gains[["topic", "date", metric]]])
+    # days are UTC, like the daily engagement rows
+    today = pd.Timestamp(datetime.utcnow().date())
+    date_thres = today - pd.Timedelta(days=trend_prev_days)
+    if trends is None:
+        daily = daily.groupby(["topic", "date"], as_index=False)[metric].sum()
+        recent = daily[daily["date"] >= date_thres]
+        slopes = trend_slopes(recent["topic"].values, recent[metric].values)
+    else:
+        # only group the days some topic hasn't seen yet, today isn't over
+        for topic_id in topic_ids.tolist():
+            trends.setdefault(topic_id, TrendState())
+        starts = [
+            pd.Timestamp(t.last_day) + pd.Timedelta(days=1)
+            for t in trends.values() if t.last_day is not None
+        ]
+        if len(starts) == len(trends):
+            date_thres = max(date_thres, min(starts))
+        daily = daily[(daily["date"] >= date_thres) & (daily["date"] < today)]
+        daily = daily.groupby(["topic", "date"], as_index=False)[metric].sum()
+        slopes = update_trends(
+            trends,
+            zip(daily["topic"].tolist(), daily["date"].dt.date.tolist(), daily[metric].tolist()),
+            (today - pd.Timedelta(days=1)).date(),
+        )
 
     topics_list = []
-    for topic_id in valid_topics:
-        # get all tweets in this topic and put them in a df
-        topic_posts_idx = [
-            i for i, t in enumerate(topics) if t == topic_id
-        ]
-        topic_df = posts_df.iloc[topic_posts_idx]
-        topic_df.sort_values(["probs"], ascending=False, inplace=True)
-        num_posts = len(topic_df)
-
-        # Get daily stats and trend type of the topic
-        num_likes, topic_df_grp = get_topic_stats(topic_df, source)
-        date_thres = datetime.now() - timedelta(days=trend_prev_days)
-        recent_posts = topic_df_grp[topic_df_grp["date"] >= date_thres.date()]
-
-        if len(recent_posts) == 0:
-            rank = 5
-        elif source == "twitter":
-            rank = trend_type(recent_posts["likes"].values)
-        elif source == "reddit":
-            rank = trend_type(recent_posts["score"].values)
-        else:
-            rank = 5
-
-        post_ids = topic_df["id"].apply(str).tolist()
+    for topic_id, size, ids in zip(topic_ids, sizes, post_ids):
+        topic_id = int(topic_id)
         topics_list.append({
             "topic_id": topic_id,
             "topic_keywords": topic_keywords[topic_id+1],  # +1 offset is used because first topic is the noise topic
             "topic_rep_docs": topic_rep_docs[topic_id+1],
-            "size": num_posts,
-            "likes": num_likes,
-            "rank": rank,
-            "post_ids": post_ids,
+            "size": int(size),
+            "likes": int(likes[topic_id]),
+            "rank": rank_from_slope(slopes.get(topic_id)),
+            "post_ids": ids.tolist(),
             "source": source
         })
 
@@ -139,6 +233,39 @@ def analyze_topics(
     return sorted(topics_list, key=lambda t: (t["rank"], -t["likes"]))
 
 
+def trend_slopes(groups: np.ndarray, values: np.ndarray, min_points=3) -> dict:
+    '''
+    Least squares slope of each group's series in one vectorised pass.
+    values must be ordered by x within each group, x is 0, 1, 2, ...
+    Groups with fewer than min_points values are left out.
+    '''
+    if len(groups) == 0:
+        return {}
+    keys, inverse = np.unique(groups, return_inverse=True)
+    values = np.asarray(values, dtype=float)
+
+    # x is the position of each value within its group
+    order = np.argsort(inverse, kind="stable")
+    counts = np.bincount(inverse)
+    group_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    x = np.empty(len(values))
+    x[order] = np.arange(len(values)) - group_starts
+
+    n = counts.astype(float)
+    sx = np.bincount(inverse, weights=x)
+    sy = np.bincount(inverse, weights=values)
+    sxy = np.bincount(inverse, weights=x * values)
+    sxx = np.bincount(inverse, weights=x * x)
+    denom = n * sxx - sx * sx
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (n * sxy - sx * sy) / denom
+
+    return {
+        k.item(): float(m)
+        for k, m, c in zip(keys, slope, counts) if c >= min_points
+    }
+
+
 def generate_topic_overview(
         docs: List[str],
         topic_keywords: List[str],
@@ -150,12 +277,11 @@ def generate_topic_overview(
     Return empty strings if GPT determines the topic is not good.
     '''
 
-    # TODO(meiji163) change this to count tokens.
-    # the limit is 4097 tokens for body + response
-    topic_documents = "\n\n".join([
-        "Message:    " + d[:1000]
-        for d in topic_rep_docs[:4]
-    ])
+    topic_documents = pack_texts(
+        topic_rep_docs[:4],
+        PROMPT_BUDGETS["topic_overview"],
+        prefix="Message:    ",
+    )
     # if not is_valid_topic_gpt(body):
     #     return "", ""
     topic_label, topic_desc = get_label_and_description(topic_documents, topic_keywords)
@@ -164,6 +290,20 @@ def generate_topic_overview(
     return topic_label, topic_desc
 
 
+def generate_topic_overviews(
+        topics: List[Tuple[List[str], List[str], List[str]]],
+        niche_title: str,
+) -> List[Tuple[str, str]]:
+    '''
+    Run generate_topic_overview for a batch of
+    (docs, topic_keywords, topic_rep_docs) concurrently.
+    Results are in the same order as topics.
+    '''
+    return LLM_EXECUTOR.map(
+        lambda t: generate_topic_overview(*t, niche_title), topics
+    )
+
+
 def get_topic_stats(df, source):
     if source == "twitter":
         return (
@@ -184,7 +324,8 @@ def get_topic_stats(df, source):
 def is_valid_topic_gpt(body: str) -> bool:
     resp = send_chat_gpt_message(
         valid_topic_test(body),
-        temperature=0.2
+        temperature=0.2,
+        call_type="validity",
     )
     return resp.lower().strip(string.punctuation) == "yes"
 
@@ -192,7 +333,8 @@ def is_valid_topic_gpt(body: str) -> bool:
 def is_topic_relevant_gpt(niche: str, topic: str) -> bool:
     resp = send_chat_gpt_message(
         is_topic_related_to_niche(topic, niche),
-        temperature=0.2
+        temperature=0.2,
+        call_type="relevance",
     )
     return resp.lower().strip(string.punctuation) == "yes"
 
@@ -200,19 +342,20 @@ def is_topic_relevant_gpt(niche: str, topic: str) -> bool:
 def is_topic_informational_gpt(text) -> bool:
     resp = send_chat_gpt_message(
         is_informational_post(text),
-        temperature=0.2
+        temperature=0.2,
+        call_type="informational",
     )
     return resp.lower().strip(string.punctuation) == "yes"
 
 
 @backoff.on_exception(backoff.expo, OpenAIError)
 def get_label_and_description(topic_documents, topic_keywords):
-    topic_label = send_chat_gpt_message(create_label_prompt(topic_documents, topic_keywords), temperature=0.2)
+    topic_label = send_chat_gpt_message(create_label_prompt(topic_documents, topic_keywords), temperature=0.2, call_type="topic_label")
     try:
         topic_label = topic_label.split('topic:')[1].strip(STRIP_CHARS)
     except Exception:
         pass
-    topic_desc = send_chat_gpt_message(create_summary_prompt(topic_documents, topic_keywords), temperature=0.2)
+    topic_desc = send_chat_gpt_message(create_summary_prompt(topic_documents, topic_keywords), temperature=0.2, call_type="topic_summary")
     try:
         topic_desc = topic_desc.split('topic:')[1].strip(STRIP_CHARS)
         # topic_desc = send_chat_gpt_message(create_summarise_topic_summary_prompt(topic_desc), temperature=0.2)
@@ -225,12 +368,12 @@ def get_label_and_description(topic_documents, topic_keywords):
 
 @backoff.on_exception(backoff.expo, OpenAIError)
 def get_label_and_description_no_keywords(topic_documents):
-    topic_label = send_chat_gpt_message(create_label_prompt_no_keywords(topic_documents), temperature=0.2)
+    topic_label = send_chat_gpt_message(create_label_prompt_no_keywords(topic_documents), temperature=0.2, call_type="topic_label")
     try:
         topic_label = topic_label.split('topic:')[1].strip(STRIP_CHARS)
     except Exception:
         pass
-    topic_desc = send_chat_gpt_message(create_summary_prompt_no_keywords(topic_documents), temperature=0.2)
+    topic_desc = send_chat_gpt_message(create_summary_prompt_no_keywords(topic_documents), temperature=0.2, call_type="topic_summary")
     try:
         topic_desc = topic_desc.split('topic:')[1].strip(STRIP_CHARS)
         # topic_desc = send_chat_gpt_message(create_summarise_topic_summary_prompt(topic_desc), temperature=0.2)
@@ -250,24 +393,20 @@ def filter_topics(
     Given output of BERTopic model, filter topic int IDs
     by avg. document probabilty.
     '''
-    n_topics = max(topics) + 1
-    topic_avg_prob = [0] * n_topics
-    topic_count = [0] * n_topics
-
-    for topic_id, pr in zip(topics, probs):
-        if topic_id == -1:
-            # in BERTopic -1 is the "catchall topic" which we filter out
-            continue
-        topic_count[topic_id] += 1
-        topic_avg_prob[topic_id] += pr
-    for i, pr in enumerate(topic_avg_prob):
-        if topic_count[i] > 0:
-            topic_avg_prob[i] = pr / topic_count[i]
-
-    return list(filter(
-        lambda i: topic_avg_prob[i] > min_avg_prob,
-        range(0, n_topics)
-    ))
+    topics = np.asarray(topics)
+    probs = np.asarray(probs, dtype=float)
+    # in BERTopic -1 is the "catchall topic" which we filter out
+    in_topic = topics != -1
+    if not in_topic.any():
+        return []
+
+    topic_count = np.bincount(topics[in_topic])
+    topic_prob_sum = np.bincount(topics[in_topic], weights=probs[in_topic])
+    topic_avg_prob = np.divide(
+        topic_prob_sum, topic_count,
+        out=np.zeros(len(topic_count)), where=topic_count > 0
+    )
+    return np.flatnonzero(topic_avg_prob > min_avg_prob).tolist()
 
 
 def format_relevant_posts(df, source):
@@ -310,28 +449,143 @@ def trend_type(points):
     y = np.array(points)
     # Fit line
     slope, intercept = np.polyfit(x, y, 1)
-    if slope >= 0.7:
-        return 0
-    elif slope >= 0.4:
-        return 1
-    elif slope >= 0:
-        return 2
-    else:
-        return 4
+    return rank_from_slope(slope)
 
 
-@backoff.on_exception(backoff.expo, OpenAIError)
-def send_chat_gpt_message(message, temperature=1):
-    # TODO: check the temperature is correct
-    return (
-        openai.ChatCompletion.create(
-            model=OPEN_AI_MODEL,
-            messages=[{"role": "user", "content": message}],
-            temperature=temperature,
+def cached_response_key(message, temperature):
+    '''
+    Cache key for a prompt, or None if its response shouldn't be cached.
+    Only deterministic, low temperature calls are cached.
+    '''
+    if LLM_CACHE is None or temperature > LLM_CACHE_MAX_TEMPERATURE:
+        return None
+    return cache_key(OPEN_AI_MODEL, temperature, message)
+
+
+def send_chat_gpt_message(message, temperature=1, call_type="chat"):
+    key = cached_response_key(message, temperature)
+    if key is not None:
+        response = LLM_CACHE.get(key)
+        if response is not None:
+            return response
+
+    response = create_chat_completion(message, temperature, call_type=call_type)
+    if key is not None:
+        LLM_CACHE.set(key, response)
+    return response
+
+
+def is_context_overflow(e: OpenAIError) -> bool:
+    # retrying a request that is too long can't succeed
+    return isinstance(e, InvalidRequestError)
+
+
+def record_usage(response, call_type) -> None:
+    usage = response.get("usage")
+    if usage:
+        TOKEN_USAGE.record(
+            call_type, usage["prompt_tokens"], usage["completion_tokens"]
         )
-        .choices[0]
-        .message.content
+
+
+@backoff.on_exception(backoff.expo, OpenAIError, giveup=is_context_overflow)
+def create_chat_completion(message, temperature=1, call_type="chat"):
+    # TODO: check the temperature is correct
+    response = openai.ChatCompletion.create(
+        model=OPEN_AI_MODEL,
+        messages=[{"role": "user", "content": message}],
+        temperature=temperature,
     )
+    record_usage(response, call_type)
+    return response.choices[0].message.content
+
+
+async def asend_chat_gpt_message(message, temperature=1, call_type="chat"):
+    key = cached_response_key(message, temperature)
+    if key is not None:
+        response = LLM_CACHE.get(key)
+        if response is not None:
+            return response
+
+    response = await acreate_chat_completion(message, temperature, call_type=call_type)
+    if key is not None:
+        LLM_CACHE.set(key, response)
+    return response
+
+
+@backoff.on_exception(backoff.expo, OpenAIError, giveup=is_context_overflow)
+async def acreate_chat_completion(message, temperature=1, call_type="chat"):
+    response = await openai.ChatCompletion.acreate(
+        model=OPEN_AI_MODEL,
+        messages=[{"role": "user", "content": message}],
+        temperature=temperature,
+    )
+    record_usage(response, call_type)
+    return response.choices[0].message.content
+
+
+def send_chat_gpt_messages(messages: List[str], temperature=1, call_type="chat") -> List[str]:
+    '''
+    Send independent prompts concurrently.
+    Responses are in the same order as messages.
+    '''
+    return LLM_EXECUTOR.map(
+        lambda m: send_chat_gpt_message(m, temperature=temperature, call_type=call_type),
+        messages,
+        async_fn=lambda m: asend_chat_gpt_message(m, temperature=temperature, call_type=call_type),
+    )
+
+
+@backoff.on_exception(backoff.expo, OpenAIError, max_tries=3, giveup=is_context_overflow)
+def create_chat_completion_candidates(message, n, temperature=1, call_type="chat") -> List[str]:
+    '''
+    Ask for n completions of one prompt in a single request,
+    so the prompt tokens are only sent and billed once.
+    '''
+    response = openai.ChatCompletion.create(
+        model=OPEN_AI_MODEL,
+        messages=[{"role": "user", "content": message}],
+        temperature=temperature,
+        n=n,
+    )
+    record_usage(response, call_type)
+    return [c.message.content for c in response.choices]
+
+
+def send_chat_gpt_message_candidates(
+        messages: List[str],
+        n: int,
+        temperature=1,
+        call_type="chat",
+) -> List[List[str]]:
+    '''
+    Get n candidate responses for each message, one request per message.
+    Candidates missing from a response (request failed, fewer choices
+    returned or empty content) are filled with separate per-call requests.
+    '''
+    def candidates(message):
+        try:
+            choices = create_chat_completion_candidates(
+                message, n, temperature, call_type=call_type
+            )
+        except OpenAIError as e:
+            log.warning(f"multi-candidate request failed, falling back: {e}")
+            return []
+        return [c for c in choices if c and c.strip(STRIP_CHARS)][:n]
+
+    results = LLM_EXECUTOR.map(candidates, messages)
+
+    fallback = [
+        (i, m) for i, m in enumerate(messages)
+        for _ in range(n - len(results[i]))
+    ]
+    if fallback:
+        responses = send_chat_gpt_messages(
+            [m for _, m in fallback], temperature=temperature, call_type=call_type
+        )
+        for (i, _), response in zip(fallback, responses):
+            results[i].append(response)
+    return results
 
 
 # TODO(meiji163) Use the BERTopic keywords for generation too
@@ -353,21 +607,28 @@ def generate_tweets_for_topic(
         1 if num_tweets_per_tweet_type <= 0 else num_tweets_per_tweet_type
     )
 
+    # one request per prompt returns all of its candidate tweets
+    num_candidates = math.ceil(num_tweets/2)
+    informative_tweets, funny_tweets = send_chat_gpt_message_candidates(
+        [
+            generate_informative_tweet_for_topic_awesome_prompt(topic_label),
+            generate_informative_tweet_for_topic_awesome_prompt(topic_summary),
+        ],
+        num_candidates,
+        call_type="tweet",
+    )
+
     generated_tweets = []
-    for i in range(math.ceil(num_tweets/2)):
-        tweet = send_chat_gpt_message(generate_informative_tweet_for_topic_awesome_prompt(topic_label))
-        tweet = clean_generated_tweet(tweet)
+    for informative_tweet, funny_tweet in zip(informative_tweets, funny_tweets):
         generated_tweets.append({
             "topic_label": topic_label,
             "information_type": "informative",
-            "text": tweet,
+            "text": clean_generated_tweet(informative_tweet),
         })
-        tweet = send_chat_gpt_message(generate_informative_tweet_for_topic_awesome_prompt(topic_summary))
-        tweet = clean_generated_tweet(tweet)
         generated_tweets.append({
             "topic_label": topic_label,
             "information_type": "funny",
-            "text": tweet,
+            "text": clean_generated_tweet(funny_tweet),
         })
 
     return generated_tweets
@@ -388,7 +649,7 @@ def clean_generated_tweet(text):
 def rewrite_tweet_in_users_tone(tweet, user_tweet_examples):
     """Given a string of user tweets rewrite a tweet in the users tone"""
     message = f"You are an educational social media content creator. You manage social media profiles and have been shown a public statement that you have to rewrite in the tone and style of your client. Here are some examples of your clients public statements {user_tweet_examples}. Here is the public statement that I want you to rewrite in the style and tone of the examples: {tweet}. Don't mention any specific twitter users, tools or resources. Don't include any emoji's."
-    return send_chat_gpt_message(message).strip(STRIP_CHARS).lower().split("public statement:")[-1]
+    return send_chat_gpt_message(message, call_type="tone_match").strip(STRIP_CHARS).lower().split("public statement:")[-1]
 
 
 def valid_topic_test(text):
@@ -458,24 +719,14 @@ def create_label_prompt_no_keywords(documents):
 
 
 def remove_duplicated_posts(generated_posts, match_threshold=0.75):
-    deduplicated_posts = []
-    post_embeddings = []
-
-    for post in generated_posts:
-        remove_post = False
-        latest_post_embedding = EMBEDDER.embed(post.text)
-
-        for post_embedding in post_embeddings:
-
-            cosine_similarity = EMBEDDER.embedding_simimalrity(latest_post_embedding, post_embedding)[0][0]
-            if cosine_similarity > match_threshold:
-                remove_post = True
-                break
-
-        if not remove_post:
-            post_embeddings.append(latest_post_embedding)
-            deduplicated_posts.append(post)
-
+    """
+    Drop posts that are semantically near-duplicates of an earlier post,
+    then drop posts that are too short.
+    """
+    keep_idx = EMBEDDER.deduplicate(
+        [post.text for post in generated_posts], threshold=match_threshold
+    )
+    deduplicated_posts = [generated_posts[i] for i in keep_idx]
     deduplicated_posts = [p for p in deduplicated_posts if len(p.text) > 50]
     return deduplicated_posts
 
@@ -511,7 +762,7 @@ def is_informational_post(post_text):
 def generate_informative_tweet_for_topic_awesome_prompt(topic_summary):
     """Implementation: original_gpt4_awesome-chatgpt-prompts_3examples_tweet_generation_results.csv
     """
-    message = f"I want you to act as a social media manager. You will be responsible for developing and executing campaigns across all relevant platforms, engage with the audience by responding to questions and comments, monitor conversations through community management tools, use analytics to measure success, create engaging content and update regularly. You manage social media profiles and have been asked to come up with a brief public statement that your client should post. I want you to read this topic summary, pick out an interesting topic and write a brief public statement about it. Use the topic summary to help you. Here is the topic summary: {topic_summary}. think step-by-step. Analyse the topic and identify its relevance to the audience. Then think of a good point that the audience should know. Then create the public statement. Don't mention any personal stories or situations from the past. Don't introduce the topic at the beginning of the tweet with words like 'exploring', 'diving', or 'unlock'. Don't mention any specific twitter users, or tools/resources. You aren't selling anything Don't include any emoji's. Here are some statement examples you can use as inspiration (don't directly copy the styles/formats: {TWEET_EXAMPLES}."
+    message = f"I want you to act as a social media manager. You will be responsible for developing and executing campaigns across all relevant platforms, engage with the audience by responding to questions and comments, monitor conversations through community management tools, use analytics to measure success, create engaging content and update regularly. You manage social media profiles and have been asked to come up with a brief public statement that your client should post. I want you to read this topic summary, pick out an interesting topic and write a brief public statement about it. Use the topic summary to help you. Here is the topic summary: {topic_summary}. think step-by-step. Analyse the topic and identify its relevance to the audience. Then think of a good point that the audience should know. Then create the public statement. Don't mention any personal stories or situations from the past. Don't introduce the topic at the beginning of the tweet with words like 'exploring', 'diving', or 'unlock'. Don't mention any specific twitter users, or tools/resources. You aren't selling anything Don't include any emoji's. Here are some statement examples you can use as inspiration (don't directly copy the styles/formats: {tweet_examples()}."
     return message
 
 
@@ -530,9 +781,9 @@ def generate_informative_tweets_from_long_content(content):
                                 f" stories or situations from the past. Don't introduce the topic at the beginning of the tweet with" \
                                 f" words like 'exploring', 'diving', or 'unlock'. Don't mention any specific twitter users, or tools/resources." \
                                 f" You aren't selling anything Don't include any emoji's. Return nothing but the public statements separated by the phrase 'NEXT STATEMENT' Here are some statement examples you can use as inspiration" \
-                                f" (don't directly copy the styles/formats: {TWEET_EXAMPLES}. Create some brief public statements from" \
-                                f" the following blog post{content[:6000]}. "
-    informative_tweets = send_chat_gpt_message(create_statements_message).strip(STRIP_CHARS)
+                                f" (don't directly copy the styles/formats: {tweet_examples()}. Create some brief public statements from" \
+                                f" the following blog post{truncate_tokens(content, PROMPT_BUDGETS['long_content'])}. "
+    informative_tweets = send_chat_gpt_message(create_statements_message, call_type="long_content").strip(STRIP_CHARS)
     return informative_tweets.split("NEXT STATEMENT")
 
 
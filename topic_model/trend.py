@@ -0,0 +1,169 @@
+"""
+Incremental trend scoring.
+
+The trend of a topic is the least squares slope of its daily engagement.
+Instead of refitting the line over the whole window on every run, each
+topic keeps the running sums of the regression (n, Σx, Σy, Σxy, Σx²),
+with older days weighted down exponentially. Adding a day's engagement
+updates the sums in constant time, and the slope is read off them.
+
+x is measured in days relative to the last day added, so it stays small
+however long a topic lives: the last day is at x=0, the day before at
+x=-1, and so on. Moving on by a day shifts the sums in closed form.
+
+Posts assigned to a topic during the day add to a provisional value for
+the day, which is replaced by the full day once it's over.
+"""
+from dataclasses import asdict, dataclass, replace
+from datetime import date
+from typing import Dict, Iterable, Optional, Tuple
+
+# weight of a day halves after this many days
+DEFAULT_HALF_LIFE_DAYS = 7.0
+# days without engagement after which the sums are negligible and reset
+MAX_GAP_DAYS = 90
+MIN_POINTS = 3
+
+
+def rank_from_slope(slope) -> int:
+    '''
+    Trend rank of a daily engagement slope, 0 is the highest.
+    A missing slope (too few points to fit) ranks 5.
+    '''
+    if slope is None:
+        return 5
+    if slope >= 0.7:
+        return 0
+    elif slope >= 0.4:
+        return 1
+    elif slope >= 0:
+        return 2
+    else:
+        return 4
+
+
+@dataclass
+class TrendState:
+    '''
+    Exponentially weighted regression sums of one topic's daily engagement.
+    Days must be added in order, adding to the last day again adds to its
+    total. Days skipped over count as days without engagement.
+    open_day and open_value hold the engagement seen so far of a day that
+    isn't over, kept out of the sums.
+    '''
+    last_day: Optional[date] = None
+    points: int = 0  # days covered, unweighted
+    n: float = 0.0  # Σw
+    sx: float = 0.0  # Σwx
+    sy: float = 0.0  # Σwy
+    sxy: float = 0.0  # Σwxy
+    sxx: float = 0.0  # Σwx²
+    half_life_days: float = DEFAULT_HALF_LIFE_DAYS
+    open_day: Optional[date] = None
+    open_value: float = 0.0
+
+    def advance(self, day: date) -> None:
+        '''Move on to day, adding a zero point for it and each day skipped.'''
+        if self.last_day is None:
+            self._add_point()
+            self.last_day = day
+            return
+        gap = (day - self.last_day).days
+        if gap < 0:
+            raise ValueError(f"Trend days must be added in order: {day} < {self.last_day}")
+        if gap > MAX_GAP_DAYS:
+            self.__init__(
+                half_life_days=self.half_life_days,
+                open_day=self.open_day, open_value=self.open_value,
+            )
+            self.advance(day)
+            return
+        decay = 0.5 ** (1 / self.half_life_days)
+        for _ in range(gap):
+            self.n *= decay
+            self.sx *= decay
+            self.sy *= decay
+            self.sxy *= decay
+            self.sxx *= decay
+            # every x goes down by one: x -> x - 1
+            self.sxx += self.n - 2 * self.sx
+            self.sxy -= self.sy
+            self.sx -= self.n
+            self._add_point()
+        self.last_day = day
+
+    def _add_point(self) -> None:
+        # a point at x=0 with y=0 only adds its weight
+        self.n += 1.0
+        self.points += 1
+
+    def add(self, day: date, value: float) -> None:
+        '''Add value to the engagement of day.'''
+        self.advance(day)
+        # the day is at x=0, so Σwxy doesn't change
+        self.sy += value
+
+    def add_open(self, day: date, value: float) -> None:
+        '''Add value to the provisional engagement of a day that isn't over.'''
+        if self.last_day is not None and day <= self.last_day:
+            # the day is closed already, it'll be added in full
+            return
+        if self.open_day != day:
+            self.open_day, self.open_value = day, 0.0
+        self.open_value += value
+
+    def close(self, until: date) -> None:
+        '''Drop the provisional value once its day has been added in full.'''
+        if self.open_day is not None and self.open_day <= until:
+            self.open_day, self.open_value = None, 0.0
+
+    def current_slope(self) -> Optional[float]:
+        '''Slope including the provisional value of the open day.'''
+        if self.open_day is None:
+            return self.slope()
+        state = replace(self)
+        state.add(self.open_day, self.open_value)
+        return state.slope()
+
+    def slope(self, min_points: int = MIN_POINTS) -> Optional[float]:
+        if self.points < min_points:
+            return None
+        denom = self.n * self.sxx - self.sx * self.sx
+        if denom <= 0:
+            return None
+        return (self.n * self.sxy - self.sx * self.sy) / denom
+
+    def rank(self) -> int:
+        return rank_from_slope(self.current_slope())
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "TrendState":
+        return cls(**{k: d[k] for k in cls.__dataclass_fields__ if k in d})
+
+
+def update_trends(
+        states: Dict[int, TrendState],
+        daily: Iterable[Tuple[int, date, float]],
+        until: date,
+) -> Dict[int, Optional[float]]:
+    '''
+    Add the (topic, day, engagement) rows of days after each topic's last
+    day and up to until, in day order, then move every state on to until.
+    Rows of days a state already covers are skipped. New topics get a state.
+    Returns topic -> slope.
+    '''
+    for topic_id, day, value in sorted(daily, key=lambda r: (r[1], r[0])):
+        if day > until:
+            continue
+        state = states.setdefault(topic_id, TrendState())
+        if state.last_day is not None and day <= state.last_day:
+            continue
+        state.add(day, value)
+    for state in states.values():
+        if state.last_day is None or state.last_day < until:
+            state.advance(until)
+        state.close(until)
+    return {topic_id: state.slope() for topic_id, state in states.items()}
@@ -1,63 +1,194 @@
+"""
+Text preprocessing helpers.
+
+NLTK data (tokenizer models, stop words, WordNet) is read from a local
+directory and never downloaded at import or on use. Run
+`python cron_tasks.py nltk-data` once per host to fetch it.
+"""
+import logging
+import os
 import re
-from typing import List
-
-import nltk
-from nltk.stem import WordNetLemmatizer
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from funcy import rcompose, lfilter, lmap, complement, partial
-from nltk.tokenize import TweetTokenizer
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Callable, List, Set
+
 from bs4 import BeautifulSoup
-from emoji import is_emoji
+from emoji import is_emoji, replace_emoji
 
-nltk.download('punkt')
-nltk.download('stopwords')
+# nltk is imported where it's used, importing it loads scipy and sklearn
 
-tweet_tokenizer = TweetTokenizer(
-    preserve_case=False, reduce_len=True, strip_handles=True
-)
-remove_emojis = partial(lfilter, complement(is_emoji))
-strip_hashtags = partial(lmap, lambda w: w.lstrip("#"))
-normalise_tweet = rcompose(
-    lambda t: re.sub(r"http\S+", "", t),
-    lambda t: re.sub(r"^RT @\S+:\s+", "", t),
-    tweet_tokenizer.tokenize,
-    remove_emojis,
-    strip_hashtags,
-    lambda ts: " ".join(ts),
+log = logging.getLogger(__name__)
+
+NLTK_DATA_DIR = os.environ.get(
+    "NLTK_DATA", os.path.join(os.path.expanduser("~"), "nltk_data")
 )
+# NLTK package name -> resource path used to look it up
+NLTK_RESOURCES = {
+    "punkt": "tokenizers/punkt",
+    "stopwords": "corpora/stopwords",
+    "wordnet": "corpora/wordnet",
+    "omw-1.4": "corpora/omw-1.4",
+}
+EXTRA_STOP_WORDS = {"what", "when", "who", "where", "how", "is", "an"}
+
+URL_RE = re.compile(r"http\S+")
+RETWEET_RE = re.compile(r"^RT @\S+:\s+")
+NON_WORD_RE = re.compile(r"[^a-zA-Z0-9 \n.]")
+HANDLE_RE = re.compile(r"@[A-Za-z0-9]+")
+LINK_RE = re.compile(r"(?:\@|http?\://|https?\://|www)\S+")
+# batches smaller than this aren't worth starting processes for
+PARALLEL_MIN_TEXTS = 2000
+
+
+def _nltk_data_path():
+    import nltk
+    if NLTK_DATA_DIR not in nltk.data.path:
+        nltk.data.path.insert(0, NLTK_DATA_DIR)
+    return nltk
+
+
+def missing_nltk_data() -> List[str]:
+    '''Names of the NLTK packages that aren't installed locally.'''
+    nltk = _nltk_data_path()
+    missing = []
+    for package, resource in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            missing.append(package)
+    return missing
+
+
+def download_nltk_data(download_dir: str = NLTK_DATA_DIR) -> List[str]:
+    '''
+    Fetch the NLTK data used by this module into download_dir.
+    Returns the packages that couldn't be downloaded.
+    '''
+    nltk = _nltk_data_path()
+    failed = []
+    for package in NLTK_RESOURCES:
+        if not nltk.download(package, download_dir=download_dir, quiet=True):
+            failed.append(package)
+    return failed
+
+
+@lru_cache(maxsize=1)
+def ensure_nltk_data():
+    '''Check the NLTK data is installed, once per process.'''
+    missing = missing_nltk_data()
+    if missing:
+        raise LookupError(
+            f"NLTK data {missing} not found in {NLTK_DATA_DIR}, "
+            "run `python cron_tasks.py nltk-data` to download it"
+        )
+
+
+@lru_cache(maxsize=1)
+def tweet_tokenizer():
+    from nltk.tokenize import TweetTokenizer
+    return TweetTokenizer(
+        preserve_case=False, reduce_len=True, strip_handles=True
+    )
+
+
+@lru_cache(maxsize=1)
+def lemmatizer():
+    ensure_nltk_data()
+    from nltk.stem import WordNetLemmatizer
+    return WordNetLemmatizer()
 
 
 def parse_html(text):
+    # plain text has nothing for the parser to do
+    if "<" not in text and "&" not in text:
+        return text
     return BeautifulSoup(text, "html.parser").get_text()
 
 
-def remove_stop_words(docs: List[str]):
-    """Remove stop words form a list of documents"""
+def normalise_tweet(text: str) -> str:
+    '''
+    Strip links, retweet prefixes, handles, emoji and hashtag signs
+    and return the lower case tokens joined by spaces.
+    '''
+    text = RETWEET_RE.sub("", URL_RE.sub("", text))
+    tokens = tweet_tokenizer().tokenize(text)
+    if not text.isascii():
+        # emoji are never ASCII, so only non-ASCII text needs the lookup
+        tokens = [t for t in tokens if not is_emoji(t)]
+    return " ".join(t.lstrip("#") for t in tokens)
+
+
+def clean_reddit_text(text: str) -> str:
+    '''Clean the title + body of a reddit post for topic modeling.'''
+    return normalise_tweet(parse_html(text))
+
+
+def clean_tweet(tweet: str) -> str:
+    '''Remove handles, links, emoji and extra whitespace from a tweet.'''
+    tweet = LINK_RE.sub("", HANDLE_RE.sub("", tweet))
+    tweet = " ".join(tweet.split())
+    if not tweet.isascii():
+        tweet = replace_emoji(tweet, replace="")
+    return tweet
+
+
+def clean_texts(
+        clean: Callable[[str], str],
+        texts: List[str],
+        processes: int = 1,
+) -> List[str]:
+    '''
+    Apply a cleaning function to a batch of texts.
+    Large batches are split over a pool of processes, clean must be a
+    module level function so it can be pickled.
+    '''
+    if processes <= 1 or len(texts) < PARALLEL_MIN_TEXTS:
+        return [clean(t) for t in texts]
+    chunksize = max(1, len(texts) // (processes * 4))
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            return list(pool.map(clean, texts, chunksize=chunksize))
+    except (AssertionError, OSError) as e:
+        # e.g. daemonic celery workers can't start child processes
+        log.warning(f"Cleaning {len(texts)} texts serially: {e}")
+        return [clean(t) for t in texts]
+
+
+def preprocess(docs: List[str]) -> List[Set[str]]:
+    """
+    Lower case, lemmatized word sets of documents without stop words.
+    Each document is tokenized once and each distinct word is lemmatized
+    once per batch.
+    """
+    from nltk.tokenize import word_tokenize
+
+    ensure_nltk_data()
     stop_words = get_stop_words()
-    lemmatizer = WordNetLemmatizer()
-    docs_non_sw = []
+    lemmatize = lemmatizer().lemmatize
+    lemmas = {}
+    docs_words = []
     for d in docs:
-        non_stop_title = " ".join(
-            [
-                lemmatizer.lemmatize(word).lower()
-                for word in word_tokenize(d)
-                if word not in stop_words and word.strip != "" and len(word) > 1
-            ]
-        )
-        non_stop_title = re.sub("[^a-zA-Z0-9 \n\.]", "", non_stop_title)
-        non_stop_title = set(word_tokenize(non_stop_title))
-        docs_non_sw.append(non_stop_title)
-    return docs_non_sw
-
-
-def get_stop_words():
-    stop_words = set(stopwords.words('english'))
-    stop_words.add('what')
-    stop_words.add('when')
-    stop_words.add('who')
-    stop_words.add('where')
-    stop_words.add('how')
-    stop_words.add('is')
-    stop_words.add('an')
-    return stop_words
\ No newline at end of file
+        words = set()
+        for word in word_tokenize(d):
+            if len(word) <= 1 or word in stop_words:
+                continue
+            lemma = lemmas.get(word)
+            if lemma is None:
+                lemma = NON_WORD_RE.sub("", lemmatize(word).lower())
+                lemmas[word] = lemma
+            words.update(lemma.split())
+        docs_words.append(words)
+    return docs_words
+
+
+def remove_stop_words(docs: List[str]):
+    """Remove stop words form a list of documents"""
+    return preprocess(docs)
+
+
+@lru_cache(maxsize=1)
+def get_stop_words() -> frozenset:
+    from nltk.corpus import stopwords
+
+    ensure_nltk_data()
+    return frozenset(stopwords.words('english')) | EXTRA_STOP_WORDS